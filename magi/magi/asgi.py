@@ -11,6 +11,10 @@ import os
 
 from django.core.asgi import get_asgi_application
 
+from melchior.services import warm_up_process
+
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'magi.settings')
 
 application = get_asgi_application()
+
+warm_up_process()
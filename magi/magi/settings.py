@@ -140,3 +140,78 @@ STATICFILES_DIRS = [
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# --- Melchior ---
+
+# Caches do Django. 'melchior_consultas' guarda os embeddings das perguntas feitas na busca:
+# MAX_ENTRIES limita o tamanho (o LocMemCache descarta os menos usados) e TIMEOUT é o TTL em segundos.
+# Para compartilhar entre workers, troque por FileBasedCache ou outro backend compartilhado.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'melchior_consultas': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'melchior-consultas',
+        'TIMEOUT': int(os.getenv('MELCHIOR_QUERY_CACHE_TTL', 24 * 60 * 60)),
+        'OPTIONS': {'MAX_ENTRIES': int(os.getenv('MELCHIOR_QUERY_CACHE_SIZE', 5000))},
+    },
+    'melchior_respostas': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'melchior-respostas',
+        'TIMEOUT': int(os.getenv('MELCHIOR_ANSWER_CACHE_TTL', 7 * 24 * 60 * 60)),
+        'OPTIONS': {'MAX_ENTRIES': int(os.getenv('MELCHIOR_ANSWER_CACHE_SIZE', 2000))},
+    },
+}
+MELCHIOR_QUERY_CACHE_ALIAS = 'melchior_consultas'
+# Respostas geradas; invalidadas pela versão do índice (VersaoIndice) e pelo hash do prompt
+MELCHIOR_ANSWER_CACHE_ALIAS = 'melchior_respostas'
+
+# Cache local de embeddings (compartilhado pelo generate_embeddings e pela busca)
+MELCHIOR_EMBEDDING_CACHE_PATH = os.path.join(BASE_DIR, 'embedding_cache.sqlite3')
+MELCHIOR_EMBEDDING_CACHE_MAX_MB = 512
+
+# Backend da busca vetorial: 'chroma' (coleção do ChromaDB), 'numpy' (busca exata) ou 'ivf' (busca aproximada),
+# os dois últimos montados pelo build_vector_index
+MELCHIOR_VECTOR_BACKEND = os.getenv('MELCHIOR_VECTOR_BACKEND', 'chroma')
+MELCHIOR_VECTOR_INDEX_DIR = os.path.join(BASE_DIR, 'vector_index')
+MELCHIOR_IVF_INDEX_DIR = os.path.join(BASE_DIR, 'vector_index_ivf')
+# Partições do IVF visitadas por consulta: mais partições, mais recall e mais latência
+MELCHIOR_IVF_NPROBE = 8
+# Máximo de candidatos pedidos ao backend vetorial quando os filtros da busca descartam resultados
+MELCHIOR_MAX_FETCH = 200
+# Candidatos de cada busca (vetorial e lexical/FTS5) combinados por reciprocal rank fusion
+MELCHIOR_HYBRID_CANDIDATES = 20
+# Busca do backend 'numpy' sobre a cópia quantizada ('int8' ou 'binary', ver build_vector_index --quantize),
+# reordenando com float32 os MELCHIOR_VECTOR_RERANK_CANDIDATES melhores candidatos. None = busca float32 direta.
+MELCHIOR_VECTOR_QUANTIZATION = os.getenv('MELCHIOR_VECTOR_QUANTIZATION') or None
+MELCHIOR_VECTOR_RERANK_CANDIDATES = 100
+
+# Provedor do embedding das perguntas e modelo das respostas da busca: 'gemini' ou 'fake' (local, sem rede,
+# para testes e medições). As opções são repassadas ao construtor (ex.: {'token_latency': 0.02} no 'fake').
+MELCHIOR_EMBEDDING_PROVIDER = os.getenv('MELCHIOR_EMBEDDING_PROVIDER', 'gemini')
+MELCHIOR_EMBEDDING_PROVIDER_OPTIONS = {}
+MELCHIOR_ANSWER_BACKEND = os.getenv('MELCHIOR_ANSWER_BACKEND', 'gemini')
+MELCHIOR_ANSWER_MODEL_OPTIONS = {}
+# Orçamento (estimado) de tokens das fontes no prompt da busca, e máximo por trecho; ver melchior.context
+MELCHIOR_CONTEXT_TOKENS = int(os.getenv('MELCHIOR_CONTEXT_TOKENS', 3000))
+MELCHIOR_CONTEXT_PASSAGE_TOKENS = int(os.getenv('MELCHIOR_CONTEXT_PASSAGE_TOKENS', 800))
+# Threads por processo para o trabalho bloqueante da busca assíncrona (ORM, índice vetorial, caches em disco)
+MELCHIOR_ASYNC_WORKERS = int(os.getenv('MELCHIOR_ASYNC_WORKERS', 8))
+# Com MELCHIOR_WARM_UP=1, cada processo WSGI/ASGI cria o cliente do Gemini e abre o índice vetorial ao
+# iniciar (melchior.services.warm_up_process), em vez de na primeira busca; workers criados por fork
+# (ex.: gunicorn --preload) descartam os clientes herdados e fazem o próprio warm-up
+MELCHIOR_WARM_UP = os.getenv('MELCHIOR_WARM_UP') == '1'
+
+# Log da busca do Melchior (ex.: tamanho do contexto de cada pergunta antes e depois da montagem)
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'melchior': {'handlers': ['console'], 'level': os.getenv('MELCHIOR_LOG_LEVEL', 'INFO')},
+    },
+}
@@ -1,7 +1,8 @@
 # nerv/magi/melchior/admin.py
 
 from django.contrib import admin
-from .models import Documento, Chunk # Importe seus modelos
+from .models import CitacaoNorma, Documento, Chunk, RegraAntinomia # Importe seus modelos
+from .lexical import fts_available, matching_documento_ids
 
 # Registrar o modelo Documento para que ele apareça no Django Admin
 @admin.register(Documento)
@@ -10,6 +11,18 @@ class DocumentoAdmin(admin.ModelAdmin):
     list_filter = ('tipo_documento', 'hierarquia', 'status', 'data_publicacao')
     search_fields = ('nome_arquivo', 'texto_completo_extraido')
     date_hierarchy = 'data_publicacao' # Permite navegar por data
+
+    def get_search_fields(self, request):
+        # Com o índice FTS5, o texto é buscado nos chunks (get_search_results) em vez de um LIKE no texto completo
+        if fts_available():
+            return ('nome_arquivo',)
+        return super().get_search_fields(request)
+
+    def get_search_results(self, request, queryset, search_term):
+        results, may_have_duplicates = super().get_search_results(request, queryset, search_term)
+        if search_term and fts_available():
+            results = results | queryset.filter(id__in=matching_documento_ids(search_term))
+        return results, may_have_duplicates
     
     # Adicionar uma ação customizada para marcar como revogado (próximo passo)
     actions = ['mark_as_revoked']
@@ -31,10 +44,42 @@ class DocumentoAdmin(admin.ModelAdmin):
 
         self.message_user(request, f'{updated_count} documento(s) marcado(s) como REVOGADO(S) com sucesso.', level='success')
 
-# Você também pode registrar o Chunk se quiser inspecioná-los no admin
-# @admin.register(Chunk)
-# class ChunkAdmin(admin.ModelAdmin):
-#     list_display = ('documento', 'ordem_no_documento', 'is_valido_apos_antinomia', 'relevancia_antinomia')
-#     list_filter = ('is_valido_apos_antinomia', 'documento__hierarquia', 'documento__status')
-#     search_fields = ('conteudo_original', 'conteudo_tratado')
-#     raw_id_fields = ('documento', 'revogado_por_chunk') # Para relacionamentos ForeignKey
\ No newline at end of file
+# Regras usadas pelo resolve_antinomias para decidir se um chunk se declara revogado
+@admin.register(RegraAntinomia)
+class RegraAntinomiaAdmin(admin.ModelAdmin):
+    list_display = ('nome', 'tipo', 'gatilho', 'posicao_maxima', 'prioridade', 'ativa', 'acertos')
+    list_editable = ('prioridade', 'ativa')
+    list_filter = ('tipo', 'ativa')
+    search_fields = ('nome', 'descricao', 'gatilho', 'padrao')
+    readonly_fields = ('acertos',)
+
+# Citações extraídas pelo resolve_antinomias, somente leitura
+class CitacaoNormaInline(admin.TabularInline):
+    model = CitacaoNorma
+    fk_name = 'chunk'
+    fields = ('tipo', 'lei_cod', 'numero_artigo', 'documento_citado', 'trecho')
+    readonly_fields = fields
+    extra = 0
+    can_delete = False
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+# Chunks com a validade já resolvida: o filtro usa o índice de is_valido_apos_antinomia
+@admin.register(Chunk)
+class ChunkAdmin(admin.ModelAdmin):
+    list_display = ('documento', 'ordem_no_documento', 'caminho_estrutural', 'is_valido_apos_antinomia', 'regra_antinomia', 'revogado_por_chunk')
+    list_filter = ('is_valido_apos_antinomia', 'regra_antinomia', 'documento__hierarquia', 'documento__status')
+    search_fields = ('documento__nome_arquivo', 'documento__lei_cod', 'caminho_estrutural')
+    raw_id_fields = ('documento', 'revogado_por_chunk') # Para relacionamentos ForeignKey
+    list_select_related = ('documento', 'regra_antinomia', 'revogado_por_chunk__documento')
+    exclude = ('embedding',)
+    inlines = [CitacaoNormaInline]
+
+@admin.register(CitacaoNorma)
+class CitacaoNormaAdmin(admin.ModelAdmin):
+    list_display = ('chunk', 'tipo', 'lei_cod', 'numero_artigo', 'documento_citado')
+    list_filter = ('tipo',)
+    search_fields = ('lei_cod', 'trecho')
+    raw_id_fields = ('chunk', 'documento_citado')
+    list_select_related = ('chunk__documento', 'documento_citado')
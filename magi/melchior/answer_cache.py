@@ -0,0 +1,73 @@
+# nerv/magi/melchior/answer_cache.py
+
+"""
+Cache das respostas geradas pela busca do Melchior.
+
+A chave combina a pergunta normalizada, a lista ordenada dos chunks recuperados, a versão do
+índice (VersaoIndice) e um hash do prompt e do modelo de geração. Assim, uma resposta só é
+reaproveitada quando o contexto enviado ao LLM seria o mesmo:
+- re-importar documentos, re-chunkar ou re-resolver antinomias incrementa a versão do índice;
+- editar o template do prompt, mudar o orçamento do contexto ou trocar o modelo muda o hash do prompt.
+As entradas antigas não são apagadas: simplesmente deixam de ser encontradas e expiram pelo TTL.
+"""
+
+import hashlib
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from melchior.embedding_cache import normalize_query
+from melchior.models import VersaoIndice
+
+
+def current_index_version():
+    return VersaoIndice.objects.values_list('versao', flat=True).first() or 0
+
+
+def bump_index_version(motivo):
+    """
+    Incrementa a versão do índice, invalidando as respostas em cache. Devolve a nova versão.
+    """
+    with transaction.atomic():
+        updated = VersaoIndice.objects.filter(pk=1).update(versao=F('versao') + 1, motivo=motivo[:255],
+                                                           atualizada_em=timezone.now())
+        if not updated:
+            VersaoIndice.objects.get_or_create(pk=1, defaults={'versao': 1, 'motivo': motivo[:255]})
+    return current_index_version()
+
+
+def prompt_version(template, model):
+    return hashlib.sha256(f'{model}\0{template}'.encode('utf-8')).hexdigest()[:16]
+
+
+class AnswerCache:
+    """
+    Respostas geradas, guardadas no alias MELCHIOR_ANSWER_CACHE_ALIAS do framework de cache do Django.
+    """
+
+    def __init__(self, alias=None):
+        self.alias = alias or getattr(settings, 'MELCHIOR_ANSWER_CACHE_ALIAS', 'default')
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def key(self, query, chunk_ids, index_version, prompt_hash):
+        ids = ','.join(str(chunk_id) for chunk_id in chunk_ids)
+        raw = f'{normalize_query(query)}\0{ids}\0{index_version}\0{prompt_hash}'
+        return f'melchior:resposta:{hashlib.sha256(raw.encode("utf-8")).hexdigest()}'
+
+    def get(self, query, chunk_ids, index_version, prompt_hash):
+        return self.cache.get(self.key(query, chunk_ids, index_version, prompt_hash))
+
+    def set(self, query, chunk_ids, index_version, prompt_hash, answer):
+        self.cache.set(self.key(query, chunk_ids, index_version, prompt_hash), answer)
+
+    async def aget(self, query, chunk_ids, index_version, prompt_hash):
+        return await self.cache.aget(self.key(query, chunk_ids, index_version, prompt_hash))
+
+    async def aset(self, query, chunk_ids, index_version, prompt_hash, answer):
+        await self.cache.aset(self.key(query, chunk_ids, index_version, prompt_hash), answer)
@@ -0,0 +1,349 @@
+# nerv/magi/melchior/chunking.py
+
+"""
+Divisão do texto das normas em chunks para o Melchior.
+"""
+
+import hashlib
+import re
+import statistics
+from dataclasses import dataclass, field
+
+# Identificadores das estratégias de chunking, parte do fingerprint gravado em Documento.hash_texto_chunking.
+# Mudar a estratégia (ou um destes valores) faz o process_documents re-chunkar todos os documentos.
+ARTICLE_STRATEGY = 'artigos-v1'
+HIERARCHICAL_STRATEGY = 'hierarquico-v1'
+
+STRATEGIES = ('artigos', 'hierarquico')
+
+# Orçamento padrão (em caracteres) de cada chunk da estratégia hierárquica
+DEFAULT_MAX_CHARS = 1500
+
+# Padrão original do process_documents. O lookahead negativo temperado é reavaliado a cada
+# caractere do corpo do artigo, o que torna o chunking lento em normas longas.
+# Mantido como referência para testes e benchmarks.
+LEGACY_ARTICLE_PATTERN = re.compile(
+    r'(Art\.\s*\d+[\ºo]?\s*(?:(?!\s*Art\.\s*\d+[\ºo]?\s*).)*)',
+    re.DOTALL | re.IGNORECASE
+)
+
+# Início de artigo: "Art." seguido de espaços opcionais e de um dígito.
+# É exatamente o que o lookahead do padrão original testa ("[\ºo]?\s*" no fim é opcional).
+ARTICLE_START_PATTERN = re.compile(r'Art\.\s*\d', re.IGNORECASE)
+
+
+def split_legal_articles_legacy(text):
+    """
+    Implementação de referência: divide o texto com o padrão original (LEGACY_ARTICLE_PATTERN).
+    """
+    chunks = []
+    for match in LEGACY_ARTICLE_PATTERN.finditer(text):
+        chunk_content = match.group(0).strip()
+        if chunk_content:
+            chunks.append(chunk_content)
+    return chunks
+
+
+def split_legal_articles(text):
+    """
+    Divide o texto de uma norma legal em artigos, usando "Art. N" como delimitador.
+
+    Localiza todos os inícios de artigo em uma única passada e fatia o texto entre eles.
+    Cada artigo vai do seu "Art." até o início do próximo (ou o fim do texto); o texto antes do
+    primeiro artigo é descartado. Produz os mesmos chunks que split_legal_articles_legacy: lá o
+    corpo do artigo para no primeiro espaço em branco antes do próximo "Art. N", e esse espaço
+    é removido pelo strip() de qualquer forma.
+    """
+    starts = [match.start() for match in ARTICLE_START_PATTERN.finditer(text)]
+    chunks = []
+    for start, end in zip(starts, starts[1:] + [len(text)]):
+        chunk_content = text[start:end].strip()
+        if chunk_content:
+            chunks.append(chunk_content)
+    return chunks
+
+
+def chunk_text_by_legal_articles(text, splitter=split_legal_articles):
+    """
+    Divide o texto em artigos; sem nenhum "Art. N", o documento inteiro vira um único chunk.
+
+    Retorna (chunks, usou_fallback). A lista é vazia se o texto não tiver conteúdo.
+    """
+    chunks = splitter(text)
+    if chunks:
+        return chunks, False
+    stripped = text.strip()
+    return ([stripped] if stripped else []), True
+
+
+def chunking_fingerprint(text, strategy=ARTICLE_STRATEGY):
+    """
+    Hash SHA-256 do texto e da estratégia de chunking; se não mudar, os chunks do documento também não mudam.
+    """
+    return hashlib.sha256(f'{strategy}\0{text}'.encode('utf-8')).hexdigest()
+
+
+# --- Chunking hierárquico (artigo / parágrafo / inciso / alínea) ---
+
+ARTICLE_LABEL_PATTERN = re.compile(r'Art\.\s*(\d+)', re.IGNORECASE)
+
+# Marcadores estruturais dentro de um artigo. O texto extraído já passou por NFKC, então "º" virou "o".
+STRUCTURE_PATTERN = re.compile(
+    r'(?P<paragrafo>§\s*(?P<num_paragrafo>\d+)\s*[ºo°]?|Par[aá]grafo\s+[uú]nico)'
+    r'|(?<![\w.])(?P<inciso>(?P<num_inciso>[IVXLC]+))\s*[-–—]\s'
+    r'|(?<![\w.])(?P<alinea>(?P<letra_alinea>[a-z]))\)\s'
+)
+
+ROMAN_NUMERAL_PATTERN = re.compile(r'^C{0,3}(XC|XL|L?X{0,3})(IX|IV|V?I{0,3})$')
+ROMAN_VALUES = {'I': 1, 'V': 5, 'X': 10, 'L': 50, 'C': 100}
+
+# Níveis da estrutura de um artigo
+LEVEL_ARTIGO, LEVEL_PARAGRAFO, LEVEL_INCISO, LEVEL_ALINEA = range(4)
+
+
+def roman_to_int(numeral):
+    """
+    Converte um numeral romano válido (até C) em inteiro; devolve None se não for válido.
+    """
+    if not numeral or not ROMAN_NUMERAL_PATTERN.match(numeral):
+        return None
+    total = 0
+    for current, following in zip(numeral, numeral[1:] + ' '):
+        value = ROMAN_VALUES[current]
+        total += -value if ROMAN_VALUES.get(following, 0) > value else value
+    return total
+
+
+def article_label(text):
+    """
+    Rótulo do artigo no início do texto (ex.: "Art. 5º", "Art. 12"), ou '' se não houver.
+    """
+    match = ARTICLE_LABEL_PATTERN.match(text)
+    if not match:
+        return ''
+    number = int(match.group(1))
+    return f'Art. {number}º' if number < 10 else f'Art. {number}'
+
+
+@dataclass
+class StructureNode:
+    """
+    Nó da árvore de um artigo. [start, end) cobre o nó e todos os descendentes;
+    [start, head_end) é o texto próprio do nó (o caput, no caso do artigo).
+    """
+    label: str
+    level: int
+    start: int
+    end: int = 0
+    head_end: int = 0
+    children: list = field(default_factory=list)
+    # Último número visto entre os filhos de cada nível, para validar a sequência (I, II, III...)
+    last_child_number: dict = field(default_factory=dict)
+
+
+def _is_structural_position(text, position):
+    # Marcadores só abrem um novo dispositivo no início do texto ou depois de '.', ';' ou ':'.
+    # Isso descarta referências cruzadas como "nos termos do § 2º do art. 5º".
+    before = text[:position].rstrip()
+    return not before or before[-1] in '.;:'
+
+
+def parse_article_structure(text):
+    """
+    Monta a árvore de dispositivos (parágrafos, incisos e alíneas) de um artigo.
+
+    Incisos e alíneas só são aceitos se seguirem a sequência do dispositivo pai (I, II, III... / a, b, c...),
+    o que evita tomar palavras em caixa alta ou letras soltas por marcadores.
+    """
+    root = StructureNode(label=article_label(text), level=LEVEL_ARTIGO, start=0)
+    stack = [root]
+
+    for match in STRUCTURE_PATTERN.finditer(text):
+        if match.group('paragrafo'):
+            level = LEVEL_PARAGRAFO
+            if match.group('num_paragrafo'):
+                number = int(match.group('num_paragrafo'))
+                label = f'§{number}º' if number < 10 else f'§{number}'
+            else:
+                number = 1
+                label = 'Parágrafo único'
+        elif match.group('inciso'):
+            level = LEVEL_INCISO
+            number = roman_to_int(match.group('num_inciso'))
+            label = match.group('num_inciso')
+        else:
+            level = LEVEL_ALINEA
+            number = ord(match.group('letra_alinea')) - ord('a') + 1
+            label = f"{match.group('letra_alinea')})"
+
+        if number is None or not _is_structural_position(text, match.start()):
+            continue
+
+        # Encontra o pai: o dispositivo aberto mais próximo de nível inferior
+        parent_index = len(stack) - 1
+        while stack[parent_index].level >= level:
+            parent_index -= 1
+        parent = stack[parent_index]
+        if level != LEVEL_PARAGRAFO and number != parent.last_child_number.get(level, 0) + 1:
+            continue
+
+        for node in stack[parent_index + 1:]:
+            node.end = match.start()
+        del stack[parent_index + 1:]
+
+        node = StructureNode(label=label, level=level, start=match.start())
+        parent.children.append(node)
+        parent.last_child_number[level] = number
+        stack.append(node)
+
+    for node in stack:
+        node.end = len(text)
+    _fill_head_end(root)
+    return root
+
+
+def _fill_head_end(node):
+    node.head_end = node.children[0].start if node.children else node.end
+    for child in node.children:
+        _fill_head_end(child)
+
+
+def _join_path(*labels):
+    return ', '.join(label for label in labels if label)
+
+
+def _split_window(text, start, end, max_chars):
+    # Divide um trecho sem estrutura em janelas de até max_chars, preferindo cortar no fim de frases
+    spans = []
+    while end - start > max_chars:
+        limit = start + max_chars
+        cut = text.rfind('. ', start, limit)
+        if cut <= start:
+            cut = text.rfind(' ', start, limit)
+        cut = cut + 1 if cut > start else limit
+        spans.append((start, cut))
+        start = cut
+    spans.append((start, end))
+    return spans
+
+
+def _pack_node(text, node, path, max_chars):
+    """
+    Gera (início, fim, caminho) cobrindo o nó. Se o nó inteiro cabe no orçamento vira um chunk só;
+    senão, o texto próprio e os filhos consecutivos são agrupados enquanto couberem, e os filhos
+    grandes demais são empacotados recursivamente.
+    """
+    if node.end - node.start <= max_chars:
+        return [(node.start, node.end, path)]
+
+    spans = []
+    group = []  # (início, fim, rótulo do filho ou None para o texto próprio do nó)
+
+    def flush():
+        if not group:
+            return
+        labels = [label for _start, _end, label in group if label is not None]
+        if len(labels) < len(group) or not labels:
+            group_path = path
+        elif len(labels) == 1:
+            group_path = _join_path(path, labels[0])
+        elif len(labels) == 2:
+            group_path = _join_path(path, f'{labels[0]} e {labels[1]}')
+        else:
+            group_path = _join_path(path, f'{labels[0]} a {labels[-1]}')
+        spans.append((group[0][0], group[-1][1], group_path))
+        group.clear()
+
+    def add(start, end, label):
+        if group and end - group[0][0] > max_chars:
+            flush()
+        group.append((start, end, label))
+
+    if text[node.start:node.head_end].strip():
+        if node.head_end - node.start <= max_chars:
+            add(node.start, node.head_end, None)
+        else:
+            windows = _split_window(text, node.start, node.head_end, max_chars)
+            for part, (start, end) in enumerate(windows, 1):
+                spans.append((start, end, f'{path} (parte {part}/{len(windows)})'))
+
+    for child in node.children:
+        if child.end - child.start <= max_chars:
+            add(child.start, child.end, child.label)
+        else:
+            flush()
+            spans.extend(_pack_node(text, child, _join_path(path, child.label), max_chars))
+    flush()
+    return spans
+
+
+def split_article_hierarchically(text, max_chars=DEFAULT_MAX_CHARS):
+    """
+    Divide um artigo em chunks de até max_chars caracteres seguindo a sua estrutura.
+
+    Retorna uma lista de (conteúdo, caminho), ex.: ("§ 2o ... III - ...", "Art. 5º, §2º, III").
+    Os chunks são trechos contíguos do artigo, na ordem original, sem sobreposição.
+    """
+    root = parse_article_structure(text)
+    chunks = []
+    for start, end, path in _pack_node(text, root, root.label, max_chars):
+        content = text[start:end].strip()
+        if content:
+            chunks.append((content, path))
+    return chunks
+
+
+def chunk_text(text, strategy='artigos', max_chars=DEFAULT_MAX_CHARS):
+    """
+    Divide o texto de uma norma segundo a estratégia escolhida.
+
+    'artigos' gera um chunk por artigo; 'hierarquico' ainda divide cada artigo pela sua estrutura
+    para respeitar o orçamento de max_chars. Retorna (lista de (conteúdo, caminho), usou_fallback).
+    """
+    articles, usou_fallback = chunk_text_by_legal_articles(text)
+    if strategy == 'artigos':
+        return [(article, article_label(article)) for article in articles], usou_fallback
+    if strategy != 'hierarquico':
+        raise ValueError(f"Estratégia de chunking desconhecida: '{strategy}'. Opções: {', '.join(STRATEGIES)}.")
+
+    chunks = []
+    for article in articles:
+        if usou_fallback:
+            # Documento sem artigos: só dá para dividir em janelas
+            windows = _split_window(article, 0, len(article), max_chars)
+            for part, (start, end) in enumerate(windows, 1):
+                path = f'parte {part}/{len(windows)}' if len(windows) > 1 else ''
+                chunks.append((article[start:end].strip(), path))
+        else:
+            chunks.extend(split_article_hierarchically(article, max_chars))
+    return [chunk for chunk in chunks if chunk[0]], usou_fallback
+
+
+def strategy_id(strategy='artigos', max_chars=DEFAULT_MAX_CHARS):
+    """
+    Identificador da estratégia (e da configuração) usado no fingerprint do chunking.
+    """
+    if strategy == 'hierarquico':
+        return f'{HIERARCHICAL_STRATEGY}:{max_chars}'
+    return ARTICLE_STRATEGY
+
+
+def chunk_size_stats(sizes):
+    """
+    Resumo da distribuição de tamanhos (em caracteres) de um conjunto de chunks.
+    """
+    sizes = sorted(sizes)
+    if not sizes:
+        return {'quantidade': 0, 'media': 0, 'p50': 0, 'p90': 0, 'p99': 0, 'maximo': 0}
+
+    def percentile(p):
+        return sizes[min(len(sizes) - 1, int(p / 100 * len(sizes)))]
+
+    return {
+        'quantidade': len(sizes),
+        'media': round(statistics.fmean(sizes)),
+        'p50': percentile(50),
+        'p90': percentile(90),
+        'p99': percentile(99),
+        'maximo': sizes[-1],
+    }
@@ -0,0 +1,160 @@
+# nerv/magi/melchior/citation_graph.py
+
+"""
+Grafo de citações e revogações entre normas, montado pelo resolve_antinomias.
+
+Tudo sai de uma leitura só dos chunks (na ordem dos documentos): as citações do texto
+(melchior.citations.extract_references) e o índice (lei_cod, artigo) -> chunks em memória, que
+resolve cada citação sem uma consulta por citação. A invalidade é propagada em uma passada pelas
+arestas de revogação, descendo pela estrutura da norma:
+- "Fica revogado o Decreto-Lei nº 137/1946" invalida todos os chunks da norma citada, e
+  "revoga o art. 5º da Lei ..." todos os chunks do artigo;
+- a nota "(Este artigo foi revogado pelo art. 3º da Lei ...)" invalida o artigo inteiro do chunk,
+  e "(Esta alínea foi revogada ...)" só o chunk, e só se ele não tiver nada além do rótulo da
+  unidade e da nota: num chunk com outras alíneas ou parágrafos, a nota fica só no grafo; notas
+  sobre títulos, capítulos e seções não invalidam nada, porque o texto revogado não está mais no
+  documento.
+
+Uma revogação vale mesmo que a norma revogadora tenha sido revogada depois: não há repristinação
+sem disposição expressa (LINDB, art. 2º, § 3º).
+"""
+
+import re
+from dataclasses import dataclass, field
+
+from melchior.citations import extract_references, simplify_text
+from melchior.models import CitacaoNorma, Chunk, Documento
+
+# Começo do chunk seguinte lido junto com cada chunk (as notas de revogação cortadas terminam nele)
+TAIL_CHARS = 200
+READ_BATCH_SIZE = 2000
+
+# Unidades das notas "(Est[ea] <unidade> foi revogad[oa] pel[oa] ...)", já sem acentos
+UNIDADES_NORMA = ('lei', 'resolucao', 'decreto')
+UNIDADES_ARTIGO = ('artigo',)
+# Títulos, capítulos e seções: a nota fica no lugar do texto revogado, que não está no chunk
+UNIDADES_TITULO = ('titulo', 'capitulo', 'sec', 'subsec', 'livro', 'parte')
+
+# Notas entre parênteses (a última pode continuar no chunk seguinte) e o rótulo da unidade no começo
+# do chunk ("Art. 5º", "b)", "III -", "§ 2º", "Parágrafo único."), no texto sem acentos e em minúsculas
+NOTE_PATTERN = re.compile(r'\([^)]*(?:\)|$)')
+UNIT_LABEL_PATTERN = re.compile(
+    r'^\s*(?:(?:art\.?|§)\s*\d+\s*(?:o|°|\ufffd)?|paragrafo\s+unico|(?:\d+|[a-z]{1,2}|[ivxlcdm]+)\s*[)\-–—])\s*[.:\-–—]?'
+)
+
+
+class ArticleIndex:
+    """
+    Chunks por documento e por (documento, artigo), e o documento de cada lei_cod.
+    """
+
+    def __init__(self):
+        self.documento_by_cod = {}
+        self.documento_of = {}
+        self.by_documento = {}
+        self.by_article = {}
+        # Se houver mais de um documento com o mesmo código (versões), vale o publicado mais recentemente
+        for documento_id, cod in Documento.objects.exclude(lei_cod='').order_by('-data_publicacao', 'id').values_list('id', 'lei_cod'):
+            self.documento_by_cod.setdefault(cod, documento_id)
+
+    def add(self, chunk_id, documento_id, numero_artigo):
+        self.documento_of[chunk_id] = documento_id
+        self.by_documento.setdefault(documento_id, []).append(chunk_id)
+        if numero_artigo is not None:
+            self.by_article.setdefault((documento_id, numero_artigo), []).append(chunk_id)
+
+    def chunks(self, documento_id, numero_artigo=None):
+        if numero_artigo is None:
+            return self.by_documento.get(documento_id, [])
+        return self.by_article.get((documento_id, numero_artigo), [])
+
+
+@dataclass
+class CitationGraph:
+    edges: list = field(default_factory=list)
+    # Chunk revogado -> chunk revogador (None se a norma revogadora não estiver no acervo)
+    revoked: dict = field(default_factory=dict)
+    chunks_read: int = 0
+
+    def count(self, tipo):
+        return sum(1 for edge in self.edges if edge.tipo == tipo)
+
+    @property
+    def resolved(self):
+        return sum(1 for edge in self.edges if edge.documento_citado_id is not None)
+
+
+def _read_chunks(index):
+    """
+    (chunk_id, documento_id, numero_artigo, fim do chunk anterior, texto, começo do seguinte),
+    registrando cada chunk no índice.
+    """
+    rows = (
+        Chunk.objects.order_by('documento_id', 'ordem_no_documento')
+        .values_list('id', 'documento_id', 'numero_artigo', 'conteudo_original')
+        .iterator(chunk_size=READ_BATCH_SIZE)
+    )
+    previous = current = None
+    for row in rows:
+        index.add(*row[:3])
+        if current is not None:
+            head = previous[3] if previous and previous[1] == current[1] else ''
+            tail = row[3][:TAIL_CHARS] if row[1] == current[1] else ''
+            yield (*current[:3], head, current[3], tail)
+        previous, current = current, row
+    if current is not None:
+        head = previous[3] if previous and previous[1] == current[1] else ''
+        yield (*current[:3], head, current[3], '')
+
+
+def _only_note(text):
+    # O chunk não tem texto além do rótulo da unidade e das notas
+    rest = UNIT_LABEL_PATTERN.sub('', NOTE_PATTERN.sub(' ', simplify_text(text)), count=1)
+    return re.search(r'\w', rest) is None
+
+
+def _revoked_by_note(reference, documento_id, numero_artigo, chunk_id, text, index):
+    # Chunks revogados segundo a nota do próprio chunk
+    unidade = reference.unidade
+    if unidade.startswith(UNIDADES_TITULO):
+        return []
+    if unidade.startswith(UNIDADES_NORMA):
+        return index.chunks(documento_id)
+    if unidade.startswith(UNIDADES_ARTIGO) and numero_artigo is not None:
+        return index.chunks(documento_id, numero_artigo)
+    return [chunk_id] if _only_note(text) else []
+
+
+def build_citation_graph():
+    """
+    Lê os chunks uma vez, extrai as citações e devolve o CitationGraph (arestas não gravadas e
+    chunks revogados). Não grava nada: quem chama decide como persistir.
+    """
+    index = ArticleIndex()
+    graph = CitationGraph()
+    notes = []
+    for chunk_id, documento_id, numero_artigo, head, text, tail in _read_chunks(index):
+        graph.chunks_read += 1
+        for reference in extract_references(text, head=head[-TAIL_CHARS:], tail=tail):
+            graph.edges.append(CitacaoNorma(
+                chunk_id=chunk_id, tipo=reference.tipo, lei_cod=reference.lei_cod,
+                numero_artigo=reference.artigo, documento_citado_id=index.documento_by_cod.get(reference.lei_cod),
+                trecho=reference.trecho,
+            ))
+            if reference.tipo == 'REVOGADO_POR':
+                notes.append((reference, documento_id, numero_artigo, chunk_id, text))
+
+    # Uma passada pelas arestas, com o índice completo: cada chunk fica com o primeiro revogador conhecido
+    for edge in graph.edges:
+        # Citação da própria norma ("revoga o art. 5º desta Lei nº ...") não é revogação de outra norma
+        if edge.tipo != 'REVOGA' or edge.documento_citado_id in (None, index.documento_of[edge.chunk_id]):
+            continue
+        for target in index.chunks(edge.documento_citado_id, edge.numero_artigo):
+            graph.revoked.setdefault(target, edge.chunk_id)
+    for reference, documento_id, numero_artigo, chunk_id, text in notes:
+        cited = index.documento_by_cod.get(reference.lei_cod)
+        revoker = index.chunks(cited, reference.artigo) if cited is not None else []
+        for target in _revoked_by_note(reference, documento_id, numero_artigo, chunk_id, text, index):
+            if graph.revoked.get(target) is None:
+                graph.revoked[target] = revoker[0] if revoker else None
+    return graph
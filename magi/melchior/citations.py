@@ -0,0 +1,220 @@
+# nerv/magi/melchior/citations.py
+
+"""
+Citações diretas de artigos ("o que diz o art. 12 da LE 1234/1998").
+
+Uma pergunta que só cita um artigo não precisa de embedding, busca vetorial nem LLM: o texto
+exato sai de uma consulta indexada por Documento.lei_cod e Chunk.numero_artigo. parse_citation()
+só reconhece a pergunta quando, fora a citação, ela não tem nada além de palavras de ligação
+("o que diz", "qual o texto do"...); perguntas sobre o conteúdo do artigo seguem pelo RAG.
+
+extract_references() acha as citações de normas no texto dos chunks ("art. 1º da Lei Municipal
+nº 091, de 02.06.1950", "Fica revogado o Decreto-Lei nº 137, de 23 de novembro de 1946") para o
+grafo de citações e revogações (melchior.citation_graph).
+"""
+
+import re
+import unicodedata
+from dataclasses import dataclass
+
+from melchior.models import Chunk
+
+# Tipos de norma citados na pergunta -> prefixo do lei_cod (os mesmos de HIERARCHY_MAP no import_documents)
+TIPOS_NORMA = {
+    'le': 'LE', 'lei': 'LE',
+    'dl': 'DL', 'decreto': 'DL', 'decreto-lei': 'DL', 'decreto lei': 'DL',
+    're': 'RE', 'resolucao': 'RE',
+}
+
+LEI_COD_PATTERN = re.compile(r'^([A-Z]+)(\d+)(\d{4})$')
+ARTICLE_NUMBER_PATTERN = re.compile(r'^Art\.\s*(\d+)', re.IGNORECASE)
+
+# Aplicado ao texto sem acentos e em minúsculas
+CITATION_PATTERN = re.compile(
+    r'\bart(?:igo)?\.?\s*(?P<artigo>\d+)\s*(?:o|°)?\s*,?\s*'
+    r'(?:d[ao]\s+)?(?P<tipo>decreto[- ]lei|decreto|resolucao|lei|le|dl|re)\.?\s*'
+    r'(?:n(?:o|°|umero)?\.?\s*)?(?P<numero>\d{1,3}(?:\.\d{3})*|\d+)\s*'
+    r'(?:/\s*|,?\s*de\s+(?:\d{1,2}\s+de\s+[a-z]+\s+de\s+)?)(?P<ano>\d{4})\b'
+)
+
+# Citação de norma no texto de um chunk (sem acentos e em minúsculas). O "º" dos textos com a
+# acentuação corrompida vira U+FFFD; o ano aparece como "1950", "1.950" ou no fim de uma data.
+_ORDINAL = r'(?:o|°|\ufffd)?'
+_NUMERO = r'(?:\d{1,3}(?:\.\d{3})+|\d+)'
+_DATA_ANO = r'(?:/\s*|,?\s*de\s+(?:\d{1,2}\s*[./-]\s*\d{1,2}\s*[./-]\s*|\d{1,2}' + _ORDINAL + r'\s+de\s+[^\s\d]+\s+de\s+)?)(?P<ano>\d\.?\d{3})\b'
+REFERENCE_PATTERN = re.compile(
+    r'(?:\barts?\.?\s*(?P<artigo>\d+)\s*' + _ORDINAL + r'\s*,?\s*(?:d[ao]\s+)?)?'
+    r'\b(?P<tipo>decreto[- ]lei|decreto|resolucao|lei)s?\s+(?:municipal\s+|municipais\s+)?'
+    r'(?:n(?:o|°|\ufffd|umero)?s?\s*\.?\s*)?(?P<numero>' + _NUMERO + r')\s*' + _DATA_ANO
+)
+# Mais números da mesma espécie logo depois de uma citação ("das Leis nºs 141, de 19-5-1.952 e 209, de 9-12-1.953")
+REFERENCE_LIST_PATTERN = re.compile(r'\s*(?:,|\be\b)\s*(?:n(?:o|°|\ufffd)?s?\s*\.?\s*)?(?P<numero>' + _NUMERO + r')\s*' + _DATA_ANO)
+# Texto logo antes da citação que a torna uma revogação
+REVOKED_BY_CONTEXT = re.compile(r'(?:\best[ea]\s+(?P<unidade>[^\s()]+)\s+foi\s+)?\brevogad[oa]s?\s+pel[oa]s?\s*$')
+REVOKES_CONTEXT = re.compile(
+    r'(?:\bfica(?:m)?\s+(?:\S+\s+){0,3}?revogad[oa]s?|\brevoga(?:m)?(?:-se)?'
+    r'|\brevog\S*\s+as\s+disposi\S*\s+em\s+contr\S*\s*,?\s*especialmente\s+(?:as|os)\s+(?:constantes\s+)?(?:d[aoe]s?|n[ao]s?))'
+    r'\s+(?:(?:o|a|os|as)\s+)?$'
+)
+CONTEXT_CHARS = 120
+
+# Palavras que podem acompanhar uma citação sem mudar o que se pede (o texto do artigo)
+FILLER_WORDS = frozenset("""
+o a os as que qual quais e diz dizem texto integra conteudo do da de mostre mostrar ver leia ler transcreva
+estabelece dispoe preve me por favor sobre
+""".split())
+
+
+@dataclass(frozen=True)
+class Citation:
+    tipo: str
+    numero: int
+    ano: int
+    artigo: int
+
+    @property
+    def lei_cod(self):
+        return lei_cod(self.tipo, self.numero, self.ano)
+
+    def __str__(self):
+        return f'Art. {self.artigo} da {self.tipo} {self.numero}/{self.ano}'
+
+
+@dataclass(frozen=True)
+class Reference:
+    """
+    Norma (ou artigo de norma, se artigo não for None) citada no texto de um chunk.
+
+    tipo: 'CITA', 'REVOGA' (o texto revoga a norma citada) ou 'REVOGADO_POR' (o texto diz que foi
+    revogado por ela); unidade: o que foi revogado ("artigo", "alinea"...), quando o texto diz.
+    """
+    norma: str
+    numero: int
+    ano: int
+    artigo: int = None
+    tipo: str = 'CITA'
+    unidade: str = ''
+    trecho: str = ''
+
+    @property
+    def lei_cod(self):
+        return lei_cod(self.norma, self.numero, self.ano)
+
+
+def lei_cod(tipo, numero, ano):
+    """
+    Código canônico da norma: prefixo + número com 5 dígitos + ano (ex.: 'LE012341998').
+    """
+    return f'{tipo}{int(numero):05d}{ano}'
+
+
+def normalize_lei_cod(value):
+    """
+    Normaliza o lei_cod do CSV para a forma canônica; códigos em outro formato só perdem espaços e caixa.
+    """
+    value = re.sub(r'\s+', '', value or '').upper()
+    match = LEI_COD_PATTERN.match(value)
+    if not match:
+        return value
+    return lei_cod(match.group(1), match.group(2), match.group(3))
+
+
+def article_number(caminho):
+    """
+    Número do artigo no caminho estrutural de um chunk ("Art. 5º, §2º, III" -> 5), ou None.
+    """
+    match = ARTICLE_NUMBER_PATTERN.match(caminho or '')
+    return int(match.group(1)) if match else None
+
+
+def simplify_text(text):
+    """
+    Texto em minúsculas (casefold) e sem acentos, para comparações que não dependem da grafia.
+    """
+    text = unicodedata.normalize('NFKD', text.casefold())
+    return ''.join(char for char in text if not unicodedata.combining(char))
+
+
+def _year(value):
+    return int(value.replace('.', ''))
+
+
+def extract_references(text, head='', tail=''):
+    """
+    Citações de normas em text. head e tail são o fim do chunk anterior e o começo do seguinte,
+    do mesmo documento: uma nota de revogação cortada entre dois chunks ("(Esta alínea foi
+    revogada pelo" | "art. 1º da Lei Municipal nº 091...") pertence ao chunk em que começa.
+    """
+    head = simplify_text(head)[-CONTEXT_CHARS:]
+    start = len(head) + 1
+    body = simplify_text(text)
+    end = start + len(body)
+    combined = f'{head} {body} {simplify_text(tail)}'
+    references = []
+    for match in REFERENCE_PATTERN.finditer(combined, start):
+        window = max(0, match.start() - CONTEXT_CHARS)
+        before = combined[window:match.start()]
+        tipo, unidade = 'CITA', ''
+        revoked_by = REVOKED_BY_CONTEXT.search(before)
+        if revoked_by:
+            tipo, unidade = 'REVOGADO_POR', revoked_by.group('unidade') or ''
+            if window + revoked_by.start() < start:
+                # A nota começou no chunk anterior
+                continue
+        elif REVOKES_CONTEXT.search(before):
+            tipo = 'REVOGA'
+        if match.start() >= end and (tipo != 'REVOGADO_POR' or window + revoked_by.start() >= end):
+            # No chunk seguinte, só a citação que completa uma nota começada neste
+            break
+        norma = TIPOS_NORMA[match.group('tipo')]
+        artigo = int(match.group('artigo')) if match.group('artigo') else None
+        found = [(match.group('numero'), match.group('ano'), match.group())]
+        position = match.end()
+        if artigo is None:
+            # Lista de normas da mesma espécie (só sem artigo: "arts. 1 e 2 da Lei" não é uma lista de leis)
+            while (extra := REFERENCE_LIST_PATTERN.match(combined, position)) is not None:
+                found.append((extra.group('numero'), extra.group('ano'), extra.group().strip(' ,')))
+                position = extra.end()
+        for numero, ano, trecho in found:
+            references.append(Reference(
+                norma=norma, numero=int(numero.replace('.', '')), ano=_year(ano), artigo=artigo,
+                tipo=tipo, unidade=unidade, trecho=trecho[:255],
+            ))
+        if match.start() >= end:
+            break
+    return references
+
+
+def parse_citation(query):
+    """
+    Devolve a Citation se a pergunta for só a citação de um artigo; caso contrário, None.
+    """
+    text = simplify_text(query)
+    match = CITATION_PATTERN.search(text)
+    if not match:
+        return None
+    remainder = text[:match.start()] + ' ' + text[match.end():]
+    if any(word not in FILLER_WORDS for word in re.findall(r'\w+', remainder)):
+        return None
+    return Citation(
+        tipo=TIPOS_NORMA[match.group('tipo')],
+        numero=int(match.group('numero').replace('.', '')),
+        ano=int(match.group('ano')),
+        artigo=int(match.group('artigo')),
+    )
+
+
+def lookup_article(citation):
+    """
+    Chunks do artigo citado, na ordem do documento, com o documento (e o chunk revogador) carregado. Se houver mais de
+    um documento com o mesmo código (versões), usa o publicado mais recentemente.
+    """
+    chunks = list(
+        Chunk.objects.filter(documento__lei_cod=citation.lei_cod, numero_artigo=citation.artigo)
+        .select_related('documento', 'revogado_por_chunk__documento')
+        .order_by('-documento__data_publicacao', 'documento_id', 'ordem_no_documento')
+    )
+    if not chunks:
+        return []
+    documento_id = chunks[0].documento_id
+    return [chunk for chunk in chunks if chunk.documento_id == documento_id]
@@ -0,0 +1,228 @@
+# nerv/magi/melchior/context.py
+
+"""
+Montagem do contexto ("Fontes") do prompt da busca do Melchior.
+
+Os chunks recuperados não entram inteiros e um a um no prompt:
+- chunks quase iguais a outro mais bem colocado (a mesma redação em duas leis, ou em duas
+  versões da mesma lei) são descartados;
+- chunks seguidos do mesmo documento (ordem_no_documento consecutiva) viram um único trecho;
+- trechos longos são cortados em volta da janela com mais termos da pergunta;
+- o total respeita um orçamento de tokens (MELCHIOR_CONTEXT_TOKENS), preenchido na ordem da busca.
+
+Os tokens são estimados (CHARS_PER_TOKEN caracteres por token), sem chamar a API. pack_context()
+devolve também o tamanho do contexto antes e depois da montagem, que a busca registra no log.
+"""
+
+import math
+import re
+from dataclasses import dataclass, field
+
+from django.conf import settings
+
+from melchior.citations import simplify_text
+from melchior.lexical import STOPWORDS
+
+CHARS_PER_TOKEN = 4
+DEFAULT_CONTEXT_TOKENS = 3000
+DEFAULT_PASSAGE_TOKENS = 800
+# Similaridade de Jaccard entre os trigramas de palavras a partir da qual um chunk é considerado repetido
+DUPLICATE_THRESHOLD = 0.8
+# Um trecho que só caberia no orçamento restante com menos tokens que isso fica de fora
+MIN_PASSAGE_TOKENS = 60
+ELLIPSIS = '[...]'
+
+QUERY_STOPWORDS = frozenset(simplify_text(word) for word in STOPWORDS)
+
+
+def estimate_tokens(text):
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def packing_version():
+    """
+    Identifica a configuração da montagem; entra na versão do prompt usada pelo AnswerCache.
+    """
+    return f'contexto-v1:{context_tokens()}:{passage_tokens()}:{DUPLICATE_THRESHOLD}'
+
+
+def context_tokens():
+    return getattr(settings, 'MELCHIOR_CONTEXT_TOKENS', DEFAULT_CONTEXT_TOKENS)
+
+
+def passage_tokens():
+    return getattr(settings, 'MELCHIOR_CONTEXT_PASSAGE_TOKENS', DEFAULT_PASSAGE_TOKENS)
+
+
+@dataclass
+class Passage:
+    """
+    Trecho do contexto: um ou mais chunks seguidos do mesmo documento.
+    """
+    documento: object
+    chunks: list
+    text: str
+    truncated: bool = False
+
+    @classmethod
+    def from_chunk(cls, chunk):
+        return cls(chunk.documento, [chunk], chunk.conteudo_tratado)
+
+    @property
+    def tokens(self):
+        return estimate_tokens(context_block(self))
+
+
+@dataclass
+class PackedContext:
+    passages: list = field(default_factory=list)
+    tokens_before: int = 0
+    tokens_after: int = 0
+    duplicates: int = 0
+    merged: int = 0
+    truncated: int = 0
+    omitted: int = 0
+
+    def summary(self):
+        saving = 1 - self.tokens_after / self.tokens_before if self.tokens_before else 0.0
+        return (
+            f'contexto: {self.tokens_before} -> {self.tokens_after} tokens estimados ({saving:.0%} a menos); '
+            f'{len(self.passages)} trecho(s), {self.duplicates} repetido(s), {self.merged} chunk(s) unido(s), '
+            f'{self.truncated} cortado(s), {self.omitted} fora do orçamento'
+        )
+
+
+def context_block(passage):
+    return (
+        f"Documento: {passage.documento.nome_arquivo}\n"
+        f"Artigo/Trecho: {passage.text}\n"
+        f"---"
+    )
+
+
+def query_terms(query):
+    return {word for word in re.findall(r'\w+', simplify_text(query)) if word not in QUERY_STOPWORDS}
+
+
+def _shingles(text):
+    words = re.findall(r'\w+', simplify_text(text))
+    if len(words) < 3:
+        return {tuple(words)}
+    return {tuple(words[i:i + 3]) for i in range(len(words) - 2)}
+
+
+def _similarity(a, b):
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+
+def best_span(text, terms, max_chars):
+    """
+    (início, fim) da janela de até max_chars caracteres, em limites de palavra, com mais
+    ocorrências dos termos, centrada nelas. Sem nenhum termo, a janela do início do texto.
+    """
+    if len(text) <= max_chars:
+        return 0, len(text)
+    words = list(re.finditer(r'\w+', text))
+    if not words:
+        return 0, max_chars
+    hits = [1 if simplify_text(word.group()) in terms else 0 for word in words]
+    best = (-1, 0, 0)
+    score = 0
+    end = 0
+    for start in range(len(words)):
+        if end < start:
+            end, score = start, 0
+        while end < len(words) and words[end].end() - words[start].start() <= max_chars:
+            score += hits[end]
+            end += 1
+        if end > start and score > best[0]:
+            best = (score, start, end)
+        if end > start:
+            score -= hits[start]
+    score, start, end = best
+    if end == start:
+        # Uma única "palavra" maior que a janela
+        return words[start].start(), words[start].start() + max_chars
+    if score > 0:
+        matched = [words[i] for i in range(start, end) if hits[i]]
+        center = (matched[0].start() + matched[-1].end()) / 2
+        low = max(0, min(len(text) - max_chars, int(center - max_chars / 2)))
+        inside = [word for word in words if word.start() >= low and word.end() <= low + max_chars]
+        return inside[0].start(), inside[-1].end()
+    return words[start].start(), words[end - 1].end()
+
+
+def truncate_passage(passage, terms, max_tokens):
+    """
+    Corta o texto do trecho em volta da melhor janela para que o bloco caiba em max_tokens.
+    """
+    overhead = estimate_tokens(context_block(Passage(passage.documento, [], ''))) + 1
+    max_chars = max(0, (max_tokens - overhead) * CHARS_PER_TOKEN - 2 * (len(ELLIPSIS) + 1))
+    start, end = best_span(passage.text, terms, max_chars)
+    text = passage.text[start:end].strip()
+    if start > 0:
+        text = f'{ELLIPSIS} {text}'
+    if end < len(passage.text):
+        text = f'{text} {ELLIPSIS}'
+    return Passage(passage.documento, passage.chunks, text, truncated=True)
+
+
+def _merge_adjacent(chunks):
+    # Agrupa por documento os chunks de ordem consecutiva; cada trecho fica na posição do seu melhor chunk
+    runs = {}
+    by_documento = {}
+    for rank, chunk in enumerate(chunks):
+        by_documento.setdefault(chunk.documento_id, []).append((rank, chunk))
+    for entries in by_documento.values():
+        entries.sort(key=lambda entry: entry[1].ordem_no_documento)
+        run = [entries[0]]
+        for entry in entries[1:]:
+            if entry[1].ordem_no_documento == run[-1][1].ordem_no_documento + 1:
+                run.append(entry)
+            else:
+                runs[min(rank for rank, _chunk in run)] = run
+                run = [entry]
+        runs[min(rank for rank, _chunk in run)] = run
+    passages = []
+    for _rank, run in sorted(runs.items()):
+        run_chunks = [chunk for _rank, chunk in run]
+        text = '\n'.join(chunk.conteudo_tratado for chunk in run_chunks)
+        passages.append(Passage(run_chunks[0].documento, run_chunks, text))
+    return passages
+
+
+def pack_context(query, chunks, budget=None, max_passage_tokens=None):
+    """
+    Monta os trechos do contexto a partir dos chunks na ordem da busca. Devolve um PackedContext.
+    """
+    budget = budget or context_tokens()
+    max_passage_tokens = max_passage_tokens or passage_tokens()
+    packed = PackedContext(tokens_before=sum(Passage.from_chunk(chunk).tokens for chunk in chunks))
+
+    unique = []
+    seen = []
+    for chunk in chunks:
+        shingles = _shingles(chunk.conteudo_tratado)
+        if any(_similarity(shingles, other) >= DUPLICATE_THRESHOLD for other in seen):
+            packed.duplicates += 1
+            continue
+        seen.append(shingles)
+        unique.append(chunk)
+
+    passages = _merge_adjacent(unique)
+    packed.merged = len(unique) - len(passages)
+
+    terms = query_terms(query)
+    remaining = budget
+    for passage in passages:
+        limit = min(max_passage_tokens, remaining)
+        if passage.tokens > limit:
+            if limit < MIN_PASSAGE_TOKENS:
+                packed.omitted += 1
+                continue
+            passage = truncate_passage(passage, terms, limit)
+            packed.truncated += 1
+        packed.passages.append(passage)
+        remaining -= passage.tokens
+    packed.tokens_after = sum(passage.tokens for passage in packed.passages)
+    return packed
@@ -0,0 +1,252 @@
+# nerv/magi/melchior/embedding_cache.py
+
+"""
+Cache local de embeddings, endereçado pelo conteúdo.
+
+A chave é (modelo, tipo de tarefa, SHA-256 do texto normalizado), de forma que textos repetidos
+(cláusulas padrão, artigos idênticos em versões consolidadas, re-importações da mesma lei) são
+embedados uma única vez, em qualquer execução. Os vetores ficam em um arquivo SQLite próprio,
+fora do banco do Django, e os menos usados recentemente são descartados quando o arquivo passa
+do tamanho máximo.
+
+O QueryEmbeddingCache é a camada da busca: guarda os embeddings das perguntas no framework de
+cache do Django (LRU + TTL), para que perguntas repetidas não esperem nem pelo arquivo SQLite.
+"""
+
+import hashlib
+import sqlite3
+import threading
+import time
+from array import array
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import caches
+
+from melchior.extractors import normalize_extracted_text
+
+DEFAULT_MAX_MB = 512
+# Acertos cujo usado_em é atualizado de uma vez, em uma única transação
+TOUCH_BATCH_SIZE = 256
+
+
+def vector_to_bytes(vector):
+    """
+    Serializa um vetor como float32 (o mesmo formato gravado em Chunk.embedding).
+    """
+    return array('f', vector).tobytes()
+
+
+def bytes_to_vector(data):
+    vector = array('f')
+    vector.frombytes(data)
+    return vector.tolist()
+
+
+def text_key(model, task_type, text):
+    normalized = normalize_extracted_text(text)
+    digest = hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+    return f'{model}\0{task_type.lower()}\0{digest}'
+
+
+class EmbeddingCache:
+    """
+    Cache em disco (SQLite) com descarte LRU por tamanho. Pode ser compartilhado entre threads.
+
+    Um acerto não grava nada na hora: o novo usado_em fica pendente na memória e é gravado em lote
+    (quando há touch_batch_size chaves pendentes, antes de um descarte e no close()), para que as leituras da
+    busca não disputem o lock de escrita do arquivo com o generate_embeddings. Se o arquivo estiver
+    travado, a leitura conta como falta, a gravação é pulada (o vetor só não fica em cache) e os
+    usado_em pendentes são descartados: o LRU fica só aproximado.
+    """
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_MB * 1024 * 1024, touch_batch_size=TOUCH_BATCH_SIZE):
+        self.path = str(path)
+        self.max_bytes = max_bytes
+        self.touch_batch_size = touch_batch_size
+        self.stats = Counter()
+        self._lock = threading.Lock()
+        self._pending_touches = {}
+        self._connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS embeddings ('
+            ' chave TEXT PRIMARY KEY, vetor BLOB NOT NULL, tamanho INTEGER NOT NULL, usado_em REAL NOT NULL)'
+        )
+        self._connection.execute('CREATE INDEX IF NOT EXISTS embeddings_usado_em ON embeddings (usado_em)')
+        self._total_bytes = self._connection.execute('SELECT COALESCE(SUM(tamanho), 0) FROM embeddings').fetchone()[0]
+
+    def get(self, model, task_type, text):
+        """
+        Devolve o vetor em cache para o texto, ou None.
+        """
+        key = text_key(model, task_type, text)
+        with self._lock:
+            try:
+                row = self._connection.execute('SELECT vetor FROM embeddings WHERE chave = ?', (key,)).fetchone()
+            except sqlite3.OperationalError:
+                self.stats['travados'] += 1
+                row = None
+            if row is None:
+                self.stats['misses'] += 1
+                return None
+            self._pending_touches[key] = time.time()
+            if len(self._pending_touches) >= self.touch_batch_size:
+                self._flush_touches()
+            self.stats['hits'] += 1
+        return bytes_to_vector(row[0])
+
+    def _flush_touches(self):
+        # Quem chama segura self._lock
+        touches = [(used_at, key) for key, used_at in self._pending_touches.items()]
+        self._pending_touches.clear()
+        if not touches:
+            return
+        try:
+            self._connection.execute('BEGIN')
+            self._connection.executemany('UPDATE embeddings SET usado_em = ? WHERE chave = ?', touches)
+            self._connection.execute('COMMIT')
+        except sqlite3.OperationalError:
+            self._rollback()
+
+    def put_many(self, model, task_type, texts, vectors):
+        rows = []
+        now = time.time()
+        for text, vector in zip(texts, vectors):
+            data = vector_to_bytes(vector)
+            rows.append((text_key(model, task_type, text), data, len(data), now))
+        with self._lock:
+            added = 0
+            try:
+                self._connection.execute('BEGIN')
+                for key, data, size, used_at in rows:
+                    previous = self._connection.execute('SELECT tamanho FROM embeddings WHERE chave = ?', (key,)).fetchone()
+                    self._connection.execute('INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)', (key, data, size, used_at))
+                    added += size - (previous[0] if previous else 0)
+                self._connection.execute('COMMIT')
+            except sqlite3.OperationalError:
+                self._rollback()
+                return
+            self._total_bytes += added
+            self.stats['gravados'] += len(rows)
+            if self._total_bytes > self.max_bytes:
+                self._flush_touches()
+                self._evict()
+
+    def _rollback(self):
+        # Quem chama segura self._lock. Sem o ROLLBACK, a transação aberta faria falhar todo BEGIN seguinte
+        if self._connection.in_transaction:
+            self._connection.execute('ROLLBACK')
+        self.stats['travados'] += 1
+
+    def put(self, model, task_type, text, vector):
+        self.put_many(model, task_type, [text], [vector])
+
+    def _evict(self):
+        # Descarta os menos usados até ficar em 90% do limite, para não descartar a cada gravação
+        target = self.max_bytes * 0.9
+        total = self._total_bytes
+        evicted = []
+        try:
+            self._connection.execute('BEGIN')
+            cursor = self._connection.execute('SELECT chave, tamanho FROM embeddings ORDER BY usado_em')
+            for key, size in cursor:
+                if total <= target:
+                    break
+                evicted.append((key,))
+                total -= size
+            cursor.close()
+            self._connection.executemany('DELETE FROM embeddings WHERE chave = ?', evicted)
+            self._connection.execute('COMMIT')
+        except sqlite3.OperationalError:
+            self._rollback()
+            return
+        self._total_bytes = total
+        self.stats['descartados'] += len(evicted)
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM embeddings').fetchone()[0]
+
+    @property
+    def size_bytes(self):
+        return self._total_bytes
+
+    def hit_rate(self):
+        lookups = self.stats['hits'] + self.stats['misses']
+        return self.stats['hits'] / lookups if lookups else 0.0
+
+    def close(self):
+        with self._lock:
+            self._flush_touches()
+            self._connection.close()
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_embedding_cache():
+    """
+    Cache compartilhado do processo, configurado por MELCHIOR_EMBEDDING_CACHE_PATH e MELCHIOR_EMBEDDING_CACHE_MAX_MB.
+    """
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            path = getattr(settings, 'MELCHIOR_EMBEDDING_CACHE_PATH', settings.BASE_DIR / 'embedding_cache.sqlite3')
+            max_mb = getattr(settings, 'MELCHIOR_EMBEDDING_CACHE_MAX_MB', DEFAULT_MAX_MB)
+            _default_cache = EmbeddingCache(path, max_bytes=max_mb * 1024 * 1024)
+        return _default_cache
+
+
+def normalize_query(query):
+    """
+    Normaliza a pergunta para a chave do cache: NFKC, espaços colapsados e sem diferença de maiúsculas.
+    """
+    return normalize_extracted_text(query).casefold()
+
+
+class QueryEmbeddingCache:
+    """
+    Cache dos embeddings de perguntas sobre o framework de cache do Django.
+
+    Usa o alias MELCHIOR_QUERY_CACHE_ALIAS; o tamanho (MAX_ENTRIES) e o TTL (TIMEOUT) vêm da
+    configuração desse alias em CACHES. Os contadores de acerto e falta ficam na memória do
+    processo, fora do cache: no cache seriam descartados junto com as entradas (MAX_ENTRIES) e
+    custariam duas operações a mais por consulta.
+    """
+
+    def __init__(self, alias=None):
+        self.alias = alias or getattr(settings, 'MELCHIOR_QUERY_CACHE_ALIAS', 'default')
+        self._counts = Counter()
+        self._counts_lock = threading.Lock()
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def key(self, model, query):
+        digest = hashlib.sha256(normalize_query(query).encode('utf-8')).hexdigest()
+        return f'melchior:consulta:{model}:{digest}'
+
+    def get(self, model, query):
+        data = self.cache.get(self.key(model, query))
+        with self._counts_lock:
+            self._counts['acertos' if data is not None else 'faltas'] += 1
+        return bytes_to_vector(data) if data is not None else None
+
+    def set(self, model, query, vector):
+        self.cache.set(self.key(model, query), vector_to_bytes(vector))
+
+    def stats(self):
+        """
+        Acertos e faltas deste processo desde a criação do cache (ou do último reset_stats()).
+        """
+        with self._counts_lock:
+            hits, misses = self._counts['acertos'], self._counts['faltas']
+        lookups = hits + misses
+        return {'acertos': hits, 'faltas': misses, 'taxa_acerto': hits / lookups if lookups else 0.0}
+
+    def reset_stats(self):
+        with self._counts_lock:
+            self._counts.clear()
@@ -0,0 +1,375 @@
+# nerv/magi/melchior/embeddings.py
+
+"""
+Geração de embeddings para os chunks do Melchior.
+
+Os provedores encapsulam a chamada ao modelo (Gemini, ou um provedor falso e determinístico
+para testes e benchmarks offline). O EmbeddingPipeline mantém várias requisições em andamento
+sob um limite de taxa (token bucket), ajusta o tamanho dos lotes pela latência observada, faz
+backoff exponencial com jitter e, quando um lote é recusado pelo conteúdo ou pelo tamanho,
+divide-o ao meio até isolar os itens problemáticos em vez de descartar o lote inteiro. Lotes que
+esgotam as repetições de erros passageiros não são divididos: falham inteiros. Com um EmbeddingCache,
+textos já embedados com o mesmo modelo não geram requisição.
+"""
+
+import asyncio
+import hashlib
+import random
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+
+from melchior.services import get_genai, run_blocking
+
+EMBEDDING_MODEL = 'embedding-001'
+DOCUMENT_TASK_TYPE = 'retrieval_document'
+QUERY_TASK_TYPE = 'retrieval_query'
+
+# Trechos de mensagens de erro da API que indicam falha passageira (vale a pena tentar de novo)
+TRANSIENT_ERROR_MARKERS = ('504', 'deadline exceeded', 'timeout', 'timed out', '429', 'resource has been exhausted',
+                           'rate limit', '503', 'unavailable', '500 internal')
+# Trechos de mensagens de erro da API que indicam lote recusado pelo conteúdo ou pelo tamanho da requisição
+BATCH_ERROR_MARKERS = ('400', 'invalid argument', '413', 'payload', 'too large', 'request size', 'exceeds')
+
+
+class EmbeddingError(Exception):
+    """
+    Falha definitiva ao gerar embeddings (ex.: entrada inválida). Não adianta tentar de novo.
+    """
+
+
+class TransientEmbeddingError(EmbeddingError):
+    """
+    Falha passageira (timeout, limite de taxa, indisponibilidade). A requisição pode ser repetida.
+    """
+
+
+def is_transient_error(exc):
+    if isinstance(exc, TransientEmbeddingError):
+        return True
+    if isinstance(exc, EmbeddingError):
+        return False
+    message = str(exc).lower()
+    return any(marker in message for marker in TRANSIENT_ERROR_MARKERS)
+
+
+def is_batch_error(exc):
+    """
+    Falha definitiva causada por algum item ou pelo tamanho do lote: dividir o lote resolve ou isola o item.
+    """
+    if is_transient_error(exc):
+        return False
+    if isinstance(exc, EmbeddingError):
+        return True
+    message = str(exc).lower()
+    return any(marker in message for marker in BATCH_ERROR_MARKERS)
+
+
+class BaseEmbeddingProvider:
+    """
+    Interface dos provedores: recebe uma lista de textos e devolve um vetor para cada um, na mesma ordem.
+
+    model_id identifica o modelo e é gravado em Chunk.modelo_embedding, de forma que trocar de
+    provedor ou de modelo faz o modo incremental re-embedar os chunks.
+    """
+    name = None
+    model_id = None
+    task_type = DOCUMENT_TASK_TYPE
+
+    def embed(self, texts):
+        raise NotImplementedError
+
+    async def aembed(self, texts):
+        """
+        Versão assíncrona de embed(); por padrão, roda embed() no pool de threads das views assíncronas.
+        """
+        return await run_blocking(self.embed, texts)
+
+
+class GeminiEmbeddingProvider(BaseEmbeddingProvider):
+    """
+    Embeddings do Google AI Studio. O cliente é configurado com a GOOGLE_API_KEY na primeira chamada.
+    """
+    name = 'gemini'
+
+    def __init__(self, model=EMBEDDING_MODEL, task_type=DOCUMENT_TASK_TYPE):
+        self.model_id = model
+        self.task_type = task_type
+
+    def embed(self, texts):
+        response = get_genai().embed_content(model=f'models/{self.model_id}', content=list(texts), task_type=self.task_type)
+        return response['embedding']
+
+    async def aembed(self, texts):
+        response = await get_genai().embed_content_async(model=f'models/{self.model_id}', content=list(texts), task_type=self.task_type)
+        return response['embedding']
+
+
+class FakeEmbeddingProvider(BaseEmbeddingProvider):
+    """
+    Provedor local e determinístico para testar a vazão do pipeline sem rede nem custo.
+
+    Cada texto vira sempre o mesmo vetor unitário. latency e latency_per_item simulam o tempo
+    de resposta; failure_rate é a probabilidade de uma requisição falhar com erro passageiro;
+    textos que contêm algum trecho de poison falham sempre, com erro definitivo.
+    """
+    name = 'fake'
+
+    def __init__(self, dimension=768, latency=0.0, latency_per_item=0.0, failure_rate=0.0, poison=(), seed=None,
+                 task_type=DOCUMENT_TASK_TYPE):
+        self.dimension = dimension
+        self.model_id = f'fake-{dimension}'
+        self.task_type = task_type
+        self.latency = latency
+        self.latency_per_item = latency_per_item
+        self.failure_rate = failure_rate
+        self.poison = tuple(poison)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def embed(self, texts):
+        texts = list(texts)
+        time.sleep(self.latency + self.latency_per_item * len(texts))
+        return self._vectors(texts)
+
+    async def aembed(self, texts):
+        texts = list(texts)
+        await asyncio.sleep(self.latency + self.latency_per_item * len(texts))
+        return self._vectors(texts)
+
+    def _vectors(self, texts):
+        with self._lock:
+            failed = self._random.random() < self.failure_rate
+        if failed:
+            raise TransientEmbeddingError('504 Deadline Exceeded (simulado)')
+        for text in texts:
+            if any(marker in text for marker in self.poison):
+                raise EmbeddingError('400 Invalid argument (simulado)')
+        return [self.vector(text) for text in texts]
+
+    def vector(self, text):
+        rng = random.Random(hashlib.sha256(text.encode('utf-8')).digest())
+        values = [rng.gauss(0.0, 1.0) for _ in range(self.dimension)]
+        norm = sum(value * value for value in values) ** 0.5 or 1.0
+        return [value / norm for value in values]
+
+
+PROVIDERS = {
+    GeminiEmbeddingProvider.name: GeminiEmbeddingProvider,
+    FakeEmbeddingProvider.name: FakeEmbeddingProvider,
+}
+
+
+def get_provider(name, **kwargs):
+    """
+    Instancia o provedor de embeddings registrado com o nome informado.
+    """
+    try:
+        provider_class = PROVIDERS[name]
+    except KeyError:
+        raise ValueError(f"Provedor de embeddings desconhecido: '{name}'. Opções: {', '.join(PROVIDERS)}.")
+    return provider_class(**kwargs)
+
+
+class TokenBucket:
+    """
+    Limitador de taxa compartilhado entre threads: no máximo 'rate' requisições por segundo,
+    com rajadas de até 'capacity'. Com rate None não há limite.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate or 1.0)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        if not self.rate:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait_time = (tokens - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+
+class AdaptiveBatchSizer:
+    """
+    Ajusta o tamanho dos lotes (AIMD): cresce aos poucos enquanto as respostas chegam dentro de
+    target_latency segundos e cai pela metade em caso de erro ou lentidão.
+    """
+
+    def __init__(self, initial=50, minimum=1, maximum=100, target_latency=5.0):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.size = max(minimum, min(maximum, initial))
+        self.target_latency = target_latency
+
+    def record_success(self, latency):
+        if latency > self.target_latency:
+            self._shrink()
+        else:
+            self.size = min(self.maximum, self.size + max(1, self.size // 10))
+
+    def record_failure(self):
+        self._shrink()
+
+    def _shrink(self):
+        self.size = max(self.minimum, self.size // 2)
+
+
+def backoff_delay(attempt, base=1.0, cap=60.0):
+    """
+    Backoff exponencial com jitter total: espera aleatória entre 0 e min(cap, base * 2^attempt).
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+@dataclass
+class _Batch:
+    keys: list
+    texts: list
+    attempt: int = 0
+
+
+@dataclass
+class BatchResult:
+    """
+    Resultado de um lote: vectors vem preenchido em caso de sucesso; error, em caso de falha definitiva.
+    cached indica que os vetores vieram do cache, sem requisição ao provedor.
+    """
+    keys: list
+    vectors: list = None
+    error: Exception = None
+    latency: float = 0.0
+    cached: bool = False
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+@dataclass
+class EmbeddingPipeline:
+    """
+    Gera embeddings para (chave, texto) com várias requisições simultâneas.
+
+    run() devolve BatchResults à medida que as respostas chegam (não necessariamente na ordem de
+    entrada). Cada item aparece em exatamente um resultado: com vetor ou com o erro definitivo.
+    Erros passageiros são repetidos até max_retries vezes; esgotadas as repetições, o lote inteiro
+    falha (dividi-lo só multiplicaria as requisições contra um serviço indisponível). Em erro de
+    conteúdo ou de tamanho (is_batch_error), o lote é dividido ao meio e cada metade recomeça, até
+    que só o item problemático falhe. Outros erros definitivos fazem o lote inteiro falhar.
+    As estatísticas da execução ficam em self.stats.
+    """
+    provider: BaseEmbeddingProvider
+    workers: int = 4
+    rate_limiter: TokenBucket = None
+    sizer: AdaptiveBatchSizer = None
+    max_retries: int = 5
+    backoff_base: float = 1.0
+    backoff_cap: float = 60.0
+    cache: object = None
+    stats: Counter = field(default_factory=Counter)
+
+    def __post_init__(self):
+        self.rate_limiter = self.rate_limiter or TokenBucket(None)
+        self.sizer = self.sizer or AdaptiveBatchSizer()
+
+    def _call(self, batch):
+        # Roda nas threads do pool: a espera do backoff não bloqueia o laço principal
+        if batch.attempt:
+            time.sleep(backoff_delay(batch.attempt - 1, self.backoff_base, self.backoff_cap))
+        self.rate_limiter.acquire()
+        start = time.perf_counter()
+        vectors = self.provider.embed(batch.texts)
+        if len(vectors) != len(batch.texts):
+            raise EmbeddingError(f'O provedor devolveu {len(vectors)} vetores para {len(batch.texts)} textos.')
+        return vectors, time.perf_counter() - start
+
+    def run(self, items):
+        items = iter(items)
+        queued = deque()  # lotes a repetir ou metades de lotes divididos; têm prioridade sobre itens novos
+        in_flight = {}
+        hits = []
+        exhausted = False
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while True:
+                while len(in_flight) < self.workers and (queued or not exhausted):
+                    if queued:
+                        batch = queued.popleft()
+                    else:
+                        batch, exhausted = self._next_batch(items, hits)
+                        if hits:
+                            yield BatchResult([key for key, _vector in hits], [vector for _key, vector in hits], cached=True)
+                            hits = []
+                        if batch is None:
+                            continue
+                    self.stats['requisicoes'] += 1
+                    in_flight[executor.submit(self._call, batch)] = batch
+                if not in_flight:
+                    return
+
+                done, _pending = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    batch = in_flight.pop(future)
+                    try:
+                        vectors, latency = future.result()
+                    except Exception as e:
+                        result = self._handle_failure(batch, e, queued)
+                        if result is not None:
+                            yield result
+                        continue
+                    self.sizer.record_success(latency)
+                    self.stats['itens'] += len(batch.keys)
+                    if self.cache is not None:
+                        self.cache.put_many(self.provider.model_id, self.provider.task_type, batch.texts, vectors)
+                    yield BatchResult(batch.keys, vectors, latency=latency)
+
+    def _next_batch(self, items, hits):
+        # Consome itens até completar um lote de textos fora do cache. Os encontrados no cache
+        # vão para hits, limitados a um lote máximo para não acumular memória.
+        # Devolve (lote ou None, entrada esgotada).
+        keys, texts = [], []
+        for key, text in items:
+            vector = self._cached_vector(text)
+            if vector is not None:
+                hits.append((key, vector))
+                if len(hits) >= self.sizer.maximum:
+                    break
+                continue
+            keys.append(key)
+            texts.append(text)
+            if len(keys) >= self.sizer.size:
+                break
+        else:
+            return (_Batch(keys, texts) if keys else None), True
+        return (_Batch(keys, texts) if keys else None), False
+
+    def _cached_vector(self, text):
+        if self.cache is None:
+            return None
+        return self.cache.get(self.provider.model_id, self.provider.task_type, text)
+
+    def _handle_failure(self, batch, error, queued):
+        self.sizer.record_failure()
+        if is_transient_error(error) and batch.attempt + 1 < self.max_retries:
+            self.stats['repeticoes'] += 1
+            queued.append(_Batch(batch.keys, batch.texts, batch.attempt + 1))
+            return None
+        if is_batch_error(error) and len(batch.keys) > 1:
+            self.stats['divisoes'] += 1
+            middle = len(batch.keys) // 2
+            queued.append(_Batch(batch.keys[:middle], batch.texts[:middle]))
+            queued.append(_Batch(batch.keys[middle:], batch.texts[middle:]))
+            return None
+        self.stats['falhas'] += 1
+        return BatchResult(batch.keys, error=error)
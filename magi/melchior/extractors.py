@@ -0,0 +1,146 @@
+# nerv/magi/melchior/extractors.py
+
+"""
+Extratores de texto para os documentos HTML importados pelo Melchior.
+
+O BeautifulSoupExtractor é a implementação de referência (a mesma que o import_documents
+sempre usou). O StreamingHTMLExtractor consome os eventos do html.parser da biblioteca padrão
+sem montar a árvore do documento e produz exatamente o mesmo texto, em uma fração do tempo.
+"""
+
+import html
+import re
+import unicodedata
+from html.entities import html5
+from html.parser import HTMLParser
+
+from bs4 import BeautifulSoup
+
+# Tags cujo conteúdo nunca entra no texto extraído
+IGNORED_TAGS = ('script', 'style')
+
+_WHITESPACE_RE = re.compile(r'\s+')
+
+
+def normalize_extracted_text(text):
+    """
+    Colapsa espaços em branco e normaliza em NFKC. Etapa final comum a todos os extratores.
+    """
+    text = _WHITESPACE_RE.sub(' ', text).strip()
+    return unicodedata.normalize('NFKC', text)
+
+
+class BaseExtractor:
+    """
+    Interface dos extratores: recebe o HTML já decodificado e devolve o texto normalizado.
+    """
+    name = None
+
+    def extract(self, html_content):
+        raise NotImplementedError
+
+
+class BeautifulSoupExtractor(BaseExtractor):
+    """
+    Implementação de referência: monta a árvore com o html.parser do BeautifulSoup e remove <script>/<style>.
+    """
+    name = 'bs4'
+
+    def extract(self, html_content):
+        soup = BeautifulSoup(html_content, 'html.parser')
+        for script in soup(IGNORED_TAGS):
+            script.extract()
+        return normalize_extracted_text(soup.get_text())
+
+
+# Entidades nomeadas indexadas sem o ';' final, como o BeautifulSoup faz ao resolver '&nome;'
+_NAMED_ENTITIES = {}
+for _name, _character in html5.items():
+    _NAMED_ENTITIES.setdefault(_name.rstrip(';'), _character)
+
+_DECIMAL_REFERENCE_RE = re.compile(r'^([0-9]+)(.*)')
+_HEX_REFERENCE_RE = re.compile(r'^([0-9a-f]+)(.*)')
+
+
+class _TextCollector(HTMLParser):
+    # Coleta os trechos de texto na ordem do documento, ignorando o conteúdo de <script>/<style>.
+    # Comentários, doctype e instruções de processamento não entram no texto (como no get_text()).
+
+    def __init__(self):
+        # As referências são resolvidas em handle_charref/handle_entityref, como no BeautifulSoup
+        super().__init__(convert_charrefs=False)
+        self.parts = []
+        self.ignored_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in IGNORED_TAGS:
+            self.ignored_depth += 1
+
+    def handle_startendtag(self, tag, attrs):
+        # '<script/>' não abre conteúdo, então não altera a profundidade
+        pass
+
+    def handle_endtag(self, tag):
+        if tag in IGNORED_TAGS and self.ignored_depth:
+            self.ignored_depth -= 1
+
+    def handle_data(self, data):
+        if not self.ignored_depth:
+            self.parts.append(data)
+
+    def handle_entityref(self, name):
+        if not self.ignored_depth:
+            self.parts.append(_NAMED_ENTITIES.get(name, '&' + name))
+
+    def handle_charref(self, name):
+        if self.ignored_depth:
+            return
+        base, reference_re = 10, _DECIMAL_REFERENCE_RE
+        if name.startswith(('x', 'X')):
+            name = name[1:]
+            base, reference_re = 16, _HEX_REFERENCE_RE
+        extra_data = ''
+        try:
+            codepoint = int(name, base)
+        except ValueError:
+            # Referência sem ';' seguida de texto: só o prefixo numérico é a referência
+            match = reference_re.search(name)
+            if match is None:
+                self.parts.append(name)
+                return
+            codepoint = int(match.group(1), base)
+            extra_data = match.group(2)
+        self.parts.append(html.unescape(f'&#{codepoint};') if codepoint < 0x110000 else '�')
+        self.parts.append(extra_data)
+
+
+class StreamingHTMLExtractor(BaseExtractor):
+    """
+    Extrator baseado em eventos: percorre o HTML uma única vez sem construir a árvore.
+    """
+    name = 'stream'
+
+    def extract(self, html_content):
+        collector = _TextCollector()
+        collector.feed(html_content)
+        collector.close()
+        return normalize_extracted_text(''.join(collector.parts))
+
+
+EXTRACTORS = {
+    BeautifulSoupExtractor.name: BeautifulSoupExtractor,
+    StreamingHTMLExtractor.name: StreamingHTMLExtractor,
+}
+
+REFERENCE_EXTRACTOR = BeautifulSoupExtractor.name
+DEFAULT_EXTRACTOR = StreamingHTMLExtractor.name
+
+
+def get_extractor(name=DEFAULT_EXTRACTOR):
+    """
+    Instancia o extrator registrado com o nome informado.
+    """
+    try:
+        return EXTRACTORS[name]()
+    except KeyError:
+        raise ValueError(f"Extrator desconhecido: '{name}'. Opções: {', '.join(EXTRACTORS)}.")
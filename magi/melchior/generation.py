@@ -0,0 +1,167 @@
+# nerv/magi/melchior/generation.py
+
+"""
+Geração da resposta da busca do Melchior a partir dos chunks recuperados.
+
+Os modelos de resposta seguem a ideia dos provedores de embedding: GeminiAnswerModel chama o
+Google AI Studio; FakeAnswerModel é local e determinístico, com latência configurável, para
+testes e medições sem rede. stream() devolve o texto aos pedaços, à medida que o modelo gera,
+para a busca com streaming (SSE), e astream() faz o mesmo como gerador assíncrono, para servir o
+stream sob ASGI sem bloquear o event loop; generate() devolve a resposta inteira. O modelo usado pela
+busca é escolhido pelo setting MELCHIOR_ANSWER_BACKEND.
+"""
+
+import asyncio
+import time
+
+from django.conf import settings
+
+from melchior.answer_cache import prompt_version
+from melchior.context import context_block, packing_version
+from melchior.services import get_genai, run_blocking
+
+ANSWER_MODEL = 'gemini-1.5-flash'
+ANSWER_PROMPT_TEMPLATE = (
+    "Você é um assistente especializado em legislação do Brasil. "
+    "Sua tarefa é responder à 'Pergunta' de forma **direta e concisa**, "
+    "utilizando **APENAS** as 'Fontes' fornecidas. "
+    "Não invente informações. Se a resposta não estiver explicitamente nas fontes, "
+    "diga 'Não consigo responder com as informações fornecidas.' "
+    "Sua resposta deve ser um parágrafo claro e curto, sem iniciar com 'Com base nas fontes...' ou similar. "
+    "Após sua resposta direta, **obrigatóriamente** inclua uma seção 'Fontes Relevantes:' "
+    "listando cada fonte utilizada com a anotação: "
+    "'Fonte: Documento: [Nome do Documento], Artigo/Trecho: [Primeiras ~50 palavras do trecho relevante]'. "
+    "Priorize informações de leis mais recentes e de hierarquia superior se houver informações conflitantes nas fontes.\n\n"
+    "Fontes:\n{context_str}\n\n"
+    "Pergunta: {query}"
+)
+
+
+def build_prompt(query, passages):
+    """
+    Prompt com os trechos montados por melchior.context.pack_context().
+    """
+    context_str = "\n".join(context_block(passage) for passage in passages)
+    return ANSWER_PROMPT_TEMPLATE.format(context_str=context_str, query=query)
+
+
+class BaseAnswerModel:
+    """
+    Interface dos modelos de resposta. prompt_version identifica o template, a configuração da montagem
+    do contexto e o modelo nas chaves do AnswerCache.
+    """
+    name = None
+    model_id = None
+
+    @property
+    def prompt_version(self):
+        return prompt_version(f'{ANSWER_PROMPT_TEMPLATE}\0{packing_version()}', self.model_id)
+
+    def stream(self, prompt):
+        raise NotImplementedError
+
+    def generate(self, prompt):
+        return ''.join(self.stream(prompt)).strip()
+
+    async def astream(self, prompt):
+        """
+        Versão assíncrona de stream(); por padrão, cada pedaço de stream() é lido no pool de threads das views assíncronas.
+        """
+        pieces = iter(self.stream(prompt))
+        done = object()
+        while True:
+            piece = await run_blocking(next, pieces, done)
+            if piece is done:
+                return
+            yield piece
+
+    async def agenerate(self, prompt):
+        """
+        Versão assíncrona de generate(); por padrão, roda generate() no pool de threads das views assíncronas.
+        """
+        return await run_blocking(self.generate, prompt)
+
+
+class GeminiAnswerModel(BaseAnswerModel):
+    name = 'gemini'
+
+    def __init__(self, model=ANSWER_MODEL):
+        self.model_id = model
+
+    def stream(self, prompt):
+        response = get_genai().GenerativeModel(self.model_id).generate_content(prompt, stream=True)
+        for piece in response:
+            # Pedaços sem texto (ex.: só metadados de segurança) não têm .text
+            if piece.parts:
+                yield piece.text
+
+    def generate(self, prompt):
+        return get_genai().GenerativeModel(self.model_id).generate_content(prompt).text.strip()
+
+    async def astream(self, prompt):
+        response = await get_genai().GenerativeModel(self.model_id).generate_content_async(prompt, stream=True)
+        async for piece in response:
+            if piece.parts:
+                yield piece.text
+
+    async def agenerate(self, prompt):
+        response = await get_genai().GenerativeModel(self.model_id).generate_content_async(prompt)
+        return response.text.strip()
+
+
+class FakeAnswerModel(BaseAnswerModel):
+    """
+    Modelo local: espera first_token_latency segundos e depois devolve uma palavra a cada
+    token_latency segundos. A resposta repete a pergunta e conta as fontes do prompt.
+    """
+    name = 'fake'
+    model_id = 'fake-llm'
+
+    def __init__(self, first_token_latency=0.0, token_latency=0.0):
+        self.first_token_latency = first_token_latency
+        self.token_latency = token_latency
+
+    def _words(self, prompt):
+        question = prompt.rsplit('Pergunta: ', 1)[-1]
+        sources = prompt.count('\n---')
+        words = f"Resposta simulada para '{question}' com base em {sources} fonte(s).".split(' ')
+        return [word if i == 0 else f' {word}' for i, word in enumerate(words)]
+
+    def stream(self, prompt):
+        time.sleep(self.first_token_latency)
+        for i, word in enumerate(self._words(prompt)):
+            if i:
+                time.sleep(self.token_latency)
+            yield word
+
+    async def astream(self, prompt):
+        await asyncio.sleep(self.first_token_latency)
+        for i, word in enumerate(self._words(prompt)):
+            if i:
+                await asyncio.sleep(self.token_latency)
+            yield word
+
+    async def agenerate(self, prompt):
+        words = self._words(prompt)
+        await asyncio.sleep(self.first_token_latency + self.token_latency * (len(words) - 1))
+        return ''.join(words).strip()
+
+
+ANSWER_MODELS = {
+    GeminiAnswerModel.name: GeminiAnswerModel,
+    FakeAnswerModel.name: FakeAnswerModel,
+}
+
+
+def get_answer_model(name=None, **kwargs):
+    """
+    Instancia o modelo de resposta informado ou, por padrão, o configurado em MELCHIOR_ANSWER_BACKEND
+    (com as opções de MELCHIOR_ANSWER_MODEL_OPTIONS).
+    """
+    if name is None:
+        name = getattr(settings, 'MELCHIOR_ANSWER_BACKEND', GeminiAnswerModel.name)
+        kwargs = {**getattr(settings, 'MELCHIOR_ANSWER_MODEL_OPTIONS', {}), **kwargs}
+    try:
+        return ANSWER_MODELS[name](**kwargs)
+    except KeyError:
+        raise ValueError(f"Modelo de resposta desconhecido: '{name}'. Opções: {', '.join(ANSWER_MODELS)}.")
@@ -0,0 +1,124 @@
+# nerv/magi/melchior/lexical.py
+
+"""
+Busca lexical (BM25) sobre o índice FTS5 dos chunks, criado pela migração 0008_chunk_fts.
+
+Complementa a busca vetorial nas perguntas que citam termos exatos (número de lei, "IPTU",
+"alvará"), que o embedding costuma diluir. O tokenizador do índice ignora acentos e caixa, e a
+pergunta passa pelo mesmo tokenizador, então "alvara" encontra "Alvará". Fora do SQLite o índice
+não existe e a busca lexical devolve vazio.
+"""
+
+import re
+
+from django.db import connection
+from django.db.models.expressions import RawSQL
+
+from melchior.models import Chunk, Documento
+
+FTS_TABLE = 'melchior_chunk_fts'
+
+# Triggers que mantêm o índice em dia (os mesmos da 0008_chunk_fts). No SQLite, toda migração que recria
+# melchior_chunk (AddField NOT NULL, AlterField, RemoveField...) apaga os triggers junto com a tabela antiga,
+# e a busca lexical passa a ignorar as gravações sem nenhum erro: a migração precisa terminar com
+# migrations.RunPython(recreate_fts_triggers, ...). O conteúdo do índice continua válido, porque a tabela
+# nova é copiada com os mesmos ids.
+FTS_TRIGGERS = {
+    'melchior_chunk_fts_ai':
+        'CREATE TRIGGER melchior_chunk_fts_ai AFTER INSERT ON melchior_chunk BEGIN'
+        ' INSERT INTO melchior_chunk_fts(rowid, conteudo_tratado) VALUES (new.id, new.conteudo_tratado); END',
+    'melchior_chunk_fts_ad':
+        'CREATE TRIGGER melchior_chunk_fts_ad AFTER DELETE ON melchior_chunk BEGIN'
+        " INSERT INTO melchior_chunk_fts(melchior_chunk_fts, rowid, conteudo_tratado) VALUES ('delete', old.id, old.conteudo_tratado); END",
+    'melchior_chunk_fts_au':
+        'CREATE TRIGGER melchior_chunk_fts_au AFTER UPDATE OF conteudo_tratado ON melchior_chunk BEGIN'
+        " INSERT INTO melchior_chunk_fts(melchior_chunk_fts, rowid, conteudo_tratado) VALUES ('delete', old.id, old.conteudo_tratado);"
+        ' INSERT INTO melchior_chunk_fts(rowid, conteudo_tratado) VALUES (new.id, new.conteudo_tratado); END',
+}
+
+# Palavras que aparecem em quase todo chunk e só diluem o OR da busca lexical
+STOPWORDS = frozenset("""
+a ao aos as com como da das de do dos e em na nas no nos o os ou para pela pelas pelo pelos por qual quais
+que quem se sem sobre um uma umas uns é
+""".split())
+
+_fts_available = None
+
+
+def fts_available():
+    global _fts_available
+    if _fts_available is None:
+        _fts_available = connection.vendor == 'sqlite' and FTS_TABLE in connection.introspection.table_names()
+    return _fts_available
+
+
+def recreate_fts_triggers(apps, schema_editor):
+    """
+    RunPython das migrações que recriam melchior_chunk: (re)cria os triggers do índice FTS5. Fora do SQLite não faz nada.
+    """
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for name, sql in FTS_TRIGGERS.items():
+        schema_editor.execute(f'DROP TRIGGER IF EXISTS {name}')
+        schema_editor.execute(sql)
+
+
+def fts_match_expression(text, operator='OR'):
+    """
+    Converte texto livre em uma expressão MATCH do FTS5: cada termo vira uma string entre aspas
+    (sem operadores nem sintaxe do FTS5 vindos do usuário), ligados por operator.
+
+    Termos com pontuação interna, como "10.257", viram uma frase e casam com o número inteiro.
+    """
+    terms = []
+    for term in re.findall(r'[^\s"]+', text.casefold()):
+        term = term.strip('.,;:!?()[]{}\'')
+        if not re.search(r'\w', term) or (operator == 'OR' and term in STOPWORDS):
+            continue
+        if term not in terms:
+            terms.append(term)
+    return f' {operator} '.join(f'"{term}"' for term in terms)
+
+
+class LexicalStore:
+    """
+    Mesma interface dos backends vetoriais, mas search() recebe o texto da pergunta.
+    O score é o BM25 com sinal trocado (maior = mais relevante).
+    """
+    name = 'fts5'
+
+    def search(self, query_text, k, filters=None):
+        expression = fts_match_expression(query_text)
+        if not expression or k <= 0 or not fts_available():
+            return []
+        sql = f'SELECT rowid, bm25({FTS_TABLE}) AS score FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s'
+        params = [expression]
+        if filters is not None:
+            # Os filtros entram como subconsulta, para o LIMIT valer só sobre chunks permitidos. O '+' impede
+            # o SQLite de entregar o IN ao FTS5 como busca por rowid (uma consulta ao índice por chunk
+            # permitido): o MATCH conduz a busca e a subconsulta vira só um teste de pertinência.
+            subquery, subquery_params = filters.chunk_queryset().order_by().values('id').query.sql_with_params()
+            sql += f' AND +rowid IN ({subquery})'
+            params.extend(subquery_params)
+        sql += ' ORDER BY score LIMIT %s'
+        params.append(k)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return [(chunk_id, -score) for chunk_id, score in cursor.fetchall()]
+
+
+def matching_documento_ids(text):
+    """
+    Subconsulta com os ids dos documentos que têm algum chunk contendo todos os termos do texto.
+    Sem o índice (fora do SQLite), cai no LIKE do admin: documentos cujo texto completo contém todos os termos.
+    """
+    if not fts_available():
+        documentos = Documento.objects.all()
+        for term in text.split():
+            documentos = documentos.filter(texto_completo_extraido__icontains=term)
+        return documentos.values('id')
+    expression = fts_match_expression(text, operator='AND')
+    if not expression:
+        return Chunk.objects.none().values('documento_id')
+    chunk_ids = RawSQL(f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s', [expression])
+    return Chunk.objects.filter(id__in=chunk_ids).values('documento_id')
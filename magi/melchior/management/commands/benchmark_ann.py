@@ -0,0 +1,87 @@
+# nerv/magi/melchior/management/commands/benchmark_ann.py
+
+import os
+import tempfile
+import time
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from melchior.vectorstore import IvfVectorStore, NumpyVectorStore, build_ivf_index, default_index_dir, default_ivf_index_dir
+
+
+def _percentile_ms(latencies, fraction):
+    return float(np.percentile(latencies, fraction * 100)) * 1000
+
+
+class Command(BaseCommand):
+    help = ('Compara o índice aproximado (IVF) com a busca exata: recall@k e latência p50/p99 '
+            'para várias combinações de nlist e nprobe.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--queries', type=int, default=500, help='Quantidade de consultas.')
+        parser.add_argument('-k', type=int, default=7, help='Vizinhos por consulta (padrão: 7, como na busca).')
+        parser.add_argument('--nprobe', type=int, action='append', dest='nprobes',
+                            help='Partições visitadas por consulta (pode ser repetido). Padrão: 1, 2, 4, 8, 16 e 32.')
+        parser.add_argument('--nlist', type=int, action='append', dest='nlists',
+                            help='Monta índices IVF temporários com este número de partições (pode ser repetido). '
+                                 'Padrão: usa o índice IVF já montado pelo build_vector_index --ivf.')
+        parser.add_argument('--noise', type=float, default=0.1,
+                            help='Ruído gaussiano somado aos embeddings de chunks usados como consulta.')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        exact = NumpyVectorStore(default_index_dir())
+        try:
+            matrix, _ids, _quantized, _scale = exact.load()
+        except FileNotFoundError as e:
+            raise CommandError(str(e))
+        k = options['k']
+        nprobes = options['nprobes'] or [1, 2, 4, 8, 16, 32]
+
+        rng = np.random.default_rng(options['seed'])
+        rows = rng.choice(len(matrix), size=min(options['queries'], len(matrix)), replace=False)
+        queries = np.asarray(matrix[rows]) + rng.normal(0, options['noise'] / np.sqrt(matrix.shape[1]), size=(len(rows), matrix.shape[1]))
+        queries = queries.astype(np.float32)
+
+        latencies = []
+        truth = []
+        for query in queries:
+            start = time.perf_counter()
+            truth.append({chunk_id for chunk_id, _score in exact.search(query, k)})
+            latencies.append(time.perf_counter() - start)
+
+        self.stdout.write(self.style.SUCCESS(f'{len(matrix)} vetor(es), {len(queries)} consulta(s), k={k}.'))
+        self.stdout.write(f'{"índice":<12} {"nprobe":>7} {f"recall@{k}":>10} {"p50 ms":>8} {"p99 ms":>8} {"consultas/s":>12}')
+        self.stdout.write(f'{"exato":<12} {"-":>7} {1:>10.3f} {_percentile_ms(latencies, 0.5):>8.3f} '
+                          f'{_percentile_ms(latencies, 0.99):>8.3f} {len(latencies) / sum(latencies):>12.1f}')
+
+        if options['nlists']:
+            with tempfile.TemporaryDirectory() as temp_dir:
+                for nlist in options['nlists']:
+                    directory = os.path.join(temp_dir, f'ivf-{nlist}')
+                    start = time.perf_counter()
+                    build_ivf_index(exact.directory, directory, nlist=nlist)
+                    self.stdout.write(self.style.NOTICE(f'IVF com nlist={nlist} montado em {time.perf_counter() - start:.1f}s'))
+                    self._measure(directory, nprobes, queries, truth, k)
+        else:
+            try:
+                self._measure(default_ivf_index_dir(), nprobes, queries, truth, k)
+            except FileNotFoundError as e:
+                raise CommandError(f'{e} Use build_vector_index --ivf ou informe --nlist.')
+        self.stdout.write(self.style.SUCCESS('Benchmark concluído.'))
+
+    def _measure(self, directory, nprobes, queries, truth, k):
+        store = IvfVectorStore(directory)
+        store.load()
+        nlist = store.meta['nlist']
+        for nprobe in nprobes:
+            store.nprobe = nprobe
+            latencies = []
+            found = 0
+            for query, expected in zip(queries, truth):
+                start = time.perf_counter()
+                hits = store.search(query, k)
+                latencies.append(time.perf_counter() - start)
+                found += len(expected & {chunk_id for chunk_id, _score in hits})
+            recall = found / max(1, sum(len(expected) for expected in truth))
+            self.stdout.write(f'{f"ivf/{nlist}":<12} {min(nprobe, nlist):>7} {recall:>10.3f} {_percentile_ms(latencies, 0.5):>8.3f} '
+                              f'{_percentile_ms(latencies, 0.99):>8.3f} {len(latencies) / sum(latencies):>12.1f}')
@@ -0,0 +1,99 @@
+# nerv/magi/melchior/management/commands/benchmark_antinomy_rules.py
+
+import re
+import time
+from django.core.management.base import BaseCommand, CommandError
+from melchior.models import Chunk
+from melchior.rules import RuleEngine
+
+# Regex fixo usado pelo resolve_antinomias antes das regras de antinomia, mantido só para comparação
+LEGACY_SELF_REVOKED_PATTERN = re.compile(
+    r'\b(?:revogado|revogada|revogados|revogadas)\b'
+    r'[\s\S]*?(?:\(.*?revogad[ao]s?.*?\))?'
+    , re.IGNORECASE | re.DOTALL
+)
+
+
+def _time_each(texts, func):
+    # Tempo total, o chunk mais lento e o resultado de cada chunk
+    results = []
+    slowest = 0.0
+    start = time.perf_counter()
+    for text in texts:
+        before = time.perf_counter()
+        results.append(func(text))
+        slowest = max(slowest, time.perf_counter() - before)
+    return time.perf_counter() - start, slowest, results
+
+
+def _excerpt(text, width=50):
+    match = re.search('revogad', text, re.IGNORECASE)
+    position = match.start() if match else 0
+    return ' '.join(text[max(0, position - width):position + width].split())
+
+
+class Command(BaseCommand):
+    help = ('Compara, no texto de todos os chunks, o regex fixo antigo de auto-revogação com o motor das '
+            'regras de antinomia ativas: tempo, chunks invalidados, divergências e disparos por regra.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, help='Analisa só os primeiros N chunks.')
+        parser.add_argument('--repeat', type=int, default=3, help='Repetições de cada medição; vale a mais rápida (padrão: 3).')
+        parser.add_argument('--examples', type=int, default=5, help='Exemplos de divergência mostrados (padrão: 5).')
+
+    def handle(self, *args, **options):
+        engine = RuleEngine.from_db()
+        if not engine.rules:
+            raise CommandError('Nenhuma regra de antinomia ativa.')
+        rows = Chunk.objects.order_by('id').values_list('id', 'conteudo_original')
+        if options['limit']:
+            rows = rows[:options['limit']]
+        rows = list(rows)
+        if not rows:
+            raise CommandError('Nenhum chunk encontrado. Execute o process_documents antes.')
+        ids = [chunk_id for chunk_id, _text in rows]
+        texts = [text for _chunk_id, text in rows]
+        self.stdout.write(self.style.SUCCESS(
+            f'{len(texts)} chunk(s), {sum(len(text) for text in texts) / 1e6:.1f} milhões de caracteres; '
+            f'{len(engine.rules)} regra(s) ativa(s), {len(engine.triggers)} gatilho(s).'
+        ))
+
+        measurements = {}
+        for label, func in (('regex fixo', LEGACY_SELF_REVOKED_PATTERN.search), ('regras', engine.decide)):
+            runs = [_time_each(texts, func) for _ in range(max(1, options['repeat']))]
+            measurements[label] = min(runs, key=lambda run: run[0])
+        self.stdout.write(f'{"método":<12} {"total ms":>10} {"µs/chunk":>10} {"pior chunk ms":>14} {"invalidados":>12}')
+        legacy = [match is not None for match in measurements['regex fixo'][2]]
+        decisions = measurements['regras'][2]
+        rules = [decision is not None and decision.rule.invalida for decision in decisions]
+        for label, invalid in (('regex fixo', legacy), ('regras', rules)):
+            elapsed, slowest, _results = measurements[label]
+            self.stdout.write(
+                f'{label:<12} {elapsed * 1000:>10.1f} {elapsed / len(texts) * 1e6:>10.1f} '
+                f'{slowest * 1000:>14.2f} {sum(invalid):>12}'
+            )
+
+        only_legacy = [i for i in range(len(texts)) if legacy[i] and not rules[i]]
+        only_rules = [i for i in range(len(texts)) if rules[i] and not legacy[i]]
+        self.stdout.write(self.style.NOTICE(
+            f'Invalidados pelos dois: {sum(a and b for a, b in zip(legacy, rules))}; só pelo regex fixo: {len(only_legacy)}; '
+            f'só pelas regras: {len(only_rules)}.'
+        ))
+        for label, indexes in (('Só pelo regex fixo', only_legacy), ('Só pelas regras', only_rules)):
+            for i in indexes[:options['examples']]:
+                decision = decisions[i]
+                rule = f' [{decision.rule.nome}]' if decision else ''
+                self.stdout.write(f'  {label}{rule} chunk {ids[i]}: ...{_excerpt(texts[i])}...')
+
+        # Disparos: chunks em que a regra casou; decisões: chunks em que ela foi a de maior prioridade
+        fired = dict.fromkeys((rule.nome for rule in engine.rules), 0)
+        decided = dict.fromkeys(fired, 0)
+        for decision in decisions:
+            if decision is not None:
+                decided[decision.rule.nome] += 1
+                for nome in decision.fired:
+                    fired[nome] += 1
+        self.stdout.write(f'{"regra":<28} {"tipo":<10} {"disparos":>9} {"decisões":>9}')
+        for rule in engine.rules:
+            self.stdout.write(f'{rule.nome:<28} {rule.tipo:<10} {fired[rule.nome]:>9} {decided[rule.nome]:>9}')
+        self.stdout.write(self.style.SUCCESS('Benchmark concluído.'))
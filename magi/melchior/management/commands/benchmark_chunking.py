@@ -0,0 +1,71 @@
+# nerv/magi/melchior/management/commands/benchmark_chunking.py
+
+import os
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from melchior.chunking import split_legal_articles, split_legal_articles_legacy
+from melchior.extractors import get_extractor
+from melchior.management.commands.benchmark_extractors import list_corpus_files
+
+
+def _best_time(func, text, repeat):
+    # Menor tempo entre 'repeat' execuções, para reduzir o ruído do micro-benchmark
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(text)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+class Command(BaseCommand):
+    help = 'Compara o divisor de artigos linear com o padrão regex original nos maiores documentos do corpus.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--documents-dir', type=str, default=os.path.join(settings.BASE_DIR, 'documentos_leis'),
+                            help='Diretório com os HTMLs do corpus (padrão: documentos_leis/).')
+        parser.add_argument('--top', type=int, default=20, help='Quantidade de maiores documentos a medir.')
+        parser.add_argument('--repeat', type=int, default=5, help='Repetições por documento (vale o menor tempo).')
+
+    def handle(self, *args, **options):
+        documents_dir = options['documents_dir']
+        if not os.path.isdir(documents_dir):
+            raise CommandError(f'O diretório de documentos não foi encontrado: {documents_dir}')
+
+        files = sorted(list_corpus_files(documents_dir), key=os.path.getsize, reverse=True)[:options['top']]
+        if not files:
+            raise CommandError(f'Nenhum arquivo HTML encontrado em {documents_dir}')
+
+        extractor = get_extractor()
+        repeat = max(1, options['repeat'])
+        total_legacy = total_linear = 0.0
+        divergent = []
+
+        self.stdout.write(f'{"documento":<28} {"caracteres":>10} {"artigos":>8} {"regex (ms)":>11} {"linear (ms)":>12} {"speedup":>8}')
+        for path in files:
+            with open(path, 'r', encoding='utf-8', errors='replace') as f:
+                text = extractor.extract(f.read())
+            legacy_time, legacy_chunks = _best_time(split_legal_articles_legacy, text, repeat)
+            linear_time, linear_chunks = _best_time(split_legal_articles, text, repeat)
+            total_legacy += legacy_time
+            total_linear += linear_time
+            if legacy_chunks != linear_chunks:
+                divergent.append(path)
+            speedup = legacy_time / linear_time if linear_time > 0 else 0.0
+            self.stdout.write(
+                f'{os.path.basename(path):<28} {len(text):>10} {len(linear_chunks):>8} '
+                f'{legacy_time * 1000:>11.2f} {linear_time * 1000:>12.2f} {speedup:>7.1f}x'
+            )
+
+        speedup = total_legacy / total_linear if total_linear > 0 else 0.0
+        self.stdout.write(self.style.SUCCESS(
+            f'Total: regex {total_legacy * 1000:.1f} ms | linear {total_linear * 1000:.1f} ms | speedup {speedup:.1f}x'
+        ))
+        if divergent:
+            for path in divergent:
+                self.stdout.write(self.style.ERROR(f'Chunks divergentes em {path}'))
+            raise CommandError(f'{len(divergent)} documento(s) com chunks divergentes entre as implementações.')
+        self.stdout.write(self.style.SUCCESS('Chunks idênticos em todos os documentos medidos.'))
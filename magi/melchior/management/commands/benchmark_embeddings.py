@@ -0,0 +1,54 @@
+# nerv/magi/melchior/management/commands/benchmark_embeddings.py
+
+import time
+from django.core.management.base import BaseCommand, CommandError
+from melchior.embeddings import AdaptiveBatchSizer, EmbeddingPipeline, FakeEmbeddingProvider, TokenBucket
+
+
+class Command(BaseCommand):
+    help = ('Mede a vazão do pipeline de embeddings com o provedor falso (offline), '
+            'variando o número de requisições simultâneas.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--items', type=int, default=5000, help='Quantidade de textos sintéticos a embedar.')
+        parser.add_argument('--workers', type=int, action='append', dest='workers_list',
+                            help='Requisições simultâneas a medir (pode ser repetido). Padrão: 1, 2, 4 e 8.')
+        parser.add_argument('--latency', type=float, default=0.2, help='Latência simulada por requisição (s).')
+        parser.add_argument('--latency-per-item', type=float, default=0.002, help='Latência simulada por texto (s).')
+        parser.add_argument('--failure-rate', type=float, default=0.05,
+                            help='Probabilidade de uma requisição falhar com erro passageiro.')
+        parser.add_argument('--requests-per-minute', type=float, default=0, help='Limite de requisições por minuto (0 = sem limite).')
+        parser.add_argument('--batch-size', type=int, default=50, help='Tamanho inicial dos lotes.')
+
+    def handle(self, *args, **options):
+        if options['items'] < 1:
+            raise CommandError('--items deve ser maior ou igual a 1.')
+        workers_list = options['workers_list'] or [1, 2, 4, 8]
+        if min(workers_list) < 1:
+            raise CommandError('--workers deve ser maior ou igual a 1.')
+
+        texts = [f'Art. {i}º Texto sintético número {i} para o benchmark de embeddings.' for i in range(options['items'])]
+        self.stdout.write(self.style.SUCCESS(f'Embedando {len(texts)} texto(s) com o provedor falso...'))
+        self.stdout.write(f'{"workers":>8} {"itens/s":>9} {"reqs":>6} {"repet.":>7} {"divisões":>9} {"falhas":>7} {"lote final":>11}')
+
+        for workers in workers_list:
+            provider = FakeEmbeddingProvider(
+                dimension=64, latency=options['latency'], latency_per_item=options['latency_per_item'],
+                failure_rate=options['failure_rate'], seed=0,
+            )
+            pipeline = EmbeddingPipeline(
+                provider,
+                workers=workers,
+                rate_limiter=TokenBucket(options['requests_per_minute'] / 60),
+                sizer=AdaptiveBatchSizer(initial=options['batch_size'], maximum=100, target_latency=1.0),
+                backoff_base=0.05,
+            )
+            start = time.perf_counter()
+            embedded = sum(len(result.keys) for result in pipeline.run(enumerate(texts)) if result.ok)
+            elapsed = time.perf_counter() - start
+            stats = pipeline.stats
+            self.stdout.write(
+                f'{workers:>8} {embedded / elapsed:>9.1f} {stats["requisicoes"]:>6} {stats["repeticoes"]:>7} '
+                f'{stats["divisoes"]:>9} {stats["falhas"]:>7} {pipeline.sizer.size:>11}'
+            )
+        self.stdout.write(self.style.SUCCESS('Benchmark concluído.'))
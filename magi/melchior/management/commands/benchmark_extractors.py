@@ -0,0 +1,99 @@
+# nerv/magi/melchior/management/commands/benchmark_extractors.py
+
+import hashlib
+import os
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from melchior.extractors import EXTRACTORS, REFERENCE_EXTRACTOR, get_extractor
+
+
+def list_corpus_files(documents_dir, limit=None):
+    """
+    Lista os arquivos HTML do corpus em ordem estável (opcionalmente só os primeiros 'limit').
+    """
+    files = []
+    for root, _dirs, names in os.walk(documents_dir):
+        files.extend(os.path.join(root, name) for name in names if name.lower().endswith('.html'))
+    files.sort()
+    return files[:limit] if limit else files
+
+
+def _run_extractor(extractor_name, files):
+    # Roda em um processo próprio para que o pico de RSS de cada extrator seja medido isoladamente.
+    # ru_maxrss é informado em KiB no Linux. Devolve também o hash do texto de cada arquivo, para
+    # comparar os extratores com a referência sem trafegar os textos entre processos.
+    baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    extractor = get_extractor(extractor_name)
+    elapsed = 0.0
+    digests = []
+    for path in files:
+        with open(path, 'r', encoding='utf-8', errors='replace') as f:
+            html_content = f.read()
+        start = time.perf_counter()
+        text = extractor.extract(html_content)
+        elapsed += time.perf_counter() - start
+        digests.append(hashlib.sha1(text.encode('utf-8')).digest())
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return elapsed, baseline_kb, peak_kb, digests
+
+
+class Command(BaseCommand):
+    help = ('Compara o tempo por arquivo (ms/arquivo) e o pico de memória (RSS) dos extratores de texto HTML, '
+            'e confere se todos produzem o mesmo texto que o extrator de referência em cada arquivo do corpus.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--documents-dir', type=str, default=os.path.join(settings.BASE_DIR, 'documentos_leis'),
+                            help='Diretório com os HTMLs do corpus (padrão: documentos_leis/).')
+        parser.add_argument('--limit', type=int, default=None, help='Usa apenas os primeiros N arquivos do corpus.')
+        parser.add_argument('--extractor', action='append', choices=sorted(EXTRACTORS), dest='extractors',
+                            help='Extrator a medir (pode ser repetido). Padrão: todos.')
+        parser.add_argument('--examples', type=int, default=5, help='Arquivos divergentes mostrados por extrator (padrão: 5).')
+
+    def handle(self, *args, **options):
+        documents_dir = options['documents_dir']
+        if not os.path.isdir(documents_dir):
+            raise CommandError(f'O diretório de documentos não foi encontrado: {documents_dir}')
+
+        files = list_corpus_files(documents_dir, options['limit'])
+        if not files:
+            raise CommandError(f'Nenhum arquivo HTML encontrado em {documents_dir}')
+
+        extractor_names = options['extractors'] or list(EXTRACTORS)
+        self.stdout.write(self.style.SUCCESS(f'Medindo {len(extractor_names)} extrator(es) sobre {len(files)} arquivo(s)...'))
+
+        results = {}
+        for name in extractor_names:
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                results[name] = executor.submit(_run_extractor, name, files).result()
+
+        reference_elapsed = results[REFERENCE_EXTRACTOR][0] if REFERENCE_EXTRACTOR in results else None
+        self.stdout.write(f'{"extrator":<10} {"ms/arquivo":>11} {"arquivos/s":>11} {"pico RSS":>11} {"Δ RSS":>10} {"speedup":>8}')
+        for name, (elapsed, baseline_kb, peak_kb, _digests) in results.items():
+            ms_per_file = elapsed * 1000 / len(files)
+            files_per_second = len(files) / elapsed if elapsed > 0 else 0.0
+            speedup = f'{reference_elapsed / elapsed:.2f}x' if reference_elapsed and elapsed > 0 else '-'
+            self.stdout.write(
+                f'{name:<10} {ms_per_file:>11.3f} {files_per_second:>11.1f} '
+                f'{peak_kb / 1024:>9.1f}MB {(peak_kb - baseline_kb) / 1024:>8.1f}MB {speedup:>8}'
+            )
+
+        if REFERENCE_EXTRACTOR not in results:
+            self.stdout.write(self.style.NOTICE(
+                f'Equivalência não conferida: o extrator de referência ({REFERENCE_EXTRACTOR}) não foi medido.'))
+            self.stdout.write(self.style.SUCCESS('Benchmark concluído.'))
+            return
+        expected = results[REFERENCE_EXTRACTOR][3]
+        divergent = {}
+        for name, (_elapsed, _baseline_kb, _peak_kb, digests) in results.items():
+            if name != REFERENCE_EXTRACTOR:
+                divergent[name] = [path for path, digest, reference in zip(files, digests, expected) if digest != reference]
+        for name, paths in divergent.items():
+            self.stdout.write(f'{name}: {len(paths)} arquivo(s) divergente(s) da referência ({REFERENCE_EXTRACTOR}).')
+            for path in paths[:options['examples']]:
+                self.stdout.write(f'  {path}')
+        if any(divergent.values()):
+            raise CommandError('Há extratores que divergem da referência.')
+        self.stdout.write(self.style.SUCCESS('Benchmark concluído.'))
@@ -0,0 +1,68 @@
+# nerv/magi/melchior/management/commands/benchmark_quantization.py
+
+import time
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from melchior.vectorstore import QUANTIZATIONS, NumpyVectorStore, default_index_dir
+
+
+class Command(BaseCommand):
+    help = ('Compara a busca sobre as cópias quantizadas (int8, binary) com reordenação em float32 contra a busca '
+            'exata: memória varrida por consulta, recall@k e latência.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--queries', type=int, default=500, help='Quantidade de consultas.')
+        parser.add_argument('-k', type=int, default=7, help='Vizinhos por consulta (padrão: 7, como na busca).')
+        parser.add_argument('--candidates', type=int, action='append', dest='candidates_list',
+                            help='Candidatos reordenados em float32 (pode ser repetido). Padrão: 7, 50, 100 e 200.')
+        parser.add_argument('--noise', type=float, default=0.1,
+                            help='Ruído gaussiano somado aos embeddings de chunks usados como consulta.')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        exact = NumpyVectorStore(default_index_dir(), quantization='')
+        try:
+            matrix, _ids, _quantized, _scale = exact.load()
+        except FileNotFoundError as e:
+            raise CommandError(str(e))
+        k = options['k']
+        available = [quantization for quantization in QUANTIZATIONS if quantization in exact.meta.get('quantizacoes', [])]
+        if not available:
+            raise CommandError('O índice não tem cópias quantizadas. Execute o build_vector_index --quantize int8 --quantize binary.')
+
+        rng = np.random.default_rng(options['seed'])
+        rows = rng.choice(len(matrix), size=min(options['queries'], len(matrix)), replace=False)
+        queries = np.asarray(matrix[rows]) + rng.normal(0, options['noise'] / np.sqrt(matrix.shape[1]), size=(len(rows), matrix.shape[1]))
+        queries = queries.astype(np.float32)
+
+        truth, latencies = self._run(exact, queries, k)
+        self.stdout.write(self.style.SUCCESS(f'{len(matrix)} vetor(es) de dimensão {matrix.shape[1]}, {len(queries)} consulta(s), k={k}.'))
+        self.stdout.write(f'{"busca":<8} {"candidatos":>10} {"varrido":>10} {"redução":>8} {f"recall@{k}":>10} {"p50 ms":>8} {"p99 ms":>8}')
+        self._row('float32', '-', exact.scanned_bytes, exact.scanned_bytes, 1.0, latencies)
+
+        for quantization in available:
+            for candidates in options['candidates_list'] or [7, 50, 100, 200]:
+                store = NumpyVectorStore(default_index_dir(), quantization=quantization, candidates=candidates)
+                results, latencies = self._run(store, queries, k)
+                found = sum(len(expected & got) for expected, got in zip(truth, results))
+                recall = found / max(1, sum(len(expected) for expected in truth))
+                self._row(quantization, candidates, store.scanned_bytes, exact.scanned_bytes, recall, latencies)
+        self.stdout.write(self.style.SUCCESS('Benchmark concluído. "varrido" é a matriz lida inteira a cada consulta; '
+                                             'a reordenação lê apenas as linhas float32 dos candidatos.'))
+
+    def _run(self, store, queries, k):
+        store.search(queries[0], k)  # abre os arquivos
+        results = []
+        latencies = []
+        for query in queries:
+            start = time.perf_counter()
+            hits = store.search(query, k)
+            latencies.append(time.perf_counter() - start)
+            results.append({chunk_id for chunk_id, _score in hits})
+        return results, latencies
+
+    def _row(self, name, candidates, scanned, full, recall, latencies):
+        self.stdout.write(
+            f'{name:<8} {candidates:>10} {scanned / 1024 / 1024:>8.2f}MB {full / scanned:>7.1f}x {recall:>10.3f} '
+            f'{np.percentile(latencies, 50) * 1000:>8.3f} {np.percentile(latencies, 99) * 1000:>8.3f}'
+        )
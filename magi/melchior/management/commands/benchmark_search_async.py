@@ -0,0 +1,131 @@
+# nerv/magi/melchior/management/commands/benchmark_search_async.py
+
+import asyncio
+import os
+import random
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+from django.test import AsyncRequestFactory, RequestFactory, override_settings
+from melchior import services, views
+from melchior.embedding_cache import bytes_to_vector
+from melchior.models import Chunk
+
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def _run_wsgi(questions, threads):
+    # Um worker WSGI com 'threads' threads (como o gthread do gunicorn): cada requisição ocupa uma thread do início ao fim
+    factory = RequestFactory()
+
+    def handle(question):
+        start = time.perf_counter()
+        try:
+            views.melchior_search_view(factory.get('/melchior/search/', {'q': question}))
+        finally:
+            close_old_connections()
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        latencies = list(executor.map(handle, questions))
+    return time.perf_counter() - start, latencies
+
+
+async def _run_asgi(questions, concurrency):
+    # Um worker ASGI com até 'concurrency' requisições em andamento no mesmo event loop
+    factory = AsyncRequestFactory()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def handle(question):
+        async with semaphore:
+            start = time.perf_counter()
+            await views.melchior_search_async_view(factory.get('/melchior/search/async/', {'q': question}))
+            return time.perf_counter() - start
+
+    start = time.perf_counter()
+    latencies = await asyncio.gather(*(handle(question) for question in questions))
+    return time.perf_counter() - start, latencies
+
+
+class Command(BaseCommand):
+    help = ('Teste de carga em um processo: vazão da busca síncrona (WSGI, uma thread por requisição) contra a '
+            'assíncrona (ASGI), com o embedding e o modelo de resposta locais (fake) e latência simulada.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=64, help='Requisições por medição.')
+        parser.add_argument('--concurrency', type=int, action='append', dest='levels',
+                            help='Requisições simultâneas (pode ser repetido). Padrão: 1, 8 e 32.')
+        parser.add_argument('--wsgi-threads', type=int, default=8,
+                            help='Threads do worker WSGI simulado (padrão: 8). A concorrência do WSGI é limitada a esse número.')
+        parser.add_argument('--embedding-latency', type=float, default=0.15,
+                            help='Segundos de uma chamada de embedding simulada (padrão: 0.15).')
+        parser.add_argument('--first-token-latency', type=float, default=0.5,
+                            help='Segundos até o primeiro token do modelo simulado (padrão: 0.5).')
+        parser.add_argument('--token-latency', type=float, default=0.01,
+                            help='Segundos entre tokens do modelo simulado (padrão: 0.01).')
+        parser.add_argument('--repeated', type=float, default=0.0,
+                            help='Fração das perguntas de cada medição repetida da medição anterior, servida pelos caches '
+                                 'de perguntas e de respostas (padrão: 0).')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        texts = list(Chunk.objects.filter(is_valido_apos_antinomia=True).values_list('conteudo_tratado', flat=True)[:5000])
+        if not texts:
+            raise CommandError('Nenhum chunk válido. Execute o process_documents antes.')
+        rng = random.Random(options['seed'])
+        base_questions = [' '.join(rng.choice(texts).split()[:10]) for _ in range(options['requests'])]
+        embedding = Chunk.objects.filter(embedding__isnull=False).values_list('embedding', flat=True).first()
+        dimension = len(bytes_to_vector(embedding)) if embedding else 768
+        levels = options['levels'] or [1, 8, 32]
+
+        with tempfile.TemporaryDirectory() as directory, override_settings(
+            # Cache de embeddings descartável: as perguntas do teste não entram no cache real
+            MELCHIOR_EMBEDDING_CACHE_PATH=os.path.join(directory, 'embedding_cache.sqlite3'),
+            MELCHIOR_EMBEDDING_PROVIDER='fake',
+            MELCHIOR_EMBEDDING_PROVIDER_OPTIONS={'dimension': dimension, 'latency': options['embedding_latency']},
+            MELCHIOR_ANSWER_BACKEND='fake',
+            MELCHIOR_ANSWER_MODEL_OPTIONS={
+                'first_token_latency': options['first_token_latency'],
+                'token_latency': options['token_latency'],
+            },
+        ):
+            # Abre o backend vetorial antes das medições
+            services.get_vector_store().warm_up()
+            self.stdout.write(self.style.SUCCESS(
+                f"{options['requests']} requisição(ões) por medição; embedding simulado em {options['embedding_latency']}s, "
+                f"primeiro token em {options['first_token_latency']}s; {options['wsgi_threads']} thread(s) WSGI, "
+                f"{getattr(settings, 'MELCHIOR_ASYNC_WORKERS', services.DEFAULT_ASYNC_WORKERS)} thread(s) no pool da view assíncrona."
+            ))
+            views.query_cache.reset_stats()
+            self.stdout.write(f'{"modo":<6} {"simultâneas":>11} {"req/s":>8} {"p50 ms":>9} {"p95 ms":>9}')
+            repeated = int(len(base_questions) * min(max(options['repeated'], 0.0), 1.0))
+            previous = None
+            for level in levels:
+                for mode in ('wsgi', 'asgi'):
+                    # Perguntas únicas por medição (exceto as repetidas de propósito): o resto não vem de cache
+                    questions = [f'{question} ({mode} {level} {i})' for i, question in enumerate(base_questions)]
+                    if previous is not None and repeated:
+                        questions[:repeated] = previous[:repeated]
+                    previous = questions
+                    if mode == 'wsgi':
+                        elapsed, latencies = _run_wsgi(questions, min(level, options['wsgi_threads']))
+                    else:
+                        elapsed, latencies = asyncio.run(_run_asgi(questions, level))
+                    self.stdout.write(
+                        f'{mode:<6} {level:>11} {len(questions) / elapsed:>8.1f} '
+                        f'{_percentile(latencies, 0.5) * 1000:>9.1f} {_percentile(latencies, 0.95) * 1000:>9.1f}'
+                    )
+            stats = views.query_cache.stats()
+            self.stdout.write(self.style.NOTICE(
+                f"Cache de perguntas: {stats['acertos']} acerto(s) | {stats['faltas']} falta(s) | "
+                f"taxa de acerto {stats['taxa_acerto']:.1%}"
+            ))
+            views.answer_cache.cache.clear()
+        self.stdout.write(self.style.SUCCESS('Benchmark concluído. A vazão do WSGI para de crescer quando todas as threads estão ocupadas.'))
@@ -0,0 +1,99 @@
+# nerv/magi/melchior/management/commands/benchmark_search_stream.py
+
+import random
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.test import RequestFactory, override_settings
+from melchior import views
+from melchior.embedding_cache import bytes_to_vector
+from melchior.models import Chunk
+
+
+def _time_blocking(request):
+    start = time.perf_counter()
+    views.melchior_search_view(request)
+    return time.perf_counter() - start
+
+
+def _time_stream(request):
+    # Tempo até o primeiro evento (fontes), até o primeiro pedaço da resposta e até o fim do stream
+    start = time.perf_counter()
+    response = views.melchior_search_stream_view(request)
+    first_event = first_token = None
+    for event in response.streaming_content:
+        elapsed = time.perf_counter() - start
+        if first_event is None:
+            first_event = elapsed
+        if first_token is None and event.startswith(b'event: resposta'):
+            first_token = elapsed
+    total = time.perf_counter() - start
+    return first_event, first_token or total, total
+
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class Command(BaseCommand):
+    help = ('Compara o tempo até o primeiro byte da busca com streaming (SSE) com o tempo da busca completa, '
+            'usando o modelo de resposta local (fake) com latência simulada.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--queries', type=int, default=20, help='Quantidade de perguntas (trechos de chunks sorteados).')
+        parser.add_argument('--first-token-latency', type=float, default=0.5,
+                            help='Segundos até o primeiro token do modelo simulado (padrão: 0.5).')
+        parser.add_argument('--token-latency', type=float, default=0.03,
+                            help='Segundos entre tokens do modelo simulado (padrão: 0.03).')
+        parser.add_argument('--fake-embeddings', action='store_true',
+                            help='Usa o provedor de embeddings local em vez do Gemini (os resultados da busca perdem o sentido, a medição não).')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        texts = list(Chunk.objects.filter(is_valido_apos_antinomia=True).values_list('conteudo_tratado', flat=True)[:5000])
+        if not texts:
+            raise CommandError('Nenhum chunk válido. Execute o process_documents antes.')
+        rng = random.Random(options['seed'])
+        questions = [' '.join(text.split()[:12]) for text in rng.sample(texts, min(options['queries'], len(texts)))]
+
+        overrides = {
+            'MELCHIOR_ANSWER_BACKEND': 'fake',
+            'MELCHIOR_ANSWER_MODEL_OPTIONS': {
+                'first_token_latency': options['first_token_latency'],
+                'token_latency': options['token_latency'],
+            },
+        }
+        if options['fake_embeddings']:
+            embedding = Chunk.objects.filter(embedding__isnull=False).values_list('embedding', flat=True).first()
+            dimension = len(bytes_to_vector(embedding)) if embedding else 768
+            overrides['MELCHIOR_EMBEDDING_PROVIDER'] = 'fake'
+            overrides['MELCHIOR_EMBEDDING_PROVIDER_OPTIONS'] = {'dimension': dimension}
+
+        factory = RequestFactory()
+        blocking, first_events, first_tokens, stream_totals = [], [], [], []
+        self.stdout.write(self.style.SUCCESS(
+            f"Medindo {len(questions)} pergunta(s); modelo simulado: primeiro token em {options['first_token_latency']}s, "
+            f"{options['token_latency']}s por token..."
+        ))
+        with override_settings(**overrides):
+            for question in questions:
+                # O embedding da pergunta fica em cache antes das duas medições, que comparam busca + geração
+                views.embed_query(question)
+                views.answer_cache.cache.clear()
+                blocking.append(_time_blocking(factory.get('/melchior/search/', {'q': question})))
+                views.answer_cache.cache.clear()
+                first_event, first_token, total = _time_stream(factory.get('/melchior/search/stream/', {'q': question}))
+                first_events.append(first_event)
+                first_tokens.append(first_token)
+                stream_totals.append(total)
+        views.answer_cache.cache.clear()
+
+        self.stdout.write(f'{"medida":<32} {"p50 ms":>9} {"p95 ms":>9}')
+        for label, values in (
+            ('busca completa (resposta)', blocking),
+            ('stream: fontes (1º byte)', first_events),
+            ('stream: 1º pedaço da resposta', first_tokens),
+            ('stream: fim', stream_totals),
+        ):
+            self.stdout.write(f'{label:<32} {_percentile(values, 0.5) * 1000:>9.1f} {_percentile(values, 0.95) * 1000:>9.1f}')
+        self.stdout.write(self.style.SUCCESS('Benchmark concluído.'))
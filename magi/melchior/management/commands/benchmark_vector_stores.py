@@ -0,0 +1,77 @@
+# nerv/magi/melchior/management/commands/benchmark_vector_stores.py
+
+import random
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+from django.core.management.base import BaseCommand, CommandError
+from melchior.embedding_cache import bytes_to_vector
+from melchior.models import Chunk
+from melchior.vectorstore import VECTOR_STORES, get_vector_store
+
+
+def _run_store(store_name, queries, k):
+    # Roda em um processo próprio para medir o pico de RSS de cada backend isoladamente (KiB no Linux)
+    baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    store = get_vector_store(store_name)
+    start = time.perf_counter()
+    store.search(queries[0], k)  # abre o cliente/índice
+    open_seconds = time.perf_counter() - start
+    latencies = []
+    results = []
+    for query in queries:
+        start = time.perf_counter()
+        hits = store.search(query, k)
+        latencies.append(time.perf_counter() - start)
+        results.append([chunk_id for chunk_id, _score in hits])
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return open_seconds, latencies, results, baseline_kb, peak_kb
+
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class Command(BaseCommand):
+    help = 'Compara latência, memória e concordância dos backends de busca vetorial, usando embeddings de chunks como consultas.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--queries', type=int, default=200, help='Quantidade de consultas.')
+        parser.add_argument('-k', type=int, default=7, help='Quantidade de vizinhos por consulta (padrão: 7, como na busca).')
+        parser.add_argument('--backend', action='append', choices=sorted(VECTOR_STORES), dest='backends',
+                            help='Backend a medir (pode ser repetido). Padrão: todos.')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        chunk_ids = list(Chunk.objects.filter(is_valido_apos_antinomia=True, embedding__isnull=False).values_list('id', flat=True))
+        if not chunk_ids:
+            raise CommandError('Nenhum chunk com embedding. Execute o generate_embeddings antes.')
+        sample = random.Random(options['seed']).sample(chunk_ids, min(options['queries'], len(chunk_ids)))
+        queries = [bytes_to_vector(data) for data in Chunk.objects.filter(id__in=sample).values_list('embedding', flat=True)]
+        k = options['k']
+        backends = options['backends'] or list(VECTOR_STORES)
+
+        self.stdout.write(self.style.SUCCESS(f'Medindo {len(backends)} backend(s) com {len(queries)} consulta(s), k={k}...'))
+        results = {}
+        for name in backends:
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                try:
+                    results[name] = executor.submit(_run_store, name, queries, k).result()
+                except Exception as e:
+                    self.stdout.write(self.style.ERROR(f'Backend "{name}" falhou: {e}'))
+
+        reference = results.get('chroma')
+        self.stdout.write(f'{"backend":<8} {"abertura":>9} {"p50 ms":>8} {"p95 ms":>8} {"consultas/s":>12} {"pico RSS":>10} {"Δ RSS":>9} {"concordância":>13}')
+        for name, (open_seconds, latencies, ids, baseline_kb, peak_kb) in results.items():
+            if reference and name != 'chroma':
+                overlap = sum(len(set(a) & set(b)) for a, b in zip(ids, reference[2])) / max(1, sum(len(b) for b in reference[2]))
+                agreement = f'{overlap:.1%}'
+            else:
+                agreement = '-'
+            self.stdout.write(
+                f'{name:<8} {open_seconds * 1000:>7.0f}ms {_percentile(latencies, 0.5) * 1000:>8.2f} '
+                f'{_percentile(latencies, 0.95) * 1000:>8.2f} {len(latencies) / sum(latencies):>12.1f} '
+                f'{peak_kb / 1024:>8.1f}MB {(peak_kb - baseline_kb) / 1024:>7.1f}MB {agreement:>13}'
+            )
+        self.stdout.write(self.style.SUCCESS('Benchmark concluído. A concordância é a fração dos vizinhos do Chroma também retornada pelo backend.'))
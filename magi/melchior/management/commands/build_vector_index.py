@@ -0,0 +1,64 @@
+# nerv/magi/melchior/management/commands/build_vector_index.py
+
+import os
+import time
+from django.core.management.base import BaseCommand, CommandError
+from melchior.embedding_cache import bytes_to_vector
+from melchior.embeddings import EMBEDDING_MODEL
+from melchior.models import Chunk
+from melchior.vectorstore import QUANTIZATIONS, build_ivf_index, build_numpy_index, default_index_dir, default_ivf_index_dir
+
+
+class Command(BaseCommand):
+    help = ('Monta o índice vetorial do backend "numpy" (matriz float32 memory-mapped) a partir de Chunk.embedding '
+            'e, opcionalmente, o índice aproximado do backend "ivf".')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--directory', type=str, default=None,
+                            help='Diretório do índice (padrão: MELCHIOR_VECTOR_INDEX_DIR).')
+        parser.add_argument('--model', type=str, default=EMBEDDING_MODEL,
+                            help=f'Inclui apenas embeddings gerados com este modelo (padrão: {EMBEDDING_MODEL}).')
+        parser.add_argument('--quantize', action='append', choices=QUANTIZATIONS, default=[],
+                            help='Grava também uma cópia quantizada (int8 ou binary) para a busca com reordenação (pode ser repetido).')
+        parser.add_argument('--ivf', action='store_true',
+                            help='Também monta o índice IVF (MELCHIOR_IVF_INDEX_DIR) a partir do índice exato.')
+        parser.add_argument('--nlist', type=int, default=None,
+                            help='Número de partições do IVF (padrão: 4 * raiz quadrada do número de vetores).')
+        parser.add_argument('--kmeans-iterations', type=int, default=20, help='Iterações do k-means do IVF.')
+        parser.add_argument('--sample-size', type=int, default=50000, help='Vetores usados para treinar os centroides do IVF.')
+
+    def handle(self, *args, **options):
+        directory = options['directory'] or default_index_dir()
+        model = options['model']
+        queryset = Chunk.objects.filter(is_valido_apos_antinomia=True, modelo_embedding=model, embedding__isnull=False) \
+                                .order_by('id').values_list('id', 'embedding')
+
+        first = queryset.first()
+        if first is None:
+            raise CommandError(f'Nenhum chunk válido com embedding do modelo "{model}". Execute o generate_embeddings antes.')
+        dimension = len(bytes_to_vector(first[1]))
+
+        self.stdout.write(self.style.SUCCESS(f'Montando o índice vetorial em {directory}...'))
+        start_time = time.perf_counter()
+        count = build_numpy_index(lambda: queryset.iterator(chunk_size=2000), directory, dimension, model,
+                                  quantizations=options['quantize'])
+        elapsed = time.perf_counter() - start_time
+
+        size_mb = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)) / 1024 / 1024
+        self.stdout.write(self.style.SUCCESS(
+            f'Índice montado: {count} vetor(es) de dimensão {dimension} | {size_mb:.1f}MB | {elapsed:.1f}s'
+        ))
+
+        if options['ivf']:
+            if options['nlist'] is not None and options['nlist'] < 1:
+                raise CommandError('--nlist deve ser maior ou igual a 1.')
+            if options['sample_size'] < 1:
+                raise CommandError('--sample-size deve ser maior ou igual a 1.')
+            ivf_directory = default_ivf_index_dir()
+            self.stdout.write(self.style.SUCCESS(f'Montando o índice IVF em {ivf_directory}...'))
+            start_time = time.perf_counter()
+            meta = build_ivf_index(directory, ivf_directory, nlist=options['nlist'],
+                                   iterations=options['kmeans_iterations'], sample_size=options['sample_size'])
+            self.stdout.write(self.style.SUCCESS(
+                f"Índice IVF montado: {meta['quantidade']} vetor(es) em {meta['nlist']} partições | {time.perf_counter() - start_time:.1f}s"
+            ))
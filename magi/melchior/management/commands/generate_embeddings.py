@@ -1,138 +1,302 @@
 # nerv/magi/melchior/management/commands/generate_embeddings.py
 
-import os
+import hashlib
+import time
 from django.core.management.base import BaseCommand, CommandError
-from melchior.models import Chunk, Documento
-import google.generativeai as genai
-import chromadb
-from chromadb.utils import embedding_functions
-from django.conf import settings
-import time # Importar para usar time.sleep
+from django.db import transaction
+from django.utils import timezone
+from melchior.models import Chunk, Documento, ExecucaoEmbedding, FalhaEmbedding, LoteEmbedding
+from melchior.embedding_cache import get_embedding_cache, vector_to_bytes
+from melchior.embeddings import EMBEDDING_MODEL, PROVIDERS, AdaptiveBatchSizer, EmbeddingPipeline, TokenBucket, get_provider
+from melchior.services import CHROMA_COLLECTION_NAME as COLLECTION_NAME, chroma_db_path, get_chroma_client, google_api_key
 
-# --- Configuração da API do Google AI Studio ---
-API_KEY = os.getenv('GOOGLE_API_KEY')
+# O batchEmbedContents do Gemini aceita no máximo 100 textos por requisição
+MAX_BATCH_SIZE = 100
+CHUNKS_PER_QUERY = 500
 
-if not API_KEY:
-    raise CommandError("Erro: A chave da API do Google AI Studio (GOOGLE_API_KEY) não foi encontrada nas variáveis de ambiente. "
-                       "Certifique-se de que seu arquivo .env está configurado corretamente e é carregado no settings.py.")
 
-genai.configure(api_key=API_KEY)
+def content_hash(text):
+    """
+    Hash SHA-256 do conteúdo tratado de um chunk, gravado em Chunk.hash_embedding após o embedding.
+    """
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
 
-# --- Configuração do ChromaDB ---
-CHROMA_DB_PATH = os.path.join(settings.BASE_DIR, 'chroma_db')
-client = chromadb.PersistentClient(path=CHROMA_DB_PATH)
 
-COLLECTION_NAME = "melchior_chunks"
-gemini_embedding_function = embedding_functions.GoogleGenerativeAiEmbeddingFunction(api_key=API_KEY, model_name="embedding-001")
+def chroma_id(chunk_id):
+    return f"chunk_{chunk_id}"
+
+
+def chunk_metadata(chunk):
+    return {
+        "chunk_id": chunk.id,
+        "documento_nome": chunk.documento.nome_arquivo if chunk.documento.nome_arquivo is not None else "",
+        "documento_id": chunk.documento.id,
+        "documento_hierarquia": chunk.documento.hierarquia if chunk.documento.hierarquia is not None else "NAO_APLICAVEL",
+        "documento_data_publicacao": str(chunk.documento.data_publicacao) if chunk.documento.data_publicacao is not None else "",
+        "ordem_no_documento": chunk.ordem_no_documento,
+    }
+
 
 class Command(BaseCommand):
     help = 'Gera e armazena embeddings para chunks válidos usando o Google AI Studio e ChromaDB.'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--incremental', action='store_true',
+                            help='Atualiza a coleção existente em vez de recriá-la: embeda apenas chunks novos ou alterados '
+                                 'e remove os vetores de chunks que sumiram ou se tornaram inválidos.')
+        parser.add_argument('--resume', action='store_true',
+                            help='Retoma a última execução interrompida, no mesmo modo, pulando os lotes já gravados.')
+        parser.add_argument('--retry-failed', action='store_true',
+                            help='Reprocessa apenas os chunks cujo embedding falhou em execuções anteriores.')
+        parser.add_argument('--provider', choices=sorted(PROVIDERS), default='gemini',
+                            help='Provedor de embeddings. "fake" gera vetores determinísticos localmente, sem rede (para testes).')
+        parser.add_argument('--workers', type=int, default=4,
+                            help='Número de requisições de embedding simultâneas.')
+        parser.add_argument('--requests-per-minute', type=float, default=600,
+                            help='Limite de requisições por minuto enviadas ao provedor (0 = sem limite).')
+        parser.add_argument('--batch-size', type=int, default=50,
+                            help=f'Tamanho inicial dos lotes; ajustado automaticamente entre 1 e {MAX_BATCH_SIZE} conforme a latência e os erros.')
+        parser.add_argument('--target-latency', type=float, default=5.0,
+                            help='Latência (s) acima da qual o tamanho dos lotes é reduzido.')
+        parser.add_argument('--max-retries', type=int, default=5,
+                            help='Tentativas por lote em erros passageiros, com backoff exponencial, antes de dividi-lo.')
+        parser.add_argument('--no-cache', action='store_true',
+                            help='Não consulta nem alimenta o cache local de embeddings (MELCHIOR_EMBEDDING_CACHE_PATH).')
+
     def handle(self, *args, **options):
+        if options['workers'] < 1:
+            raise CommandError('--workers deve ser maior ou igual a 1.')
+        if not 1 <= options['batch_size'] <= MAX_BATCH_SIZE:
+            raise CommandError(f'--batch-size deve estar entre 1 e {MAX_BATCH_SIZE}.')
+        if options['max_retries'] < 1:
+            raise CommandError('--max-retries deve ser maior ou igual a 1.')
+        if sum([options['incremental'], options['resume'], options['retry_failed']]) > 1:
+            raise CommandError('Use apenas uma das opções --incremental, --resume e --retry-failed.')
+
         self.stdout.write(self.style.SUCCESS('Iniciando a geração e armazenamento de embeddings...'))
+        self.chunks_processed = 0
+        self.chunks_skipped = 0
+        self.provider = get_provider(options['provider'])
+        self.cache = None if options['no_cache'] else get_embedding_cache()
+        self.pipeline = EmbeddingPipeline(
+            self.provider,
+            workers=options['workers'],
+            rate_limiter=TokenBucket(options['requests_per_minute'] / 60),
+            sizer=AdaptiveBatchSizer(initial=options['batch_size'], maximum=MAX_BATCH_SIZE, target_latency=options['target_latency']),
+            max_retries=options['max_retries'],
+            cache=self.cache,
+        )
+        start_time = time.perf_counter()
+
+        if options['resume']:
+            self.execucao = self._unfinished_run()
+            self.stdout.write(self.style.NOTICE(f'Retomando a execução {self.execucao.id} iniciada em {self.execucao.iniciada_em:%d/%m/%Y %H:%M}.'))
+        else:
+            modo = 'FALHAS' if options['retry_failed'] else 'INCREMENTAL' if options['incremental'] else 'COMPLETO'
+            self.execucao = ExecucaoEmbedding.objects.create(modo=modo, modelo_embedding=self.provider.model_id)
+
+        if self.execucao.modo == 'FALHAS':
+            self._handle_retry_failed()
+        elif self.execucao.modo == 'INCREMENTAL':
+            self._handle_incremental()
+        elif options['resume']:
+            self._handle_resume_full_rebuild()
+        else:
+            self._handle_full_rebuild()
+
+        self.execucao.status = 'CONCLUIDA'
+        self.execucao.finalizada_em = timezone.now()
+        self.execucao.save(update_fields=['status', 'finalizada_em'])
 
+        elapsed = time.perf_counter() - start_time
+        stats = self.pipeline.stats
+        self.stdout.write(self.style.SUCCESS(f'Geração e armazenamento de embeddings concluída.'))
+        self.stdout.write(self.style.SUCCESS(f'Total de chunks processados e armazenados: {self.chunks_processed}'))
+        self.stdout.write(self.style.WARNING(f'Total de chunks ignorados (sem conteúdo ou erro no processamento): {self.chunks_skipped}'))
+        pending_failures = FalhaEmbedding.objects.count()
+        if pending_failures:
+            self.stdout.write(self.style.WARNING(f'{pending_failures} chunk(s) com falha registrada. Use --retry-failed para reprocessá-los.'))
+        self.stdout.write(self.style.NOTICE(
+            f"Requisições: {stats['requisicoes']} | repetições: {stats['repeticoes']} | lotes divididos: {stats['divisoes']} | "
+            f"tamanho final do lote: {self.pipeline.sizer.size} | {self.chunks_processed / elapsed if elapsed > 0 else 0:.1f} chunks/s"
+        ))
+        if self.cache is not None:
+            cache_stats = self.cache.stats
+            self.stdout.write(self.style.NOTICE(
+                f"Cache de embeddings: {cache_stats['hits']} acerto(s) | {cache_stats['misses']} falta(s) | "
+                f"taxa de acerto {self.cache.hit_rate():.1%} | {cache_stats['descartados']} descartado(s) | "
+                f"{cache_stats['travados']} acesso(s) com o arquivo travado | "
+                f"{len(self.cache)} vetor(es), {self.cache.size_bytes / 1024 / 1024:.1f}MB"
+            ))
+        self.stdout.write(self.style.SUCCESS(f'Embeddings armazenados no ChromaDB em: {chroma_db_path()}'))
+
+    def _get_collection(self):
         try:
-            client.delete_collection(name=COLLECTION_NAME)
-            self.stdout.write(self.style.NOTICE(f'Coleção "{COLLECTION_NAME}" do ChromaDB deletada para recomeço limpo.'))
+            from chromadb.utils import embedding_functions
+            gemini_embedding_function = embedding_functions.GoogleGenerativeAiEmbeddingFunction(
+                api_key=google_api_key(), model_name=EMBEDDING_MODEL)
+            return get_chroma_client().get_or_create_collection(name=COLLECTION_NAME, embedding_function=gemini_embedding_function)
         except Exception as e:
-            self.stdout.write(self.style.WARNING(f'Não foi possível deletar a coleção "{COLLECTION_NAME}" do ChromaDB (provavelmente não existia ou outro erro). Erro: {e}'))
-        
+            raise CommandError(f"Erro fatal ao inicializar/criar ChromaDB collection: {e}. Verifique sua chave API, conexão ou se há conflito na função de embedding.")
+
+    def _unfinished_run(self):
+        execucao = ExecucaoEmbedding.objects.order_by('-iniciada_em', '-id').first()
+        if execucao is None or execucao.status != 'EM_ANDAMENTO':
+            raise CommandError('Não há execução interrompida para retomar.')
+        if execucao.modelo_embedding != self.provider.model_id:
+            raise CommandError(f'A execução {execucao.id} usou o modelo "{execucao.modelo_embedding}", '
+                               f'mas o provedor escolhido usa "{self.provider.model_id}".')
+        return execucao
+
+    def _valid_chunks(self, only_ids=None, exclude_ids=()):
+        # Lidos em blocos de ids (e não com um cursor aberto), porque os hashes são gravados
+        # enquanto este gerador ainda está sendo consumido.
+        queryset = Chunk.objects.filter(is_valido_apos_antinomia=True)
+        if only_ids is not None:
+            queryset = queryset.filter(id__in=only_ids)
+        chunk_ids = [chunk_id for chunk_id in queryset.order_by('id').values_list('id', flat=True) if chunk_id not in exclude_ids]
+        for start in range(0, len(chunk_ids), CHUNKS_PER_QUERY):
+            chunks = Chunk.objects.filter(id__in=chunk_ids[start:start + CHUNKS_PER_QUERY]).select_related('documento').order_by('id')
+            for chunk in chunks:
+                if not chunk.conteudo_tratado:
+                    self.stdout.write(self.style.WARNING(f'Chunk {chunk.id} não possui conteúdo tratado. Ignorando embedding.'))
+                    self.chunks_skipped += 1
+                    continue
+                yield chunk
+
+    def _handle_full_rebuild(self):
         try:
-            collection = client.get_or_create_collection(name=COLLECTION_NAME, embedding_function=gemini_embedding_function)
+            get_chroma_client().delete_collection(name=COLLECTION_NAME)
+            self.stdout.write(self.style.NOTICE(f'Coleção "{COLLECTION_NAME}" do ChromaDB deletada para recomeço limpo.'))
         except Exception as e:
-            raise CommandError(f"Erro fatal ao inicializar/criar ChromaDB collection: {e}. Verifique sua chave API, conexão ou se há conflito na função de embedding.")
+            self.stdout.write(self.style.WARNING(f'Não foi possível deletar a coleção "{COLLECTION_NAME}" do ChromaDB (provavelmente não existia ou outro erro). Erro: {e}'))
+
+        collection = self._get_collection()
+        # A coleção foi recriada do zero: nenhum chunk tem mais embedding armazenado
+        Chunk.objects.exclude(hash_embedding='').update(embedding=None, hash_embedding='', modelo_embedding='')
+        self._embed_and_store(collection, self._valid_chunks())
+
+    def _handle_resume_full_rebuild(self):
+        # A coleção não é apagada de novo: pula os chunks dos lotes já gravados e os que falharam
+        # nesta execução (estes ficam para o --retry-failed).
+        done_ids = set()
+        for chunk_ids in self.execucao.lotes.values_list('chunk_ids', flat=True):
+            done_ids.update(chunk_ids)
+        failed_ids = set(self.execucao.falhas.values_list('chunk_id', flat=True))
+        self.stdout.write(self.style.NOTICE(f'{len(done_ids)} chunk(s) já gravado(s) e {len(failed_ids)} com falha nesta execução serão pulados.'))
+        self._embed_and_store(self._get_collection(), self._valid_chunks(exclude_ids=done_ids | failed_ids))
+
+    def _handle_retry_failed(self):
+        failed_ids = set(FalhaEmbedding.objects.values_list('chunk_id', flat=True))
+        if not failed_ids:
+            self.stdout.write(self.style.SUCCESS('Nenhuma falha registrada para reprocessar.'))
+            return
+        # Chunks que deixaram de ser válidos não precisam mais de embedding
+        FalhaEmbedding.objects.filter(chunk__is_valido_apos_antinomia=False).delete()
+        self.stdout.write(self.style.NOTICE(f'Reprocessando {len(failed_ids)} chunk(s) com falha registrada...'))
+        self._embed_and_store(self._get_collection(), self._valid_chunks(only_ids=failed_ids))
+
+    def _handle_incremental(self):
+        collection = self._get_collection()
+        stored = collection.get(include=['metadatas'])
+        stored_metadata = dict(zip(stored['ids'], stored['metadatas']))
+        stored_ids = set(stored_metadata)
+        self.stdout.write(self.style.NOTICE(f'Coleção "{COLLECTION_NAME}" possui {len(stored_ids)} vetor(es) armazenado(s).'))
+
+        valid_ids = set()
+        counts = {'adicionados': 0, 'atualizados': 0, 'inalterados': 0, 'metadados': 0}
+        # Chunks com o mesmo texto cujo documento mudou (hierarquia, data) ou que mudaram de posição:
+        # o vetor continua valendo, só os metadados são regravados
+        metadata_updates = {}
 
+        def changed_chunks():
+            for chunk in self._valid_chunks():
+                valid_ids.add(chroma_id(chunk.id))
+                is_stored = chroma_id(chunk.id) in stored_ids
+                if (is_stored and chunk.hash_embedding == content_hash(chunk.conteudo_tratado)
+                        and chunk.modelo_embedding == self.provider.model_id):
+                    counts['inalterados'] += 1
+                    metadata = chunk_metadata(chunk)
+                    if stored_metadata[chroma_id(chunk.id)] != metadata:
+                        metadata_updates[chroma_id(chunk.id)] = metadata
+                        if len(metadata_updates) >= MAX_BATCH_SIZE:
+                            self._update_metadata(collection, metadata_updates, counts)
+                    continue
+                counts['atualizados' if is_stored else 'adicionados'] += 1
+                yield chunk
 
-        valid_chunks = Chunk.objects.filter(is_valido_apos_antinomia=True).iterator()
-        
-        chunks_processed = 0
-        chunks_skipped = 0
-        
-        documents_batch = []
-        metadatas_batch = []
-        ids_batch = []
-        # Reduzindo o tamanho do lote para evitar timeouts
-        # Tente 100, 50 ou até 20 se o problema persistir.
-        BATCH_SIZE = 100 
-        MAX_RETRIES = 3 # Número máximo de tentativas para cada batch
-        RETRY_DELAY = 10 # Atraso em segundos antes de re-tentar
-
-        for chunk in valid_chunks:
-            if not chunk.conteudo_tratado:
-                self.stdout.write(self.style.WARNING(f'Chunk {chunk.id} não possui conteúdo tratado. Ignorando embedding.'))
-                chunks_skipped += 1
+        self._embed_and_store(collection, changed_chunks())
+        self._update_metadata(collection, metadata_updates, counts)
+
+        # Vetores de chunks que foram apagados ou deixaram de ser válidos
+        stale_ids = sorted(stored_ids - valid_ids)
+        for start in range(0, len(stale_ids), MAX_BATCH_SIZE):
+            collection.delete(ids=stale_ids[start:start + MAX_BATCH_SIZE])
+        stale_chunk_ids = [int(stale_id.split('_')[1]) for stale_id in stale_ids]
+        Chunk.objects.filter(id__in=stale_chunk_ids).update(embedding=None, hash_embedding='', modelo_embedding='')
+
+        self.stdout.write(self.style.SUCCESS('Diferença aplicada à coleção:'))
+        self.stdout.write(self.style.SUCCESS(f"  + {counts['adicionados']} vetor(es) adicionado(s)"))
+        self.stdout.write(self.style.SUCCESS(f"  ~ {counts['atualizados']} vetor(es) atualizado(s) (conteúdo ou modelo alterado)"))
+        self.stdout.write(self.style.SUCCESS(f'  - {len(stale_ids)} vetor(es) removido(s) (chunk apagado ou inválido)'))
+        self.stdout.write(self.style.SUCCESS(
+            f"  = {counts['inalterados']} vetor(es) inalterado(s), {counts['metadados']} com metadados atualizados"
+        ))
+
+    def _update_metadata(self, collection, metadata_updates, counts):
+        if not metadata_updates:
+            return
+        collection.update(ids=list(metadata_updates), metadatas=list(metadata_updates.values()))
+        counts['metadados'] += len(metadata_updates)
+        metadata_updates.clear()
+
+    def _embed_and_store(self, collection, chunks):
+        """
+        Gera os embeddings pelo pipeline concorrente e grava cada lote concluído na coleção,
+        registrando em cada chunk o hash do conteúdo e o modelo que foram embedados.
+
+        Cada lote gravado entra no diário da execução na mesma transação dos hashes; os chunks
+        que falham em definitivo são registrados em FalhaEmbedding.
+        """
+        items = ((chunk, chunk.conteudo_tratado) for chunk in chunks)
+        for result in self.pipeline.run(items):
+            batch = result.keys
+            if not result.ok:
+                chunk = batch[0]
+                self.stdout.write(self.style.ERROR(f'Erro ao gerar embedding do chunk {chunk.id}: {result.error}'))
+                self._record_failures(batch, result.error)
+                continue
+            try:
+                collection.upsert(
+                    ids=[chroma_id(chunk.id) for chunk in batch],
+                    embeddings=result.vectors,
+                    documents=[chunk.conteudo_tratado for chunk in batch],
+                    metadatas=[chunk_metadata(chunk) for chunk in batch],
+                )
+            except Exception as e:
+                self.stdout.write(self.style.ERROR(f'Erro ao gravar lote de {len(batch)} chunks no ChromaDB: {e}'))
+                self._record_failures(batch, e)
                 continue
 
-            chroma_id = f"chunk_{chunk.id}"
-            documents_batch.append(chunk.conteudo_tratado)
-            
-            metadatas_batch.append({
-                "chunk_id": chunk.id,
-                "documento_nome": chunk.documento.nome_arquivo if chunk.documento.nome_arquivo is not None else "",
-                "documento_id": chunk.documento.id,
-                "documento_hierarquia": chunk.documento.hierarquia if chunk.documento.hierarquia is not None else "NAO_APLICAVEL",
-                "documento_data_publicacao": str(chunk.documento.data_publicacao) if chunk.documento.data_publicacao is not None else "",
-                "ordem_no_documento": chunk.ordem_no_documento,
-            })
-            ids_batch.append(chroma_id)
-
-            if len(documents_batch) >= BATCH_SIZE:
-                for attempt in range(MAX_RETRIES):
-                    try:
-                        collection.add(
-                            documents=documents_batch,
-                            metadatas=metadatas_batch,
-                            ids=ids_batch
-                        )
-                        chunks_processed += len(documents_batch)
-                        self.stdout.write(self.style.NOTICE(f'Processados {chunks_processed} chunks...'))
-                        break # Sai do loop de retries se for bem-sucedido
-                    except Exception as e:
-                        if "504 Deadline Exceeded" in str(e) or "timeout" in str(e).lower():
-                            self.stdout.write(self.style.WARNING(f'Erro de timeout no batch (tentativa {attempt + 1}/{MAX_RETRIES}): {e}'))
-                            self.stdout.write(self.style.NOTICE(f'Aguardando {RETRY_DELAY} segundos antes de re-tentar...'))
-                            time.sleep(RETRY_DELAY)
-                        else:
-                            # Outros erros, não tentar novamente
-                            self.stdout.write(self.style.ERROR(f'Erro não-timeout ao adicionar batch de chunks ao ChromaDB: {e}'))
-                            chunks_skipped += len(documents_batch)
-                            break # Sai do loop de retries para outros erros
-                else: # Este else é executado se o loop de retries não foi quebrado (ou seja, todas as tentativas falharam)
-                    self.stdout.write(self.style.ERROR(f'Todas as {MAX_RETRIES} tentativas para o batch falharam. Ignorando este batch.'))
-                    chunks_skipped += len(documents_batch)
-                
-                # Limpar os batches, mesmo que as tentativas falhem, para não acumular
-                documents_batch = []
-                metadatas_batch = []
-                ids_batch = []
-        
-        # Processar qualquer chunk restante no último batch
-        if documents_batch:
-            for attempt in range(MAX_RETRIES):
-                try:
-                    collection.add(
-                        documents=documents_batch,
-                        metadatas=metadatas_batch,
-                        ids=ids_batch
-                    )
-                    chunks_processed += len(documents_batch)
-                    self.stdout.write(self.style.NOTICE(f'Processados os últimos {len(documents_batch)} chunks restantes.'))
-                    break
-                except Exception as e:
-                    if "504 Deadline Exceeded" in str(e) or "timeout" in str(e).lower():
-                        self.stdout.write(self.style.WARNING(f'Erro de timeout no último batch (tentativa {attempt + 1}/{MAX_RETRIES}): {e}'))
-                        self.stdout.write(self.style.NOTICE(f'Aguardando {RETRY_DELAY} segundos antes de re-tentar...'))
-                        time.sleep(RETRY_DELAY)
-                    else:
-                        self.stdout.write(self.style.ERROR(f'Erro não-timeout ao adicionar último batch de chunks ao ChromaDB: {e}'))
-                        chunks_skipped += len(documents_batch)
-                        break
-            else:
-                self.stdout.write(self.style.ERROR(f'Todas as {MAX_RETRIES} tentativas para o último batch falharam. Ignorando este batch.'))
-                chunks_skipped += len(documents_batch)
+            for chunk, vector in zip(batch, result.vectors):
+                chunk.embedding = vector_to_bytes(vector)
+                chunk.hash_embedding = content_hash(chunk.conteudo_tratado)
+                chunk.modelo_embedding = self.provider.model_id
+            chunk_ids = [chunk.id for chunk in batch]
+            with transaction.atomic():
+                Chunk.objects.bulk_update(batch, fields=['embedding', 'hash_embedding', 'modelo_embedding'])
+                LoteEmbedding.objects.create(execucao=self.execucao, chunk_ids=chunk_ids)
+                FalhaEmbedding.objects.filter(chunk_id__in=chunk_ids).delete()
 
+            self.chunks_processed += len(batch)
+            self.stdout.write(self.style.NOTICE(f'Processados {self.chunks_processed} chunks...'))
 
-        self.stdout.write(self.style.SUCCESS(f'Geração e armazenamento de embeddings concluída.'))
-        self.stdout.write(self.style.SUCCESS(f'Total de chunks processados e armazenados: {chunks_processed}'))
-        self.stdout.write(self.style.WARNING(f'Total de chunks ignorados (sem conteúdo ou erro no processamento): {chunks_skipped}'))
-        self.stdout.write(self.style.SUCCESS(f'Embeddings armazenados no ChromaDB em: {CHROMA_DB_PATH}'))
\ No newline at end of file
+    def _record_failures(self, chunks, error):
+        chunk_ids = [chunk.id for chunk in chunks]
+        with transaction.atomic():
+            # Mantém só a falha mais recente de cada chunk
+            FalhaEmbedding.objects.filter(chunk_id__in=chunk_ids).delete()
+            FalhaEmbedding.objects.bulk_create(
+                FalhaEmbedding(execucao=self.execucao, chunk_id=chunk_id, erro=str(error)) for chunk_id in chunk_ids
+            )
+        self.chunks_skipped += len(chunks)
@@ -2,14 +2,185 @@
 
 import os
 import csv
+import hashlib
+import json
+import time
+from collections import Counter
 from datetime import datetime
+from functools import partial
 from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
+from django.db import transaction
 from melchior.models import Documento
-from bs4 import BeautifulSoup
+from melchior.answer_cache import bump_index_version
+from melchior.citations import normalize_lei_cod
+from melchior.extractors import DEFAULT_EXTRACTOR, EXTRACTORS, get_extractor
+from melchior.parallel import ordered_pool_map
 import re
 from django.core.files import File
-import unicodedata
+
+HIERARCHY_MAP = {
+    'LE': 'LEI_MUNICIPAL',
+    'DL': 'DECRETO_MUNICIPAL',
+    'RE': 'RESOLUCAO',
+}
+
+# Campos do Documento que são (re)escritos a cada importação.
+# Usados tanto no update do caminho serial quanto no bulk_update do caminho paralelo.
+UPDATE_FIELDS = ['tipo_documento', 'data_publicacao', 'hierarquia', 'status', 'lei_cod', 'texto_completo_extraido',
+                 'hash_conteudo', 'hash_metadados']
+
+# Quantas linhas do CSV cada tarefa enviada ao pool de processos carrega.
+# Tarefas maiores diluem o custo de serialização entre processos.
+ROWS_PER_TASK = 25
+
+
+def hash_csv_row(row):
+    """
+    Calcula o hash SHA-256 dos metadados de uma linha do CSV (colunas extras sem cabeçalho são ignoradas).
+    """
+    metadados = {key: value for key, value in row.items() if key is not None}
+    serialized = json.dumps(metadados, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+
+def decode_html_bytes(raw_content):
+    """
+    Decodifica o conteúdo bruto do arquivo exatamente como open(..., 'r', encoding='utf-8', errors='replace'),
+    inclusive a tradução universal de quebras de linha.
+    """
+    return raw_content.decode('utf-8', errors='replace').replace('\r\n', '\n').replace('\r', '\n')
+
+
+def resolve_row(row, documents_dir, known_hashes=None, skip_unchanged=False, extractor_name=DEFAULT_EXTRACTOR):
+    """
+    Interpreta uma linha do CSV de metadados e extrai o texto do arquivo correspondente.
+
+    Não toca no banco de dados, então pode rodar tanto no processo principal quanto em workers.
+    known_hashes é a tupla (hash_conteudo, hash_metadados) já gravada para este arquivo, se existir.
+    Com skip_unchanged, um documento cujos bytes e metadados não mudaram não é reprocessado.
+    extractor_name escolhe o extrator de texto (veja melchior.extractors).
+
+    Retorna um dicionário com:
+      - 'row': a linha original do CSV;
+      - 'nome_arquivo' e 'full_file_path' (None se a linha foi ignorada);
+      - 'campos': valores dos campos do Documento (None se a linha foi ignorada ou não mudou);
+      - 'situacao': 'novo', 'alterado' ou 'inalterado' (None se a linha foi ignorada);
+      - 'mensagens': lista de (nível, mensagem) a serem exibidas/registradas no log.
+    """
+    resultado = {'row': row, 'nome_arquivo': None, 'full_file_path': None, 'campos': None, 'situacao': None, 'mensagens': []}
+
+    file_relative_path = row.get('arquivo')
+    data_publicacao_str = row.get('data_publicacao')
+    lei_cod_full = row.get('lei_cod', '')
+    revogada_status_str = row.get('revogada', '').strip().lower()
+
+    if not file_relative_path:
+        resultado['mensagens'].append(('WARNING', 'Linha ignorada: "arquivo" ausente no CSV.'))
+        return resultado
+
+    file_path_after_htmls = re.sub(r'^/?htmls/', '', file_relative_path)
+    full_file_path = os.path.join(documents_dir, file_path_after_htmls)
+
+    if not os.path.exists(full_file_path):
+        resultado['mensagens'].append(('WARNING', f'Arquivo não encontrado, ignorando: {full_file_path}'))
+        return resultado
+
+    file_extension = os.path.splitext(file_relative_path)[1].lower()
+    doc_type = 'HTML' if file_extension == '.html' else 'OUTRO'
+
+    hierarquia_model = 'NAO_APLICAVEL'
+    if lei_cod_full:
+        prefix_match = re.match(r'([A-Z]+)', lei_cod_full)
+        if prefix_match:
+            hierarquia_model = HIERARCHY_MAP.get(prefix_match.group(1).upper(), 'NAO_APLICAVEL')
+
+    status_documento = 'PENDENTE_ANALISE'
+    if revogada_status_str == 'sim' or revogada_status_str == 'true' or revogada_status_str == '1':
+        status_documento = 'REVOGADO'
+    elif revogada_status_str == 'não' or revogada_status_str == 'false' or revogada_status_str == '0':
+        status_documento = 'VIGENTE'
+
+    data_publicacao = None
+    if data_publicacao_str and data_publicacao_str.upper() != 'NULL' and data_publicacao_str.lower() != 'não data de publicação':
+        try:
+            data_publicacao = datetime.strptime(data_publicacao_str, '%Y-%m-%d').date()
+        except ValueError:
+            resultado['mensagens'].append(('WARNING', f'Formato de data inválido para {file_relative_path}: "{data_publicacao_str}". Ignorando data_publicacao.'))
+
+    try:
+        with open(full_file_path, 'rb') as f:
+            raw_content = f.read()
+    except OSError as e:
+        resultado['mensagens'].append(('ERROR', f'Erro ao extrair texto de {file_relative_path}: {e}'))
+        return resultado
+
+    hash_conteudo = hashlib.sha256(raw_content).hexdigest()
+    hash_metadados = hash_csv_row(row)
+    if known_hashes is None:
+        situacao = 'novo'
+    elif known_hashes == (hash_conteudo, hash_metadados):
+        situacao = 'inalterado'
+    else:
+        situacao = 'alterado'
+
+    resultado['nome_arquivo'] = file_relative_path
+    resultado['full_file_path'] = full_file_path
+    resultado['situacao'] = situacao
+    if situacao == 'inalterado' and skip_unchanged:
+        return resultado
+
+    text = ""
+    try:
+        if doc_type == 'HTML':
+            text = get_extractor(extractor_name).extract(decode_html_bytes(raw_content))
+        elif doc_type == 'PDF':
+            resultado['mensagens'].append(('WARNING', f'Processamento de PDF não implementado para {file_relative_path}. Ignorando extração de texto.'))
+            text = ""
+    except Exception as e:
+        resultado['mensagens'].append(('ERROR', f'Erro ao extrair texto de {file_relative_path}: {e}'))
+        resultado['nome_arquivo'] = resultado['full_file_path'] = resultado['situacao'] = None
+        return resultado
+
+    resultado['campos'] = {
+        'tipo_documento': doc_type,
+        'data_publicacao': data_publicacao,
+        'hierarquia': hierarquia_model,
+        'status': status_documento,
+        'lei_cod': normalize_lei_cod(lei_cod_full),
+        'texto_completo_extraido': text,
+        'hash_conteudo': hash_conteudo,
+        'hash_metadados': hash_metadados,
+    }
+    return resultado
+
+
+def _resolve_task(task, documents_dir, skip_unchanged, extractor_name):
+    # Ponto de entrada dos workers: task é a tupla (linha do CSV, hashes conhecidos).
+    row, known_hashes = task
+    return resolve_row(row, documents_dir, known_hashes, skip_unchanged, extractor_name)
+
+
+def last_rows(reader):
+    """
+    Linhas do CSV sem as que são sobrescritas por uma linha posterior do mesmo arquivo.
+
+    Na importação completa a última linha define os campos do documento; no modo incremental as
+    anteriores seriam comparadas com os hashes gravados a partir da última e regravariam os campos dela.
+    """
+    rows = list(reader)
+    last = {row.get('arquivo'): i for i, row in enumerate(rows)}
+    return [row for i, row in enumerate(rows) if not row.get('arquivo') or last[row.get('arquivo')] == i]
+
+
+def iter_resolved_rows(reader, documents_dir, workers, stored_hashes, skip_unchanged, extractor_name):
+    """
+    Distribui as linhas do CSV em um pool de processos e devolve os resultados na ordem original.
+    """
+    tasks = ((row, stored_hashes.get(row.get('arquivo'))) for row in reader)
+    func = partial(_resolve_task, documents_dir=documents_dir, skip_unchanged=skip_unchanged, extractor_name=extractor_name)
+    return ordered_pool_map(func, tasks, workers, items_per_task=ROWS_PER_TASK)
+
 
 class Command(BaseCommand):
     help = 'Importa documentos HTML e seus metadados de um arquivo CSV.'
@@ -18,137 +189,73 @@ class Command(BaseCommand):
         parser.add_argument('csv_file_path', type=str, help='Caminho para o arquivo CSV de metadados.')
         parser.add_argument('documents_dir', type=str, help='Caminho para o diretório raiz contendo os arquivos de documentos (e.g., a pasta que contém "htmls/").')
         parser.add_argument('--error-log', type=str, help='Caminho para o arquivo de log de erros de importação.', default='import_errors.log') # Novo argumento
+        parser.add_argument('--workers', type=int, default=0,
+                            help='Número de processos para extrair o texto em paralelo. Com 0 (padrão) usa o caminho serial; '
+                                 'com N >= 1 extrai em um pool de N processos e grava em lotes com bulk_create/bulk_update.')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Quantidade de documentos gravados por transação no modo paralelo.')
+        parser.add_argument('--incremental', action='store_true',
+                            help='Ignora documentos cujo arquivo e linha do CSV não mudaram desde a última importação (comparando os hashes gravados).')
+        parser.add_argument('--extractor', type=str, choices=sorted(EXTRACTORS), default=DEFAULT_EXTRACTOR,
+                            help=f'Extrator de texto HTML (padrão: {DEFAULT_EXTRACTOR}). "bs4" é a implementação de referência.')
 
     def handle(self, *args, **options):
         csv_file_path = options['csv_file_path']
         documents_dir = options['documents_dir']
         error_log_path = options['error_log'] # Captura o caminho do log
+        workers = options['workers']
+        batch_size = options['batch_size']
+        incremental = options['incremental']
+        extractor_name = options['extractor']
 
         # Lista para armazenar os erros durante a execução
-        import_errors = []
+        self.import_errors = []
+        self.documents_saved = 0
+        self.situacoes = Counter()
 
         if not os.path.exists(csv_file_path):
             raise CommandError(f'O arquivo CSV não foi encontrado: {csv_file_path}')
         if not os.path.isdir(documents_dir):
             raise CommandError(f'O diretório de documentos não foi encontrado: {documents_dir}')
+        if workers < 0:
+            raise CommandError('--workers deve ser maior ou igual a 0.')
+        if batch_size < 1:
+            raise CommandError('--batch-size deve ser maior ou igual a 1.')
 
         self.stdout.write(self.style.SUCCESS(f'Iniciando importação de documentos de {csv_file_path}'))
+        if workers:
+            self.stdout.write(self.style.NOTICE(f'Modo paralelo: {workers} worker(s), lotes de {batch_size} documento(s).'))
 
-        HIERARCHY_MAP = {
-            'LE': 'LEI_MUNICIPAL',
-            'DL': 'DECRETO_MUNICIPAL',
-            'RE': 'RESOLUCAO',
+        # Hashes gravados na última importação, para classificar (e, com --incremental, pular) cada documento
+        stored_hashes = {
+            nome: (hash_conteudo, hash_metadados)
+            for nome, hash_conteudo, hash_metadados in Documento.objects.values_list('nome_arquivo', 'hash_conteudo', 'hash_metadados')
         }
 
+        start_time = time.perf_counter()
+
         try:
             with open(csv_file_path, newline='', encoding='utf-8') as csvfile:
                 reader = csv.DictReader(csvfile)
 
                 reader.fieldnames = [f for f in reader.fieldnames if f is not None and f.strip() != '']
-                
+
                 required_csv_columns = ['arquivo', 'data_publicacao', 'lei_cod', 'revogada']
                 if not all(col in reader.fieldnames for col in required_csv_columns):
                     missing = [col for col in required_csv_columns if col not in reader.fieldnames]
                     raise CommandError(f"Erro: As seguintes colunas obrigatórias não foram encontradas no CSV: {', '.join(missing)}. Verifique o arquivo CSV.")
 
-                for row in reader:
-                    file_relative_path = row.get('arquivo')
-                    data_publicacao_str = row.get('data_publicacao')
-                    lei_cod_full = row.get('lei_cod', '')
-                    revogada_status_str = row.get('revogada', '').strip().lower()
-
-                    if not file_relative_path:
-                        msg = 'Linha ignorada: "arquivo" ausente no CSV.'
-                        self.stdout.write(self.style.WARNING(msg))
-                        import_errors.append(f'{datetime.now().isoformat()} - WARNING: {msg} - Row: {row}')
-                        continue
-
-                    file_path_after_htmls = re.sub(r'^/?htmls/', '', file_relative_path)
-                    full_file_path = os.path.join(documents_dir, file_path_after_htmls)
-
-                    if not os.path.exists(full_file_path):
-                        msg = f'Arquivo não encontrado, ignorando: {full_file_path}'
-                        self.stdout.write(self.style.WARNING(msg))
-                        import_errors.append(f'{datetime.now().isoformat()} - WARNING: {msg} - CSV Row: {row}')
-                        continue
-
-                    file_extension = os.path.splitext(file_relative_path)[1].lower()
-                    doc_type = 'HTML' if file_extension == '.html' else 'OUTRO'
-
-                    hierarquia_model = 'NAO_APLICAVEL'
-                    if lei_cod_full:
-                        prefix_match = re.match(r'([A-Z]+)', lei_cod_full)
-                        if prefix_match:
-                            hierarquia_model = HIERARCHY_MAP.get(prefix_match.group(1).upper(), 'NAO_APLICAVEL')
-                    
-                    status_documento = 'PENDENTE_ANALISE'
-                    if revogada_status_str == 'sim' or revogada_status_str == 'true' or revogada_status_str == '1':
-                        status_documento = 'REVOGADO'
-                    elif revogada_status_str == 'não' or revogada_status_str == 'false' or revogada_status_str == '0':
-                         status_documento = 'VIGENTE'
-
-                    data_publicacao = None
-                    if data_publicacao_str and data_publicacao_str.upper() != 'NULL' and data_publicacao_str.lower() != 'não data de publicação':
-                        try:
-                            data_publicacao = datetime.strptime(data_publicacao_str, '%Y-%m-%d').date()
-                        except ValueError:
-                            msg = f'Formato de data inválido para {file_relative_path}: "{data_publicacao_str}". Ignorando data_publicacao.'
-                            self.stdout.write(self.style.WARNING(msg))
-                            import_errors.append(f'{datetime.now().isoformat()} - WARNING: {msg} - CSV Row: {row}')
-
-                    text = ""
-                    try:
-                        if doc_type == 'HTML':
-                            with open(full_file_path, 'r', encoding='utf-8', errors='replace') as f:
-                                html_content = f.read()
-                            soup = BeautifulSoup(html_content, 'html.parser')
-                            for script in soup(["script", "style"]):
-                                script.extract()
-                            text = soup.get_text()
-                            text = re.sub(r'\s+', ' ', text).strip()
-                            text = unicodedata.normalize('NFKC', text)
-                        elif doc_type == 'PDF':
-                            msg = f'Processamento de PDF não implementado para {file_relative_path}. Ignorando extração de texto.'
-                            self.stdout.write(self.style.WARNING(msg))
-                            import_errors.append(f'{datetime.now().isoformat()} - WARNING: {msg} - CSV Row: {row}')
-                            text = ""
-
-                    except Exception as e:
-                        msg = f'Erro ao extrair texto de {file_relative_path}: {e}'
-                        self.stdout.write(self.style.ERROR(msg))
-                        import_errors.append(f'{datetime.now().isoformat()} - ERROR: {msg} - CSV Row: {row}')
-                        continue
-
-                    try:
-                        documento, created = Documento.objects.get_or_create(
-                            nome_arquivo=file_relative_path,
-                            defaults={
-                                'tipo_documento': doc_type,
-                                'data_publicacao': data_publicacao,
-                                'hierarquia': hierarquia_model,
-                                'status': status_documento,
-                                'texto_completo_extraido': text
-                            }
-                        )
-
-                        if created:
-                            with open(full_file_path, 'rb') as doc_data:
-                                django_file = File(doc_data, name=os.path.basename(file_relative_path))
-                                documento.arquivo.save(django_file.name, django_file, save=True)
-                            self.stdout.write(self.style.SUCCESS(f'Documento "{file_relative_path}" importado com sucesso.'))
-                        else:
-                            documento.tipo_documento = doc_type
-                            documento.data_publicacao = data_publicacao
-                            documento.hierarquia = hierarquia_model
-                            documento.status = status_documento
-                            documento.texto_completo_extraido = text
-                            documento.save()
-                            self.stdout.write(self.style.NOTICE(f'Documento "{file_relative_path}" atualizado.'))
+                if incremental:
+                    reader = last_rows(reader)
 
-                    except Exception as e:
-                        msg = f'Erro ao salvar/atualizar documento {file_relative_path} no banco de dados: {e}'
-                        self.stdout.write(self.style.ERROR(msg))
-                        import_errors.append(f'{datetime.now().isoformat()} - ERROR: {msg} - CSV Row: {row}')
+                if workers:
+                    self._import_parallel(reader, documents_dir, workers, batch_size, start_time, stored_hashes, incremental, extractor_name)
+                else:
+                    for row in reader:
+                        resultado = resolve_row(row, documents_dir, stored_hashes.get(row.get('arquivo')), incremental, extractor_name)
+                        self._report_messages(resultado)
+                        if resultado['campos'] is not None:
+                            self._save_serial(resultado)
 
         except FileNotFoundError:
             raise CommandError(f'Erro: O arquivo CSV não foi encontrado em {csv_file_path}')
@@ -156,10 +263,130 @@ class Command(BaseCommand):
             raise CommandError(f'Ocorreu um erro inesperado: {e}')
         finally:
             # Garante que o log seja salvo mesmo se ocorrer um erro geral
-            if import_errors:
+            if self.import_errors:
                 with open(error_log_path, 'w', encoding='utf-8') as f:
-                    for error_msg in import_errors:
+                    for error_msg in self.import_errors:
                         f.write(error_msg + '\n')
                 self.stdout.write(self.style.WARNING(f'Foram encontrados erros/avisos durante a importação. Veja o log em: {error_log_path}'))
 
-        self.stdout.write(self.style.SUCCESS('Importação de documentos concluída.'))
\ No newline at end of file
+        elapsed = time.perf_counter() - start_time
+        rate = self.documents_saved / elapsed if elapsed > 0 else 0.0
+        self.stdout.write(self.style.SUCCESS(f'{self.documents_saved} documento(s) gravado(s) em {elapsed:.1f}s ({rate:.1f} documentos/s).'))
+        inalterados_label = 'ignorado(s)' if incremental else 'regravado(s)'
+        self.stdout.write(self.style.SUCCESS(
+            f"Novos: {self.situacoes['novo']} | Alterados: {self.situacoes['alterado']} | "
+            f"Inalterados: {self.situacoes['inalterado']} ({inalterados_label})"
+        ))
+        if self.situacoes['novo'] or self.situacoes['alterado']:
+            # Conteúdo novo ou alterado invalida as respostas em cache da busca
+            bump_index_version('import_documents')
+        self.stdout.write(self.style.SUCCESS('Importação de documentos concluída.'))
+
+    def _report_messages(self, resultado):
+        # Exibe e registra no log as mensagens geradas por resolve_row, e contabiliza a situação do documento
+        if resultado['situacao']:
+            self.situacoes[resultado['situacao']] += 1
+        for level, msg in resultado['mensagens']:
+            style = self.style.ERROR if level == 'ERROR' else self.style.WARNING
+            self.stdout.write(style(msg))
+            row_label = 'CSV Row' if resultado['row'].get('arquivo') else 'Row'
+            self.import_errors.append(f'{datetime.now().isoformat()} - {level}: {msg} - {row_label}: {resultado["row"]}')
+
+    def _log_save_error(self, resultado, e):
+        msg = f'Erro ao salvar/atualizar documento {resultado["nome_arquivo"]} no banco de dados: {e}'
+        self.stdout.write(self.style.ERROR(msg))
+        self.import_errors.append(f'{datetime.now().isoformat()} - ERROR: {msg} - CSV Row: {resultado["row"]}')
+
+    def _save_serial(self, resultado):
+        file_relative_path = resultado['nome_arquivo']
+        campos = resultado['campos']
+        try:
+            documento = Documento.objects.filter(nome_arquivo=file_relative_path).first()
+
+            if documento is None:
+                # Copia o arquivo antes de criar a linha, como em _flush_batch: se a cópia falhar, nada é gravado
+                documento = Documento(nome_arquivo=file_relative_path, **campos)
+                with open(resultado['full_file_path'], 'rb') as doc_data:
+                    django_file = File(doc_data, name=os.path.basename(file_relative_path))
+                    documento.arquivo.save(django_file.name, django_file, save=False)
+                documento.save()
+                self.stdout.write(self.style.SUCCESS(f'Documento "{file_relative_path}" importado com sucesso.'))
+            else:
+                for field, value in campos.items():
+                    setattr(documento, field, value)
+                documento.save()
+                self.stdout.write(self.style.NOTICE(f'Documento "{file_relative_path}" atualizado.'))
+            self.documents_saved += 1
+
+        except Exception as e:
+            self._log_save_error(resultado, e)
+
+    def _import_parallel(self, reader, documents_dir, workers, batch_size, start_time, stored_hashes, skip_unchanged, extractor_name):
+        batch = []
+        for resultado in iter_resolved_rows(reader, documents_dir, workers, stored_hashes, skip_unchanged, extractor_name):
+            self._report_messages(resultado)
+            if resultado['campos'] is None:
+                continue
+            batch.append(resultado)
+            if len(batch) >= batch_size:
+                self._flush_batch(batch)
+                batch = []
+                elapsed = time.perf_counter() - start_time
+                self.stdout.write(self.style.NOTICE(
+                    f'{self.documents_saved} documento(s) gravado(s) ({self.documents_saved / elapsed:.1f} documentos/s)...'
+                ))
+        if batch:
+            self._flush_batch(batch)
+
+    def _flush_batch(self, batch):
+        """
+        Grava um lote de documentos com bulk_create/bulk_update em uma única transação.
+
+        Reproduz a semântica do caminho serial: o arquivo é copiado para o storage apenas na criação
+        e, se o mesmo 'arquivo' aparecer mais de uma vez, a última linha do CSV define os campos.
+        """
+        existentes = Documento.objects.in_bulk([r['nome_arquivo'] for r in batch], field_name='nome_arquivo')
+        to_create = {}
+        to_update = {}
+        pending = {}  # nome_arquivo -> resultado da última linha, para mensagens de erro
+        rows_per_doc = Counter()  # linhas do CSV aplicadas a cada documento (como no caminho serial)
+
+        for resultado in batch:
+            nome = resultado['nome_arquivo']
+            pending[nome] = resultado
+            if nome in to_create:
+                documento = to_create[nome]
+            elif nome in existentes:
+                documento = to_update.setdefault(nome, existentes[nome])
+            else:
+                documento = Documento(nome_arquivo=nome)
+                try:
+                    with open(resultado['full_file_path'], 'rb') as doc_data:
+                        django_file = File(doc_data, name=os.path.basename(nome))
+                        documento.arquivo.save(django_file.name, django_file, save=False)
+                except Exception as e:
+                    self._log_save_error(resultado, e)
+                    continue
+                to_create[nome] = documento
+            for field, value in resultado['campos'].items():
+                setattr(documento, field, value)
+            rows_per_doc[nome] += 1
+
+        try:
+            with transaction.atomic():
+                Documento.objects.bulk_create(to_create.values())
+                Documento.objects.bulk_update(to_update.values(), fields=UPDATE_FIELDS)
+            self.documents_saved += sum(rows_per_doc.values())
+        except Exception as e:
+            # Se o lote falhar, grava documento a documento para isolar (e registrar) o problema
+            self.stdout.write(self.style.WARNING(f'Falha ao gravar o lote em bloco ({e}). Gravando documento a documento...'))
+            for nome, documento in list(to_create.items()) + list(to_update.items()):
+                try:
+                    with transaction.atomic():
+                        if nome in to_create:
+                            documento.save()
+                        else:
+                            documento.save(update_fields=UPDATE_FIELDS)
+                    self.documents_saved += rows_per_doc[nome]
+                except Exception as save_error:
+                    self._log_save_error(pending[nome], save_error)
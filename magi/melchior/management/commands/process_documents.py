@@ -1,15 +1,63 @@
 # nerv/magi/melchior/management/commands/process_documents.py
 
 import os
+import time
+from collections import Counter, defaultdict
+from functools import partial
 from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models.functions import Length
 from melchior.models import Documento, Chunk
-import re
-import unicodedata # Já deve estar importado
+from melchior.answer_cache import bump_index_version
+from melchior.citations import article_number
+from melchior.chunking import DEFAULT_MAX_CHARS, STRATEGIES, chunk_size_stats, chunk_text, chunking_fingerprint, strategy_id
+from melchior.parallel import ordered_pool_map
+
+
+def chunk_document(task, strategy='artigos', max_chars=DEFAULT_MAX_CHARS):
+    """
+    Divide o texto de um documento em chunks. Não toca no banco, então pode rodar em workers.
+
+    task é a tupla (id do documento, texto).
+    Retorna (id, [(conteúdo, caminho)], usou_fallback, fingerprint).
+    """
+    doc_id, text = task
+    chunks, usou_fallback = chunk_text(text, strategy, max_chars)
+    return doc_id, chunks, usou_fallback, chunking_fingerprint(text, strategy_id(strategy, max_chars))
+
 
 class Command(BaseCommand):
     help = 'Processa os documentos importados, divide-os em chunks e preenche o conteudo_original.'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=0,
+                            help='Número de processos para o chunking. Com 0 (padrão) o chunking roda no próprio processo.')
+        parser.add_argument('--batch-size', type=int, default=200,
+                            help='Quantidade de documentos gravados por transação.')
+        parser.add_argument('--force', action='store_true',
+                            help='Re-chunka todos os documentos, mesmo os cujo texto extraído não mudou desde a última execução.')
+        parser.add_argument('--strategy', choices=STRATEGIES, default='artigos',
+                            help='"artigos" (padrão) gera um chunk por artigo; "hierarquico" divide os artigos por parágrafo, '
+                                 'inciso e alínea para respeitar --max-chars.')
+        parser.add_argument('--max-chars', type=int, default=DEFAULT_MAX_CHARS,
+                            help=f'Tamanho máximo de cada chunk na estratégia hierárquica (padrão: {DEFAULT_MAX_CHARS}).')
+        parser.add_argument('--stats', action='store_true',
+                            help='Exibe a distribuição de tamanho dos chunks antes e depois do processamento.')
+
     def handle(self, *args, **options):
+        workers = options['workers']
+        batch_size = options['batch_size']
+        force = options['force']
+        strategy = options['strategy']
+        max_chars = options['max_chars']
+        self.verbosity = options['verbosity']
+        if workers < 0:
+            raise CommandError('--workers deve ser maior ou igual a 0.')
+        if batch_size < 1:
+            raise CommandError('--batch-size deve ser maior ou igual a 1.')
+        if max_chars < 100:
+            raise CommandError('--max-chars deve ser maior ou igual a 100.')
+
         self.stdout.write(self.style.SUCCESS('Iniciando o processamento de documentos para chunking...'))
 
         documentos = Documento.objects.all()
@@ -17,69 +65,140 @@ class Command(BaseCommand):
             self.stdout.write(self.style.WARNING('Nenhum documento encontrado no banco de dados para processar.'))
             return
 
+        if options['stats']:
+            self._write_size_stats('antes')
+
+        self.stats = Counter()
+        self.fingerprint_strategy = strategy_id(strategy, max_chars)
+        start_time = time.perf_counter()
+
+        func = partial(chunk_document, strategy=strategy, max_chars=max_chars)
+        results = ordered_pool_map(func, self._pending_documents(force), workers)
+        batch = []
+        for result in results:
+            batch.append(result)
+            if len(batch) >= batch_size:
+                self._write_batch(batch)
+                batch = []
+        if batch:
+            self._write_batch(batch)
+
+        elapsed = time.perf_counter() - start_time
+        self.stdout.write(self.style.SUCCESS(
+            f"Documentos re-chunkados: {self.stats['documentos']} | inalterados: {self.stats['inalterados']} | "
+            f"sem texto: {self.stats['sem_texto']} ({elapsed:.1f}s)"
+        ))
+        self.stdout.write(self.style.SUCCESS(
+            f"Chunks criados: {self.stats['criados']} | mantidos: {self.stats['mantidos']} | removidos: {self.stats['removidos']}"
+        ))
+        if self.stats['documentos']:
+            bump_index_version('process_documents')
+        if options['stats']:
+            self._write_size_stats('depois')
+        self.stdout.write(self.style.SUCCESS('Processamento de documentos concluído.'))
+
+    def _pending_documents(self, force):
+        """
+        Gera (id, texto) dos documentos que precisam de chunking, pulando os que não mudaram.
+        """
+        # Os textos são lidos em blocos de ids (e não com um cursor aberto), porque os lotes
+        # são gravados no banco enquanto este gerador ainda está sendo consumido.
+        doc_ids = list(Documento.objects.order_by('id').values_list('id', flat=True))
+        for start in range(0, len(doc_ids), 500):
+            documentos = Documento.objects.filter(id__in=doc_ids[start:start + 500]) \
+                                          .only('id', 'nome_arquivo', 'texto_completo_extraido', 'hash_texto_chunking') \
+                                          .order_by('id')
+            yield from self._filter_pending(documentos, force)
+
+    def _filter_pending(self, documentos, force):
         for doc in documentos:
-            self.stdout.write(self.style.NOTICE(f'Processando documento: {doc.nome_arquivo}'))
-            
             if not doc.texto_completo_extraido:
                 self.stdout.write(self.style.WARNING(f'Documento "{doc.nome_arquivo}" não possui texto extraído. Ignorando chunking.'))
+                self.stats['sem_texto'] += 1
                 continue
+            if not force and doc.hash_texto_chunking == chunking_fingerprint(doc.texto_completo_extraido, self.fingerprint_strategy):
+                self.stats['inalterados'] += 1
+                continue
+            yield doc.id, doc.texto_completo_extraido
 
-            text = doc.texto_completo_extraido
-            
-            # Limpar chunks existentes para este documento antes de criar novos
-            # Isso é útil se você rodar o comando várias vezes durante o desenvolvimento
-            Chunk.objects.filter(documento=doc).delete()
-            
-            chunks = self._chunk_text_by_legal_articles(text)
-
-            if not chunks: # Se a função de chunking não retornou nada, crie um único chunk
-                if text.strip():
-                    chunks.append(text.strip())
-                    self.stdout.write(self.style.WARNING(f"Nenhum 'Art. Xº' encontrado para {doc.nome_arquivo}. Tratando o documento como um único chunk."))
-                else:
-                    self.stdout.write(self.style.WARNING(f"Documento '{doc.nome_arquivo}' não possui texto válido para chunking."))
-                    continue # Pula para o próximo documento se o texto estiver vazio
-
-            for i, chunk_content in enumerate(chunks):
-                Chunk.objects.create(
-                    documento=doc,
-                    conteudo_original=chunk_content,
-                    conteudo_tratado=chunk_content, # Por enquanto, tratado é igual ao original
-                    ordem_no_documento=i,
-                )
-            self.stdout.write(self.style.SUCCESS(f'Criados {len(chunks)} chunks para "{doc.nome_arquivo}".'))
-        
-        self.stdout.write(self.style.SUCCESS('Processamento de documentos concluído.'))
-
-    def _chunk_text_by_legal_articles(self, text):
+    def _write_batch(self, batch):
         """
-        Divide o texto de uma norma legal em chunks, usando "Art." como delimitador.
-        Considera parágrafos únicos e incisos como parte do artigo.
+        Sincroniza os chunks de um lote de documentos em uma única transação.
+
+        Chunks cujo conteúdo não mudou mantêm o id (e, portanto, os embeddings já gerados);
+        só a ordem e o caminho são atualizados se necessário. Os demais são removidos ou criados com bulk_create.
         """
-        chunks = []
-        
-        # Regex mais robusta:
-        # - Captura "Art." ou "ART."
-        # - Permite um ou mais espaços/quebras de linha (incluindo &nbsp; que vira espaço)
-        # - Captura o número do artigo (pode ter ponto depois)
-        # - Opcionalmente captura o símbolo de grau (º)
-        # - (?:(?! ... ).)*? é o lookahead negativo para parar antes do próximo artigo
-        # - Usamos re.DOTALL para '.' casar com nova linha
-        # - Usamos re.IGNORECASE para "Art."
-        article_pattern = re.compile(
-            r'(Art\.\s*\d+[\ºo]?\s*(?:(?!\s*Art\.\s*\d+[\ºo]?\s*).)*)',
-            re.DOTALL | re.IGNORECASE
-        )
-
-        matches = list(article_pattern.finditer(text))
-
-        if matches:
-            for match in matches:
-                chunk_content = match.group(0).strip()
-                if chunk_content:
-                    chunks.append(chunk_content)
-        
-        # O bloco de fallback para único chunk se não houver matches é movido para handle()
-        # para que o WARNING seja exibido de forma mais centralizada.
-
-        return chunks
\ No newline at end of file
+        doc_ids = [doc_id for doc_id, _chunks, _fallback, _fingerprint in batch]
+        nomes = dict(Documento.objects.filter(id__in=doc_ids).values_list('id', 'nome_arquivo'))
+
+        existing = defaultdict(lambda: defaultdict(list))  # doc_id -> conteudo_original -> [chunks]
+        for chunk in Chunk.objects.filter(documento_id__in=doc_ids).only('id', 'documento_id', 'conteudo_original', 'ordem_no_documento', 'caminho_estrutural', 'numero_artigo'):
+            existing[chunk.documento_id][chunk.conteudo_original].append(chunk)
+
+        to_create = []
+        to_update = []
+        to_delete = []
+        fingerprints = []
+        for doc_id, chunks, usou_fallback, fingerprint in batch:
+            nome = nomes.get(doc_id, doc_id)
+            if not chunks:
+                self.stdout.write(self.style.WARNING(f"Documento '{nome}' não possui texto válido para chunking."))
+            elif usou_fallback:
+                self.stdout.write(self.style.WARNING(f"Nenhum 'Art. Xº' encontrado para {nome}. Tratando o documento como um único chunk."))
+
+            by_content = existing.get(doc_id, {})
+            for i, (chunk_content, caminho) in enumerate(chunks):
+                caminho = caminho[:255]
+                numero_artigo = article_number(caminho)
+                reused = by_content.get(chunk_content)
+                if reused:
+                    chunk = reused.pop(0)
+                    if chunk.ordem_no_documento != i or chunk.caminho_estrutural != caminho or chunk.numero_artigo != numero_artigo:
+                        chunk.ordem_no_documento = i
+                        chunk.caminho_estrutural = caminho
+                        chunk.numero_artigo = numero_artigo
+                        to_update.append(chunk)
+                    self.stats['mantidos'] += 1
+                else:
+                    to_create.append(Chunk(
+                        documento_id=doc_id,
+                        conteudo_original=chunk_content,
+                        conteudo_tratado=chunk_content, # Por enquanto, tratado é igual ao original
+                        ordem_no_documento=i,
+                        caminho_estrutural=caminho,
+                        numero_artigo=numero_artigo,
+                    ))
+            for leftovers in by_content.values():
+                to_delete.extend(chunk.id for chunk in leftovers)
+
+            fingerprints.append(Documento(id=doc_id, hash_texto_chunking=fingerprint))
+            self.stats['documentos'] += 1
+            if self.verbosity > 1:
+                self.stdout.write(self.style.SUCCESS(f'{len(chunks)} chunks para "{nome}".'))
+
+        with transaction.atomic():
+            if to_delete:
+                Chunk.objects.filter(id__in=to_delete).delete()
+            if to_update:
+                # Duas etapas para não violar unique_together (documento, ordem_no_documento) durante as trocas
+                final_order = [chunk.ordem_no_documento for chunk in to_update]
+                for chunk in to_update:
+                    chunk.ordem_no_documento = -chunk.ordem_no_documento - 1
+                Chunk.objects.bulk_update(to_update, fields=['ordem_no_documento'], batch_size=500)
+                for chunk, ordem in zip(to_update, final_order):
+                    chunk.ordem_no_documento = ordem
+                Chunk.objects.bulk_update(to_update, fields=['ordem_no_documento', 'caminho_estrutural', 'numero_artigo'], batch_size=500)
+            Chunk.objects.bulk_create(to_create, batch_size=500)
+            Documento.objects.bulk_update(fingerprints, fields=['hash_texto_chunking'])
+
+        self.stats['criados'] += len(to_create)
+        self.stats['removidos'] += len(to_delete)
+        self.stdout.write(self.style.NOTICE(f"{self.stats['documentos']} documento(s) re-chunkado(s)..."))
+
+    def _write_size_stats(self, momento):
+        sizes = Chunk.objects.annotate(tamanho=Length('conteudo_original')).values_list('tamanho', flat=True)
+        stats = chunk_size_stats(sizes.iterator(chunk_size=2000))
+        self.stdout.write(self.style.NOTICE(
+            f"Tamanho dos chunks ({momento}), em caracteres: {stats['quantidade']} chunks | média {stats['media']} | "
+            f"p50 {stats['p50']} | p90 {stats['p90']} | p99 {stats['p99']} | máximo {stats['maximo']}"
+        ))
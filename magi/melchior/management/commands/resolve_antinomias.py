@@ -1,10 +1,37 @@
 # nerv/magi/melchior/management/commands/resolve_antinomias.py
 
-import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from functools import reduce
+from operator import or_
 from django.core.management.base import BaseCommand, CommandError
-from melchior.models import Documento, Chunk
-import re
-from datetime import date # Para comparar datas
+from django.db import transaction
+from django.db.models import Count, Q
+from melchior.models import CitacaoNorma, Documento, Chunk, RegraAntinomia
+from melchior.answer_cache import bump_index_version
+from melchior.citation_graph import build_citation_graph
+from melchior.rules import REVOGACAO, Rule, RuleEngine
+
+BATCH_SIZE = 2000
+# Limite de ids por UPDATE ... WHERE id IN (...), abaixo do limite de parâmetros do SQLite
+UPDATE_BATCH_SIZE = 500
+
+# Motor de regras de cada processo da busca no texto, compilado uma vez em _init_worker
+_worker_engine = None
+
+
+def _init_worker(rules):
+    global _worker_engine
+    _worker_engine = RuleEngine(rules)
+
+
+def evaluate_batch(batch):
+    """
+    Recebe [(id, conteudo_original)] e devolve [(id, regra decisiva, regras disparadas)].
+    Função de módulo para poder rodar em processos separados.
+    """
+    return _worker_engine.evaluate(batch)
+
 
 class Command(BaseCommand):
     help = 'Resolve antinomias em chunks de documentos legais, marcando a validade.'
@@ -25,7 +52,15 @@ class Command(BaseCommand):
         'NAO_APLICAVEL': -1,
     }
 
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Processos para a busca das regras de antinomia no texto dos chunks (padrão: 1, no próprio processo).')
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                            help=f'Chunks lidos do banco e enviados a cada processo por vez (padrão: {BATCH_SIZE}).')
+
     def handle(self, *args, **options):
+        if options['workers'] < 1 or options['batch_size'] < 1:
+            raise CommandError('--workers e --batch-size devem ser maiores ou iguais a 1.')
         self.stdout.write(self.style.SUCCESS('Iniciando a resolução de antinomias...'))
 
         documentos = Documento.objects.all()
@@ -35,31 +70,42 @@ class Command(BaseCommand):
 
         # Listas para armazenar as regras aplicadas e chunks modificados
         resolved_antinomies_log = []
+        # Os passos abaixo revalidam e invalidam de novo os mesmos chunks a cada execução: o que decide se as
+        # respostas em cache deixam de valer é o conjunto final de chunks inválidos, não o log
+        invalid_before = self._invalid_chunk_ids()
         
         # --- Passo 1: Marcar chunks com base no status do Documento principal ---
         # Se o Documento.status for 'REVOGADO', todos os seus chunks são inválidos.
         # Se for 'VIGENTE', a princípio, seus chunks são válidos.
         # 'PARCIALMENTE_REVOGADO' e 'PENDENTE_ANALISE' exigem análise mais profunda.
+        # Cada regra é um UPDATE sobre todos os documentos com o status, precedido de uma contagem
+        # agrupada por documento para o resumo (em vez de duas consultas por documento).
         self.stdout.write(self.style.NOTICE('Aplicando regras baseadas no status do Documento...'))
-        for doc in documentos:
-            if doc.status == 'REVOGADO':
-                chunks_to_update = doc.chunks.filter(is_valido_apos_antinomia=True)
-                count = chunks_to_update.update(is_valido_apos_antinomia=False)
-                if count > 0:
-                    self.stdout.write(self.style.WARNING(f'Marcado {count} chunks de "{doc.nome_arquivo}" como inválidos (Documento Revogado).'))
-                    resolved_antinomies_log.append(f'Documento {doc.nome_arquivo} (Status: REVOGADO) -> {count} chunks marcados como inválidos.')
-            elif doc.status == 'VIGENTE':
-                chunks_to_update = doc.chunks.filter(is_valido_apos_antinomia=False)
-                count = chunks_to_update.update(is_valido_apos_antinomia=True)
-                if count > 0:
-                    self.stdout.write(self.style.NOTICE(f'Marcado {count} chunks de "{doc.nome_arquivo}" como válidos (Documento Vigente).'))
-                    resolved_antinomies_log.append(f'Documento {doc.nome_arquivo} (Status: VIGENTE) -> {count} chunks marcados como válidos.')
-            
-            # Reset conteudo_tratado para conteudo_original para garantir uma base limpa antes de aplicar as regras
-            # Futuramente, o conteudo_tratado poderá ser alterado para incluir notas de revogação.
-            # doc.chunks.all().update(conteudo_tratado=models.F('conteudo_original')) # Não funciona diretamente para textfield
-            # Melhor iterar ou fazer um update mais inteligente se for mudar o texto.
-            # Por agora, vamos manter conteudo_tratado = conteudo_original, e apenas mudar is_valido_apos_antinomia
+        start = time.perf_counter()
+        status_rules = [
+            ('REVOGADO', True, False, 'inválidos (Documento Revogado)', self.style.WARNING),
+            ('VIGENTE', False, True, 'válidos (Documento Vigente)', self.style.NOTICE),
+        ]
+        for status, current, new, label, style in status_rules:
+            chunks_to_update = Chunk.objects.filter(documento__status=status, is_valido_apos_antinomia=current)
+            counts = list(
+                chunks_to_update.order_by().values('documento__nome_arquivo')
+                .annotate(total=Count('id')).order_by('documento__nome_arquivo')
+            )
+            if not counts:
+                continue
+            chunks_to_update.update(is_valido_apos_antinomia=new)
+            for entry in counts:
+                nome, count = entry['documento__nome_arquivo'], entry['total']
+                self.stdout.write(style(f'Marcado {count} chunks de "{nome}" como {label}.'))
+                resolved_antinomies_log.append(
+                    f'Documento {nome} (Status: {status}) -> {count} chunks marcados como {label.split(" ")[0]}.'
+                )
+        self.stdout.write(self.style.NOTICE(f'Tempo das regras de status: {time.perf_counter() - start:.2f}s'))
+
+        # Reset conteudo_tratado para conteudo_original para garantir uma base limpa antes de aplicar as regras
+        # Futuramente, o conteudo_tratado poderá ser alterado para incluir notas de revogação.
+        # Por agora, vamos manter conteudo_tratado = conteudo_original, e apenas mudar is_valido_apos_antinomia
 
         # --- Passo 2: Identificação de Revogações Explícitas no Conteúdo do Chunk ---
         # Padrões para buscar por revogações explícitas dentro do texto do chunk
@@ -67,51 +113,40 @@ class Command(BaseCommand):
         # Isso é uma simplificação. Identificar qual lei ou artigo é revogado é mais complexo.
         # Por enquanto, se um chunk *menciona* uma revogação genérica, ele não invalida outros,
         # mas se um chunk *se declara* revogado (ex: "Art. X. (Revogado)"), ele é invalidado.
-        
-        self.stdout.write(self.style.NOTICE('Buscando por termos de revogação explícita nos chunks...'))
-        
-        # Regex para identificar se o próprio chunk se declara revogado
-        # Ex: "Art. 5º (Revogado pela Lei XYZ)" ou "Parágrafo único. (Revogado)"
-        self_revoked_pattern = re.compile(
-            r'\b(?:revogado|revogada|revogados|revogadas)\b' # palavras "revogado"
-            r'[\s\S]*?(?:\(.*?revogad[ao]s?.*?\))?' # opcionalmente, entre parênteses
-            , re.IGNORECASE | re.DOTALL
-        )
 
         # Regex para identificar texto tachado (ex: [texto tachado]) - **Extremamente difícil de capturar em texto puro extraído de HTML sem a formatação.**
         # A detecção de texto tachado geralmente requer análise do HTML/PDF original (tags <del>, estilos CSS).
         # Para texto puro, é quase impossível sem um padrão de marcador específico.
-        # Por exemplo, se o texto tachado sempre for exportado como [TACHADO: Conteúdo], poderíamos usar.
         # Sem isso, vamos ignorar a detecção de "tachado" por agora no nível do texto puro.
 
-        chunks_count = Chunk.objects.filter(is_valido_apos_antinomia=True).count()
-        self.stdout.write(self.style.NOTICE(f'Analisando {chunks_count} chunks válidos para revogações explícitas...'))
-
-        for chunk in Chunk.objects.filter(is_valido_apos_antinomia=True):
-            # Se o texto do chunk se declara revogado
-            if self_revoked_pattern.search(chunk.conteudo_original):
-                chunk.is_valido_apos_antinomia = False
-                chunk.save()
-                msg = f'Chunk {chunk.id} de "{chunk.documento.nome_arquivo}" marcado como inválido (contém termo de auto-revogação).'
-                self.stdout.write(self.style.WARNING(msg))
-                resolved_antinomies_log.append(msg)
-            # else:
-            #     # Poderíamos aqui implementar lógica para identificar revogação de *outros* chunks
-            #     # Ex: "Esta Lei revoga o Art. 5º da Lei Y". Isso exigiria:
-            #     # 1. Extração do número do artigo e da lei revogada.
-            #     # 2. Busca no DB por essa Lei Y e seu Art. 5º.
-            #     # 3. Marcar o Art. 5º da Lei Y como is_valido_apos_antinomia = False.
-            #     # Isso é bem mais complexo e podemos deixar para uma versão futura.
-
-
-        # --- Passo 3: Aplicação de Regras de Prevalência (Hierárquica e Cronológica) ---
+        # As regras (RegraAntinomia, editáveis no admin) substituem o regex fixo: cada uma tem um gatilho
+        # literal e um padrão testado a partir dele, e o chunk guarda a regra que decidiu (regra_antinomia).
+        self.stdout.write(self.style.NOTICE('Buscando por termos de revogação explícita nos chunks...'))
+        rules = {regra.nome: regra for regra in RegraAntinomia.objects.filter(ativa=True)}
+        try:
+            engine = RuleEngine(Rule.from_model(regra) for regra in rules.values())
+        except ValueError as e:
+            raise CommandError(str(e))
+        if rules:
+            self._apply_rules(engine, rules, options, resolved_antinomies_log)
+        else:
+            self.stdout.write(self.style.WARNING('Nenhuma regra de antinomia ativa: a busca no texto foi pulada.'))
+
+        # --- Passo 3: Revogações entre normas ---
+        # "Fica revogado o Decreto-Lei nº 137/1946", "revoga o art. 5º da Lei ...", e as notas
+        # "(Este artigo foi revogado pelo art. 3º da Lei ...)": as citações de todos os chunks viram o grafo
+        # CitacaoNorma, resolvido contra o índice (lei_cod, artigo), e os chunks revogados são invalidados
+        # com revogado_por_chunk apontando para o chunk revogador (se ele estiver no acervo).
+        self._apply_citation_graph(resolved_antinomies_log)
+
+        # --- Passo 4: Aplicação de Regras de Prevalência (Hierárquica e Cronológica) ---
         # Esta é a parte mais complexa e que exige identificação de CONFLITOS de CONTEÚDO.
         # Para um protótipo, não é viável fazer isso sem um sistema de PNL que:
         # a) Identifique o "assunto" de cada chunk.
         # b) Compare chunks de diferentes documentos que tratam do MESMO assunto.
         # c) A partir dessa comparação, aplique a hierarquia e cronologia para ver qual prevalece.
 
-        # POR ENQUANTO, vamos apenas usar o status inicial do documento e a auto-revogação.
+        # POR ENQUANTO, vamos apenas usar o status inicial do documento, a auto-revogação e as revogações explícitas entre normas.
         # A resolução de antinomias por hierarquia/cronologia será acionada quando o usuário fizer uma pergunta
         # e o sistema recuperar chunks conflitantes, ou em um pipeline de processamento posterior.
         
@@ -120,9 +155,158 @@ class Command(BaseCommand):
 
         self.stdout.write(self.style.SUCCESS('Resolução de antinomias concluída.'))
         
+        if self._invalid_chunk_ids() != invalid_before:
+            # A validade dos chunks mudou: as respostas em cache da busca deixam de valer
+            bump_index_version('resolve_antinomias')
+        else:
+            self.stdout.write(self.style.NOTICE('A validade dos chunks não mudou: as respostas em cache continuam valendo.'))
         if resolved_antinomies_log:
             self.stdout.write(self.style.SUCCESS('\nResumo das Antinomias Resolvidas/Marcadas:'))
             for entry in resolved_antinomies_log:
                 self.stdout.write(self.style.SUCCESS(f'- {entry}'))
         else:
-            self.stdout.write(self.style.SUCCESS('Nenhuma antinomia explícita encontrada ou marcada nesta execução.'))
\ No newline at end of file
+            self.stdout.write(self.style.SUCCESS('Nenhuma antinomia explícita encontrada ou marcada nesta execução.'))
+
+    @staticmethod
+    def _invalid_chunk_ids():
+        return set(Chunk.objects.filter(is_valido_apos_antinomia=False).values_list('id', flat=True))
+
+    def _apply_rules(self, engine, rules, options, resolved_antinomies_log):
+        start = time.perf_counter()
+        valid_chunks = Chunk.objects.filter(is_valido_apos_antinomia=True)
+        # Um chunk sem nenhum gatilho no texto não dispara regra: o banco descarta esses chunks antes
+        candidates = valid_chunks.filter(reduce(or_, (Q(conteudo_original__icontains=trigger) for trigger in engine.triggers)))
+        self.stdout.write(self.style.NOTICE(
+            f'Analisando {valid_chunks.count()} chunks válidos com {len(engine.rules)} regra(s) '
+            f'({candidates.count()} com algum gatilho no texto)...'
+        ))
+        results = self._scan(candidates, engine, options['workers'], options['batch_size'])
+        self.stdout.write(self.style.NOTICE(f'Tempo da busca no texto: {time.perf_counter() - start:.2f}s'))
+
+        # Um UPDATE ... WHERE id IN (...) por regra e lote, sem carregar os chunks
+        start = time.perf_counter()
+        by_rule = {}
+        for chunk_id, decisive, _fired in results:
+            by_rule.setdefault(decisive, []).append(chunk_id)
+        # A regra registrada nos chunks analisados é a desta execução
+        valid_chunks.filter(regra_antinomia__isnull=False).update(regra_antinomia=None)
+        revoked = 0
+        for nome, chunk_ids in sorted(by_rule.items()):
+            regra = rules[nome]
+            for i in range(0, len(chunk_ids), UPDATE_BATCH_SIZE):
+                batch = Chunk.objects.filter(id__in=chunk_ids[i:i + UPDATE_BATCH_SIZE])
+                if regra.tipo != REVOGACAO:
+                    batch.update(regra_antinomia=regra)
+                    continue
+                names = dict(batch.values_list('id', 'documento__nome_arquivo'))
+                batch.update(is_valido_apos_antinomia=False, regra_antinomia=regra)
+                for chunk_id in chunk_ids[i:i + UPDATE_BATCH_SIZE]:
+                    msg = f'Chunk {chunk_id} de "{names[chunk_id]}" marcado como inválido (regra "{nome}").'
+                    self.stdout.write(self.style.WARNING(msg))
+                    resolved_antinomies_log.append(msg)
+                    revoked += 1
+        self.stdout.write(self.style.NOTICE(f'Tempo da gravação ({revoked} chunk(s) invalidado(s)): {time.perf_counter() - start:.2f}s'))
+        self._report_rules(rules, results)
+
+    def _apply_citation_graph(self, resolved_antinomies_log):
+        self.stdout.write(self.style.NOTICE('Montando o grafo de citações entre normas...'))
+        start = time.perf_counter()
+        graph = build_citation_graph()
+        self.stdout.write(self.style.NOTICE(
+            f'{len(graph.edges)} citação(ões) em {graph.chunks_read} chunks: {graph.count("REVOGA")} revogação(ões) e '
+            f'{graph.count("REVOGADO_POR")} nota(s) de revogação; {graph.resolved} apontam para normas do acervo.'
+        ))
+        self.stdout.write(self.style.NOTICE(f'Tempo da extração das citações: {time.perf_counter() - start:.2f}s'))
+
+        start = time.perf_counter()
+        by_revoker = {}
+        for chunk_id, revoker_id in graph.revoked.items():
+            by_revoker.setdefault(revoker_id, []).append(chunk_id)
+        revoked = 0
+        with transaction.atomic():
+            CitacaoNorma.objects.all().delete()
+            CitacaoNorma.objects.bulk_create(graph.edges, batch_size=UPDATE_BATCH_SIZE)
+            # As revogações da execução anterior são desfeitas antes de aplicar o grafo novo: o chunk volta a
+            # ser válido, a menos que o documento esteja revogado ou uma regra de revogação o tenha invalidado
+            previous = Chunk.objects.filter(Q(revogado_por_citacao=True) | Q(revogado_por_chunk__isnull=False))
+            previously_revoked = set(previous.filter(is_valido_apos_antinomia=False).values_list('id', flat=True))
+            previous.exclude(documento__status='REVOGADO').exclude(regra_antinomia__tipo=REVOGACAO).update(is_valido_apos_antinomia=True)
+            previous.update(revogado_por_chunk=None, revogado_por_citacao=False)
+            for revoker_id, chunk_ids in by_revoker.items():
+                chunk_ids.sort()
+                for i in range(0, len(chunk_ids), UPDATE_BATCH_SIZE):
+                    batch = Chunk.objects.filter(id__in=chunk_ids[i:i + UPDATE_BATCH_SIZE])
+                    newly_revoked = [
+                        (chunk_id, nome)
+                        for chunk_id, nome in batch.filter(is_valido_apos_antinomia=True).values_list('id', 'documento__nome_arquivo')
+                        if chunk_id not in previously_revoked
+                    ]
+                    batch.update(is_valido_apos_antinomia=False, revogado_por_chunk=revoker_id, revogado_por_citacao=True)
+                    for chunk_id, nome in newly_revoked:
+                        origem = f'pelo chunk {revoker_id}' if revoker_id else 'por norma fora do acervo'
+                        msg = f'Chunk {chunk_id} de "{nome}" marcado como inválido (revogado {origem}).'
+                        self.stdout.write(self.style.WARNING(msg))
+                        resolved_antinomies_log.append(msg)
+                        revoked += 1
+            restored_ids = sorted(previously_revoked - set(graph.revoked))
+            for i in range(0, len(restored_ids), UPDATE_BATCH_SIZE):
+                restored = Chunk.objects.filter(id__in=restored_ids[i:i + UPDATE_BATCH_SIZE], is_valido_apos_antinomia=True)
+                for chunk_id, nome in restored.order_by('id').values_list('id', 'documento__nome_arquivo'):
+                    msg = f'Chunk {chunk_id} de "{nome}" voltou a ser válido (a revogação não está mais no acervo).'
+                    self.stdout.write(self.style.NOTICE(msg))
+                    resolved_antinomies_log.append(msg)
+        self.stdout.write(self.style.NOTICE(
+            f'Tempo da gravação do grafo ({len(graph.revoked)} chunk(s) revogado(s), {revoked} invalidado(s) agora): '
+            f'{time.perf_counter() - start:.2f}s'
+        ))
+
+    def _report_rules(self, rules, results):
+        # Disparos: chunks em que a regra casou; decisões: chunks em que ela foi a de maior prioridade
+        fired = dict.fromkeys(rules, 0)
+        decided = dict.fromkeys(rules, 0)
+        for _chunk_id, decisive, names in results:
+            decided[decisive] += 1
+            for nome in names:
+                fired[nome] += 1
+        self.stdout.write(self.style.NOTICE('Regras de antinomia nesta execução:'))
+        self.stdout.write(f'{"regra":<28} {"tipo":<10} {"prioridade":>10} {"disparos":>9} {"decisões":>9}')
+        for nome, regra in rules.items():
+            self.stdout.write(f'{nome:<28} {regra.tipo:<10} {regra.prioridade:>10} {fired[nome]:>9} {decided[nome]:>9}')
+            regra.acertos = fired[nome]
+        RegraAntinomia.objects.bulk_update(rules.values(), ['acertos'])
+
+    def _scan(self, queryset, engine, workers, batch_size):
+        """
+        [(id, regra decisiva, regras disparadas)] dos chunks do queryset em que alguma regra disparou.
+        Os chunks são lidos em lotes, só com id e conteudo_original; com workers > 1, os lotes são
+        analisados em processos separados, cada um com o motor compilado uma única vez.
+        """
+        rows = queryset.order_by('id').values_list('id', 'conteudo_original').iterator(chunk_size=batch_size)
+        batches = self._batches(rows, batch_size)
+        if workers == 1:
+            return [result for batch in batches for result in engine.evaluate(batch)]
+
+        results = []
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(engine.rules,)) as executor:
+            pending = set()
+            for batch in batches:
+                # No máximo dois lotes por processo em memória
+                if len(pending) >= workers * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        results.extend(future.result())
+                pending.add(executor.submit(evaluate_batch, batch))
+            for future in pending:
+                results.extend(future.result())
+        return sorted(results)
+
+    @staticmethod
+    def _batches(rows, batch_size):
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
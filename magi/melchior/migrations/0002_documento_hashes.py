@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('melchior', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='documento',
+            name='hash_conteudo',
+            field=models.CharField(blank=True, default='', help_text='Hash SHA-256 dos bytes do arquivo importado.', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='documento',
+            name='hash_metadados',
+            field=models.CharField(blank=True, default='', help_text='Hash SHA-256 da linha de metadados do CSV.', max_length=64),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('melchior', '0002_documento_hashes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='documento',
+            name='hash_texto_chunking',
+            field=models.CharField(blank=True, default='', help_text='Hash do texto extraído usado no último chunking.', max_length=64),
+        ),
+    ]
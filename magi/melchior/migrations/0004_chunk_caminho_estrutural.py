@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('melchior', '0003_documento_hash_texto_chunking'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chunk',
+            name='caminho_estrutural',
+            field=models.CharField(blank=True, default='', help_text="Localização do chunk na estrutura da norma (ex.: 'Art. 5º, §2º, III').", max_length=255),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('melchior', '0004_chunk_caminho_estrutural'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chunk',
+            name='hash_embedding',
+            field=models.CharField(blank=True, default='', help_text='Hash do conteúdo tratado no momento em que o embedding foi gerado.', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='chunk',
+            name='modelo_embedding',
+            field=models.CharField(blank=True, default='', help_text='Modelo usado para gerar o embedding armazenado.', max_length=100),
+        ),
+    ]
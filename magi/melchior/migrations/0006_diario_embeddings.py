@@ -0,0 +1,47 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:54
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('melchior', '0005_chunk_hash_embedding'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExecucaoEmbedding',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('modo', models.CharField(choices=[('COMPLETO', 'Completo'), ('INCREMENTAL', 'Incremental'), ('FALHAS', 'Reprocessamento de falhas')], help_text='Modo em que o comando foi executado.', max_length=20)),
+                ('modelo_embedding', models.CharField(help_text='Modelo usado para gerar os embeddings.', max_length=100)),
+                ('status', models.CharField(choices=[('EM_ANDAMENTO', 'Em andamento'), ('CONCLUIDA', 'Concluída')], default='EM_ANDAMENTO', help_text='Situação da execução.', max_length=20)),
+                ('iniciada_em', models.DateTimeField(auto_now_add=True, help_text='Data e hora de início da execução.')),
+                ('finalizada_em', models.DateTimeField(blank=True, help_text='Data e hora em que a execução terminou.', null=True)),
+            ],
+            options={
+                'ordering': ['-iniciada_em'],
+            },
+        ),
+        migrations.CreateModel(
+            name='FalhaEmbedding',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('erro', models.TextField(help_text='Mensagem do erro retornado.')),
+                ('registrada_em', models.DateTimeField(auto_now_add=True, help_text='Data e hora em que a falha foi registrada.')),
+                ('chunk', models.ForeignKey(help_text='Chunk que não pôde ser embedado.', on_delete=django.db.models.deletion.CASCADE, related_name='falhas_embedding', to='melchior.chunk')),
+                ('execucao', models.ForeignKey(help_text='Execução em que a falha ocorreu.', on_delete=django.db.models.deletion.CASCADE, related_name='falhas', to='melchior.execucaoembedding')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='LoteEmbedding',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('chunk_ids', models.JSONField(help_text='Ids dos chunks gravados neste lote.')),
+                ('registrado_em', models.DateTimeField(auto_now_add=True, help_text='Data e hora em que o lote foi gravado.')),
+                ('execucao', models.ForeignKey(help_text='Execução à qual o lote pertence.', on_delete=django.db.models.deletion.CASCADE, related_name='lotes', to='melchior.execucaoembedding')),
+            ],
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('melchior', '0006_diario_embeddings'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VersaoIndice',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('versao', models.PositiveIntegerField(default=0, help_text='Número da versão atual do índice.')),
+                ('motivo', models.CharField(blank=True, default='', help_text='O que provocou a última mudança de versão.', max_length=255)),
+                ('atualizada_em', models.DateTimeField(auto_now=True, help_text='Data e hora da última mudança de versão.')),
+            ],
+        ),
+    ]
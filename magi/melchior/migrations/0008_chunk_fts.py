@@ -0,0 +1,48 @@
+# Índice de texto completo (SQLite FTS5) sobre Chunk.conteudo_tratado, mantido por triggers:
+# qualquer gravação em melchior_chunk (process_documents, resolve_antinomias, admin...) já
+# atualiza o índice. Em outros bancos a migração não faz nada e a busca lexical fica desligada.
+
+from django.db import migrations
+
+CREATE_SQL = [
+    # Tabela de conteúdo externo: o texto não é duplicado, só o índice invertido
+    "CREATE VIRTUAL TABLE melchior_chunk_fts USING fts5("
+    " conteudo_tratado, content='melchior_chunk', content_rowid='id',"
+    " tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER melchior_chunk_fts_ai AFTER INSERT ON melchior_chunk BEGIN"
+    " INSERT INTO melchior_chunk_fts(rowid, conteudo_tratado) VALUES (new.id, new.conteudo_tratado); END",
+    "CREATE TRIGGER melchior_chunk_fts_ad AFTER DELETE ON melchior_chunk BEGIN"
+    " INSERT INTO melchior_chunk_fts(melchior_chunk_fts, rowid, conteudo_tratado) VALUES ('delete', old.id, old.conteudo_tratado); END",
+    "CREATE TRIGGER melchior_chunk_fts_au AFTER UPDATE OF conteudo_tratado ON melchior_chunk BEGIN"
+    " INSERT INTO melchior_chunk_fts(melchior_chunk_fts, rowid, conteudo_tratado) VALUES ('delete', old.id, old.conteudo_tratado);"
+    " INSERT INTO melchior_chunk_fts(rowid, conteudo_tratado) VALUES (new.id, new.conteudo_tratado); END",
+    # Indexa os chunks que já existem
+    "INSERT INTO melchior_chunk_fts(melchior_chunk_fts) VALUES ('rebuild')",
+]
+
+DROP_SQL = [
+    "DROP TRIGGER IF EXISTS melchior_chunk_fts_au",
+    "DROP TRIGGER IF EXISTS melchior_chunk_fts_ad",
+    "DROP TRIGGER IF EXISTS melchior_chunk_fts_ai",
+    "DROP TABLE IF EXISTS melchior_chunk_fts",
+]
+
+
+def _run(statements):
+    def run(apps, schema_editor):
+        if schema_editor.connection.vendor != 'sqlite':
+            return
+        for statement in statements:
+            schema_editor.execute(statement)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('melchior', '0007_versao_indice'),
+    ]
+
+    operations = [
+        migrations.RunPython(_run(CREATE_SQL), _run(DROP_SQL)),
+    ]
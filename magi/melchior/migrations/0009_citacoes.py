@@ -0,0 +1,56 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:21
+
+import os
+import re
+
+from django.db import migrations, models
+
+# O nome dos arquivos consolidados começa pelo código da norma (ex.: LE000021948consol.html)
+LEI_COD_FILE_PATTERN = re.compile(r'^([A-Z]+)(\d+)(\d{4})')
+ARTICLE_PATTERN = re.compile(r'^Art\.\s*(\d+)')
+
+
+def preencher_citacoes(apps, schema_editor):
+    # Os documentos inalterados são pulados pelo import_documents --incremental, então o código
+    # da norma é recuperado do nome do arquivo; o número do artigo vem do caminho estrutural
+    Documento = apps.get_model('melchior', 'Documento')
+    Chunk = apps.get_model('melchior', 'Chunk')
+    documentos = []
+    for documento in Documento.objects.filter(lei_cod='').only('id', 'nome_arquivo'):
+        match = LEI_COD_FILE_PATTERN.match(os.path.basename(documento.nome_arquivo))
+        if match:
+            documento.lei_cod = f'{match.group(1)}{int(match.group(2)):05d}{match.group(3)}'
+            documentos.append(documento)
+    Documento.objects.bulk_update(documentos, ['lei_cod'], batch_size=500)
+    chunks = []
+    for chunk in Chunk.objects.exclude(caminho_estrutural='').only('id', 'caminho_estrutural'):
+        match = ARTICLE_PATTERN.match(chunk.caminho_estrutural)
+        if match:
+            chunk.numero_artigo = int(match.group(1))
+            chunks.append(chunk)
+    Chunk.objects.bulk_update(chunks, ['numero_artigo'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('melchior', '0008_chunk_fts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chunk',
+            name='numero_artigo',
+            field=models.PositiveIntegerField(blank=True, help_text='Número do artigo ao qual o chunk pertence (se houver).', null=True),
+        ),
+        migrations.AddField(
+            model_name='documento',
+            name='lei_cod',
+            field=models.CharField(blank=True, db_index=True, default='', help_text='Código da norma (tipo, número e ano).', max_length=30),
+        ),
+        migrations.AddIndex(
+            model_name='chunk',
+            index=models.Index(fields=['documento', 'numero_artigo'], name='melchior_chunk_artigo_idx'),
+        ),
+        migrations.RunPython(preencher_citacoes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,98 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:53
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+# Regras iniciais, no lugar do regex fixo do resolve_antinomias. Os padrões aceitam qualquer
+# caractere onde há acentos, porque parte dos textos importados tem a acentuação corrompida.
+REGRAS_INICIAIS = [
+    {
+        'nome': 'nota-revogado',
+        'descricao': 'Nota de revogação do próprio dispositivo. Ex.: "(Revogado pela Lei nº 10.000/2000)".',
+        'tipo': 'REVOGACAO',
+        'gatilho': '(revogad',
+        'padrao': r'\(revogad[oa]s?\b',
+        'prioridade': 10,
+    },
+    {
+        'nome': 'nota-foi-revogado',
+        'descricao': 'Nota de revogação por extenso. Ex.: "(Esta alínea foi revogada pela Lei nº 10.000/2000)".',
+        'tipo': 'REVOGACAO',
+        'gatilho': '(est',
+        'padrao': r'\(est[ea]\s+[^()]{1,40}?\s+foi\s+revogad[oa]s?\b',
+        'prioridade': 10,
+    },
+    {
+        'nome': 'dispositivo-revogado',
+        'descricao': 'Dispositivo cujo texto é só a revogação, logo após o rótulo. Ex.: "Art. 7º Revogado." ou "§ 2º Revogado pela Lei ...".',
+        'tipo': 'REVOGACAO',
+        'gatilho': 'revogad',
+        'padrao': r'revogad[oa]s?\s*(?:[.;:)\-–]|pel[oa]s?\b|$)',
+        'posicao_maxima': 40,
+        'prioridade': 10,
+    },
+    {
+        'nome': 'nota-revigorado',
+        'descricao': 'Dispositivo revogado e depois revigorado: continua válido. Ex.: "(Revigorado pela Lei nº 10.000/2000)".',
+        'tipo': 'VALIDADE',
+        'gatilho': '(revigorad',
+        'padrao': r'\(revigorad[oa]s?\b',
+        'prioridade': 20,
+    },
+    {
+        'nome': 'disposicoes-em-contrario',
+        'descricao': 'Cláusula final "revogadas as disposições em contrário": não revoga o próprio dispositivo.',
+        'tipo': 'VALIDADE',
+        'gatilho': 'revogadas as disposi',
+        'padrao': r'revogadas\s+as\s+disposi\S*\s+em\s+contr',
+        'prioridade': 0,
+    },
+    {
+        'nome': 'revoga-outra-norma',
+        'descricao': 'O dispositivo revoga outra norma. Ex.: "Fica revogado o Decreto-Lei nº 137/1970".',
+        'tipo': 'VALIDADE',
+        'gatilho': 'fica',
+        'padrao': r'fica(?:m)?\s+(?:\S+\s+){0,3}?revogad[oa]s?\b',
+        'prioridade': 0,
+    },
+]
+
+
+def criar_regras(apps, schema_editor):
+    RegraAntinomia = apps.get_model('melchior', 'RegraAntinomia')
+    for regra in REGRAS_INICIAIS:
+        RegraAntinomia.objects.get_or_create(nome=regra['nome'], defaults=regra)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('melchior', '0009_citacoes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RegraAntinomia',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('nome', models.SlugField(help_text='Identificador da regra (aparece nas estatísticas e no chunk).', max_length=100, unique=True)),
+                ('descricao', models.CharField(blank=True, default='', help_text='O que a regra reconhece, com um exemplo.', max_length=255)),
+                ('tipo', models.CharField(choices=[('REVOGACAO', 'Revogação (invalida o chunk)'), ('VALIDADE', 'Validade (mantém o chunk válido)')], default='REVOGACAO', help_text='Efeito da regra sobre a validade do chunk.', max_length=20)),
+                ('gatilho', models.CharField(help_text='Trecho literal (sem diferença de maiúsculas) em que a regra começa a ser testada.', max_length=100)),
+                ('padrao', models.CharField(help_text='Expressão regular (sem diferença de maiúsculas) testada a partir do gatilho.', max_length=500)),
+                ('posicao_maxima', models.PositiveIntegerField(blank=True, help_text='Se preenchido, o gatilho precisa começar até este caractere do chunk (ex.: logo após o rótulo do artigo).', null=True)),
+                ('prioridade', models.IntegerField(default=0, help_text='Entre as regras que disparam no mesmo chunk, decide a de maior prioridade.')),
+                ('ativa', models.BooleanField(default=True, help_text='Regras inativas não são usadas pelo resolve_antinomias.')),
+                ('acertos', models.PositiveIntegerField(default=0, help_text='Chunks em que a regra disparou na última execução do resolve_antinomias.')),
+            ],
+            options={
+                'ordering': ['-prioridade', 'nome'],
+            },
+        ),
+        migrations.AddField(
+            model_name='chunk',
+            name='regra_antinomia',
+            field=models.ForeignKey(blank=True, help_text='Regra de antinomia que decidiu a validade do chunk na última análise do texto (se alguma disparou).', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='chunks', to='melchior.regraantinomia'),
+        ),
+        migrations.RunPython(criar_regras, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:01
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('melchior', '0010_regras_antinomia'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CitacaoNorma',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tipo', models.CharField(choices=[('CITA', 'Cita'), ('REVOGA', 'Revoga a norma citada'), ('REVOGADO_POR', 'Revogado pela norma citada')], default='CITA', help_text='Relação entre o chunk e a norma citada.', max_length=20)),
+                ('lei_cod', models.CharField(help_text='Código da norma citada (tipo, número e ano).', max_length=30)),
+                ('numero_artigo', models.PositiveIntegerField(blank=True, help_text='Artigo citado; vazio quando a citação é da norma inteira.', null=True)),
+                ('trecho', models.CharField(help_text='Texto da citação (em minúsculas e sem acentos).', max_length=255)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='chunk',
+            index=models.Index(fields=['is_valido_apos_antinomia'], name='melchior_chunk_validade_idx'),
+        ),
+        migrations.AddField(
+            model_name='citacaonorma',
+            name='chunk',
+            field=models.ForeignKey(help_text='Chunk em cujo texto está a citação.', on_delete=django.db.models.deletion.CASCADE, related_name='citacoes', to='melchior.chunk'),
+        ),
+        migrations.AddField(
+            model_name='citacaonorma',
+            name='documento_citado',
+            field=models.ForeignKey(blank=True, help_text='Documento com o código citado, se estiver no acervo (o publicado mais recentemente).', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='citacoes_recebidas', to='melchior.documento'),
+        ),
+        migrations.AddIndex(
+            model_name='citacaonorma',
+            index=models.Index(fields=['lei_cod', 'numero_artigo'], name='melchior_citacao_alvo_idx'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:23
+
+from django.db import migrations, models
+
+from melchior.lexical import recreate_fts_triggers
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('melchior', '0011_citacoes_norma'),
+    ]
+
+    # A coluna NOT NULL recria melchior_chunk no SQLite: os triggers do índice FTS5 são recriados depois,
+    # nos dois sentidos (na reversão, o primeiro RunPython roda depois do RemoveField)
+    operations = [
+        migrations.RunPython(migrations.RunPython.noop, recreate_fts_triggers),
+        migrations.AddField(
+            model_name='chunk',
+            name='revogado_por_citacao',
+            field=models.BooleanField(default=False, help_text='Indica se o chunk foi invalidado pelo grafo de citações entre normas na última execução do resolve_antinomias.'),
+        ),
+        migrations.RunPython(recreate_fts_triggers, migrations.RunPython.noop),
+    ]
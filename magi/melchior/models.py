@@ -1,6 +1,9 @@
 # nerv/magi/melchior/models.py
 
+import re
+
 from django.db import models
+from django.core.exceptions import ValidationError
 from django.core.validators import FileExtensionValidator
 
 class Documento(models.Model):
@@ -64,20 +67,69 @@ class Documento(models.Model):
     )
     # Campo para armazenar o texto completo extraído do documento antes de chunking
     texto_completo_extraido = models.TextField(blank=True, null=True, help_text="Texto completo extraído do documento.")
+    # Fingerprints usados pela importação incremental para pular arquivos e linhas do CSV que não mudaram
+    hash_conteudo = models.CharField(max_length=64, blank=True, default='', help_text="Hash SHA-256 dos bytes do arquivo importado.")
+    hash_metadados = models.CharField(max_length=64, blank=True, default='', help_text="Hash SHA-256 da linha de metadados do CSV.")
+    # Fingerprint do texto (e da estratégia de chunking) na última execução do process_documents
+    hash_texto_chunking = models.CharField(max_length=64, blank=True, default='', help_text="Hash do texto extraído usado no último chunking.")
+    # Código da norma no CSV (ex.: 'LE012341998' = Lei 1234/1998), normalizado por melchior.citations.normalize_lei_cod
+    lei_cod = models.CharField(max_length=30, blank=True, default='', db_index=True, help_text="Código da norma (tipo, número e ano).")
 
     def __str__(self):
         return self.nome_arquivo
 
+class RegraAntinomia(models.Model):
+    """
+    Padrão de texto que decide, no resolve_antinomias, se um chunk se declara revogado.
+
+    O gatilho é um trecho literal procurado de uma vez só junto com os gatilhos das outras regras
+    (melchior.rules); o padrão é uma expressão regular testada a partir da posição do gatilho.
+    """
+    TIPO_CHOICES = [
+        ('REVOGACAO', 'Revogação (invalida o chunk)'),
+        ('VALIDADE', 'Validade (mantém o chunk válido)'),
+    ]
+
+    nome = models.SlugField(max_length=100, unique=True, help_text="Identificador da regra (aparece nas estatísticas e no chunk).")
+    descricao = models.CharField(max_length=255, blank=True, default='', help_text="O que a regra reconhece, com um exemplo.")
+    tipo = models.CharField(max_length=20, choices=TIPO_CHOICES, default='REVOGACAO', help_text="Efeito da regra sobre a validade do chunk.")
+    gatilho = models.CharField(max_length=100, help_text="Trecho literal (sem diferença de maiúsculas) em que a regra começa a ser testada.")
+    padrao = models.CharField(max_length=500, help_text="Expressão regular (sem diferença de maiúsculas) testada a partir do gatilho.")
+    posicao_maxima = models.PositiveIntegerField(null=True, blank=True, help_text="Se preenchido, o gatilho precisa começar até este caractere do chunk (ex.: logo após o rótulo do artigo).")
+    prioridade = models.IntegerField(default=0, help_text="Entre as regras que disparam no mesmo chunk, decide a de maior prioridade.")
+    ativa = models.BooleanField(default=True, help_text="Regras inativas não são usadas pelo resolve_antinomias.")
+    acertos = models.PositiveIntegerField(default=0, help_text="Chunks em que a regra disparou na última execução do resolve_antinomias.")
+
+    class Meta:
+        ordering = ['-prioridade', 'nome']
+
+    def clean(self):
+        try:
+            re.compile(self.padrao, re.IGNORECASE)
+        except re.error as e:
+            raise ValidationError({'padrao': f'Expressão regular inválida: {e}'})
+
+    def __str__(self):
+        return f"{self.nome} ({self.get_tipo_display()})"
+
 class Chunk(models.Model):
     """
     Modelo para armazenar os pedaços de texto (chunks) de cada documento,
     seus embeddings e informações sobre antinomias.
+
+    A tabela tem triggers do índice FTS5 (melchior.lexical.FTS_TRIGGERS): toda migração que a recria
+    no SQLite precisa terminar com RunPython(melchior.lexical.recreate_fts_triggers), como a 0012.
     """
     documento = models.ForeignKey(Documento, on_delete=models.CASCADE, related_name='chunks', help_text="Documento ao qual este chunk pertence.")
     conteudo_original = models.TextField(help_text="O pedaço de texto original do documento.")
     conteudo_tratado = models.TextField(help_text="O pedaço de texto após a aplicação das regras de antinomia.")
     embedding = models.BinaryField(blank=True, null=True, help_text="O vetor de embedding do conteúdo tratado.")
+    # Controle do generate_embeddings incremental: o que foi embedado por último, e com qual modelo
+    hash_embedding = models.CharField(max_length=64, blank=True, default='', help_text="Hash do conteúdo tratado no momento em que o embedding foi gerado.")
+    modelo_embedding = models.CharField(max_length=100, blank=True, default='', help_text="Modelo usado para gerar o embedding armazenado.")
     ordem_no_documento = models.IntegerField(help_text="Ordem do chunk dentro do documento original.")
+    caminho_estrutural = models.CharField(max_length=255, blank=True, default='', help_text="Localização do chunk na estrutura da norma (ex.: 'Art. 5º, §2º, III').")
+    numero_artigo = models.PositiveIntegerField(null=True, blank=True, help_text="Número do artigo ao qual o chunk pertence (se houver).")
     relevancia_antinomia = models.FloatField(default=0.0, help_text="Pontuação para indicar a relevância em relação a antinomias (0 a 1).")
     data_revisao_antinomia = models.DateTimeField(null=True, blank=True, help_text="Data da última revisão manual ou automática da antinomia.")
     # Exemplo de campo para referenciar a norma revogadora, se aplicável
@@ -89,14 +141,128 @@ class Chunk(models.Model):
         related_name='chunks_revogados',
         help_text="Referência a outro chunk que revoga este (se aplicável)."
     )
+    # Invalidação vinda do grafo de citações, desfeita pelo resolve_antinomias quando a revogação some
+    # (inclusive quando o chunk revogador é apagado ou a norma revogadora está fora do acervo)
+    revogado_por_citacao = models.BooleanField(default=False, help_text="Indica se o chunk foi invalidado pelo grafo de citações entre normas na última execução do resolve_antinomias.")
     # Pode-se adicionar um campo booleano para indicar se o chunk foi considerado inválido devido a uma antinomia
     is_valido_apos_antinomia = models.BooleanField(default=True, help_text="Indica se o chunk é válido após a resolução de antinomias.")
+    regra_antinomia = models.ForeignKey(
+        RegraAntinomia,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='chunks',
+        help_text="Regra de antinomia que decidiu a validade do chunk na última análise do texto (se alguma disparou)."
+    )
 
 
     class Meta:
         # Garante que não haverá chunks duplicados para o mesmo documento e ordem
         unique_together = ('documento', 'ordem_no_documento')
         ordering = ['documento', 'ordem_no_documento'] # Ordem padrão para chunks
+        indexes = [
+            # Consulta direta de citações ("art. 12 da Lei 1234/1998")
+            models.Index(fields=['documento', 'numero_artigo'], name='melchior_chunk_artigo_idx'),
+            # Validade já resolvida (resolve_antinomias), consultada pela busca e pelo admin
+            models.Index(fields=['is_valido_apos_antinomia'], name='melchior_chunk_validade_idx'),
+        ]
+
+    def __str__(self):
+        return f"Chunk {self.ordem_no_documento} de {self.documento.nome_arquivo}"
+
+class CitacaoNorma(models.Model):
+    """
+    Aresta do grafo de citações entre normas: um chunk cita uma norma (ou um artigo dela).
+
+    Montado pelo resolve_antinomias a partir do texto de todos os chunks. As citações de revogação
+    invalidam os chunks revogados e preenchem Chunk.revogado_por_chunk.
+    """
+    TIPO_CHOICES = [
+        ('CITA', 'Cita'),
+        ('REVOGA', 'Revoga a norma citada'),
+        ('REVOGADO_POR', 'Revogado pela norma citada'),
+    ]
+
+    chunk = models.ForeignKey(Chunk, on_delete=models.CASCADE, related_name='citacoes', help_text="Chunk em cujo texto está a citação.")
+    tipo = models.CharField(max_length=20, choices=TIPO_CHOICES, default='CITA', help_text="Relação entre o chunk e a norma citada.")
+    lei_cod = models.CharField(max_length=30, help_text="Código da norma citada (tipo, número e ano).")
+    numero_artigo = models.PositiveIntegerField(null=True, blank=True, help_text="Artigo citado; vazio quando a citação é da norma inteira.")
+    documento_citado = models.ForeignKey(
+        Documento,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='citacoes_recebidas',
+        help_text="Documento com o código citado, se estiver no acervo (o publicado mais recentemente)."
+    )
+    trecho = models.CharField(max_length=255, help_text="Texto da citação (em minúsculas e sem acentos).")
+
+    class Meta:
+        indexes = [models.Index(fields=['lei_cod', 'numero_artigo'], name='melchior_citacao_alvo_idx')]
+
+    def __str__(self):
+        artigo = f"art. {self.numero_artigo} da " if self.numero_artigo else ""
+        return f"Chunk {self.chunk_id} {self.get_tipo_display().lower()}: {artigo}{self.lei_cod}"
+
+class ExecucaoEmbedding(models.Model):
+    """
+    Diário de uma execução do generate_embeddings, usado para retomar execuções interrompidas.
+    """
+    MODO_CHOICES = [
+        ('COMPLETO', 'Completo'),
+        ('INCREMENTAL', 'Incremental'),
+        ('FALHAS', 'Reprocessamento de falhas'),
+    ]
+
+    STATUS_CHOICES = [
+        ('EM_ANDAMENTO', 'Em andamento'),
+        ('CONCLUIDA', 'Concluída'),
+    ]
+
+    modo = models.CharField(max_length=20, choices=MODO_CHOICES, help_text="Modo em que o comando foi executado.")
+    modelo_embedding = models.CharField(max_length=100, help_text="Modelo usado para gerar os embeddings.")
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='EM_ANDAMENTO', help_text="Situação da execução.")
+    iniciada_em = models.DateTimeField(auto_now_add=True, help_text="Data e hora de início da execução.")
+    finalizada_em = models.DateTimeField(null=True, blank=True, help_text="Data e hora em que a execução terminou.")
+
+    class Meta:
+        ordering = ['-iniciada_em']
+
+    def __str__(self):
+        return f"Execução {self.id} ({self.get_modo_display()}, {self.get_status_display()})"
+
+class LoteEmbedding(models.Model):
+    """
+    Lote de chunks cujos embeddings foram gravados no ChromaDB (registrado na mesma transação que os hashes).
+    """
+    execucao = models.ForeignKey(ExecucaoEmbedding, on_delete=models.CASCADE, related_name='lotes', help_text="Execução à qual o lote pertence.")
+    chunk_ids = models.JSONField(help_text="Ids dos chunks gravados neste lote.")
+    registrado_em = models.DateTimeField(auto_now_add=True, help_text="Data e hora em que o lote foi gravado.")
+
+    def __str__(self):
+        return f"Lote {self.id} da execução {self.execucao_id} ({len(self.chunk_ids)} chunks)"
+
+class FalhaEmbedding(models.Model):
+    """
+    Chunk cujo embedding falhou em definitivo, para ser reprocessado com --retry-failed.
+    """
+    execucao = models.ForeignKey(ExecucaoEmbedding, on_delete=models.CASCADE, related_name='falhas', help_text="Execução em que a falha ocorreu.")
+    chunk = models.ForeignKey(Chunk, on_delete=models.CASCADE, related_name='falhas_embedding', help_text="Chunk que não pôde ser embedado.")
+    erro = models.TextField(help_text="Mensagem do erro retornado.")
+    registrada_em = models.DateTimeField(auto_now_add=True, help_text="Data e hora em que a falha foi registrada.")
+
+    def __str__(self):
+        return f"Falha no chunk {self.chunk_id} (execução {self.execucao_id})"
+
+class VersaoIndice(models.Model):
+    """
+    Contador global da versão do conteúdo pesquisável (documentos, chunks e validade após antinomias).
+
+    Os comandos que alteram esse conteúdo incrementam a versão, o que invalida as respostas em cache da busca.
+    """
+    versao = models.PositiveIntegerField(default=0, help_text="Número da versão atual do índice.")
+    motivo = models.CharField(max_length=255, blank=True, default='', help_text="O que provocou a última mudança de versão.")
+    atualizada_em = models.DateTimeField(auto_now=True, help_text="Data e hora da última mudança de versão.")
 
     def __str__(self):
-        return f"Chunk {self.ordem_no_documento} de {self.documento.nome_arquivo}"
\ No newline at end of file
+        return f"Versão {self.versao} do índice ({self.motivo})"
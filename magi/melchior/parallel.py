@@ -0,0 +1,44 @@
+# nerv/magi/melchior/parallel.py
+
+"""
+Utilitários para distribuir trabalho CPU-bound dos comandos do Melchior entre processos.
+"""
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+
+def _apply_to_batch(func, items):
+    # Ponto de entrada dos workers: aplica func a um lote de itens de uma vez.
+    return [func(item) for item in items]
+
+
+def ordered_pool_map(func, items, workers, items_per_task=25, max_pending_per_worker=4):
+    """
+    Aplica func a cada item e devolve os resultados na ordem original, à medida que ficam prontos.
+
+    Com workers == 0 roda no próprio processo. Caso contrário, os itens são agrupados em tarefas de
+    items_per_task itens e enviados a um pool de processos, mantendo no máximo
+    workers * max_pending_per_worker tarefas em andamento para que a memória não cresça com o
+    tamanho da entrada. func precisa ser serializável (função de módulo ou functools.partial).
+    """
+    if not workers:
+        for item in items:
+            yield func(item)
+        return
+
+    max_pending = workers * max_pending_per_worker
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) >= items_per_task:
+                pending.append(executor.submit(_apply_to_batch, func, batch))
+                batch = []
+                while len(pending) >= max_pending:
+                    yield from pending.popleft().result()
+        if batch:
+            pending.append(executor.submit(_apply_to_batch, func, batch))
+        while pending:
+            yield from pending.popleft().result()
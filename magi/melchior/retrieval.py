@@ -0,0 +1,210 @@
+# nerv/magi/melchior/retrieval.py
+
+"""
+Recuperação de chunks com filtros para a busca do Melchior.
+
+Os filtros do documento (status, hierarquia, intervalo de datas de publicação) são aplicados
+dentro da busca vetorial, e não depois dela: os backends numpy/IVF só pontuam os chunks
+permitidos, com uma máscara alinhada ao índice que é montada uma vez por combinação de filtros e
+versão do índice (VersaoIndice), e o ChromaDB recebe o filtro de hierarquia no 'where'. A
+validade após antinomias sozinha não monta máscara: quase todos os chunks são válidos, então é
+mais barato deixar os poucos inválidos para a conferência no banco. O que o índice não filtra (ou
+um índice desatualizado em relação ao banco) é conferido no banco, e retrieve() busca mais
+candidatos (dobrando k) até ter k chunks válidos ou esgotar o índice.
+Os chunks voltam com o documento já carregado, em uma única consulta com JOIN.
+
+hybrid_retrieve() soma à busca vetorial a busca lexical (BM25 sobre o índice FTS5) e combina as
+duas listas por reciprocal rank fusion: cada chunk recebe 1 / (RRF_K + posição) de cada lista em
+que aparece, então o que está bem colocado nas duas sobe, sem precisar calibrar os scores.
+ahybrid_retrieve() faz o mesmo para as views assíncronas, com as duas buscas em paralelo.
+"""
+
+import asyncio
+import inspect
+from dataclasses import dataclass
+
+import numpy as np
+from django.conf import settings
+from django.utils.dateparse import parse_date
+
+from melchior.answer_cache import current_index_version
+from melchior.lexical import LexicalStore
+from melchior.models import Chunk, Documento
+from melchior.services import run_blocking
+
+# Limite de candidatos por consulta ao índice durante o over-fetch
+DEFAULT_MAX_FETCH = 200
+# Candidatos de cada busca levados à fusão
+DEFAULT_HYBRID_CANDIDATES = 20
+RRF_K = 60
+
+
+@dataclass
+class SearchFilters:
+    """
+    Filtros da busca. Listas vazias e datas None não restringem nada.
+    """
+    status: tuple = ()
+    hierarquias: tuple = ()
+    data_inicio: object = None
+    data_fim: object = None
+    apenas_validos: bool = True
+
+    def __post_init__(self):
+        self._allowed_ids = None
+        self._mask_key = None
+
+    @classmethod
+    def from_query_params(cls, params):
+        """
+        Lê os filtros dos parâmetros da URL: status e hierarquia (repetíveis), data_inicio e data_fim (AAAA-MM-DD).
+        """
+        status = tuple(value for value in params.getlist('status') if value)
+        hierarquias = tuple(value for value in params.getlist('hierarquia') if value)
+        valid_status = dict(Documento.STATUS_DOCUMENTO_CHOICES)
+        valid_hierarquias = dict(Documento.HIERARQUIA_NORMA_CHOICES)
+        for value in status:
+            if value not in valid_status:
+                raise ValueError(f"Status desconhecido: '{value}'.")
+        for value in hierarquias:
+            if value not in valid_hierarquias:
+                raise ValueError(f"Hierarquia desconhecida: '{value}'.")
+        dates = {}
+        for name in ('data_inicio', 'data_fim'):
+            value = params.get(name, '').strip()
+            dates[name] = parse_date(value) if value else None
+            if value and dates[name] is None:
+                raise ValueError(f"Data inválida em '{name}': '{value}'. Use o formato AAAA-MM-DD.")
+        return cls(status=status, hierarquias=hierarquias, **dates)
+
+    def chunk_queryset(self):
+        queryset = Chunk.objects.all()
+        if self.apenas_validos:
+            queryset = queryset.filter(is_valido_apos_antinomia=True)
+        if self.status:
+            queryset = queryset.filter(documento__status__in=self.status)
+        if self.hierarquias:
+            queryset = queryset.filter(documento__hierarquia__in=self.hierarquias)
+        if self.data_inicio:
+            queryset = queryset.filter(documento__data_publicacao__gte=self.data_inicio)
+        if self.data_fim:
+            queryset = queryset.filter(documento__data_publicacao__lte=self.data_fim)
+        return queryset
+
+    @property
+    def restricts_documents(self):
+        """
+        Há filtro por atributo do documento? Só então os backends numpy/IVF montam a máscara do índice.
+        """
+        return bool(self.status or self.hierarquias or self.data_inicio or self.data_fim)
+
+    def mask_key(self):
+        """
+        Chave da máscara do índice para estes filtros: muda quando o banco é re-importado, re-chunkado
+        ou tem as antinomias re-resolvidas (a versão do índice, como no cache de respostas).
+        """
+        if self._mask_key is None:
+            self._mask_key = (self.status, self.hierarquias, self.data_inicio, self.data_fim, self.apenas_validos,
+                              current_index_version())
+        return self._mask_key
+
+    def allowed_ids(self):
+        """
+        Ids (ordenados) dos chunks que passam nos filtros, calculados uma vez por objeto.
+        """
+        if self._allowed_ids is None:
+            ids = self.chunk_queryset().order_by('id').values_list('id', flat=True)
+            self._allowed_ids = np.fromiter(ids, dtype=np.int64)
+        return self._allowed_ids
+
+    def chroma_where(self):
+        # Só a hierarquia está gravada nos metadados de todas as coleções geradas pelo generate_embeddings;
+        # o restante é conferido no banco por retrieve()
+        if not self.hierarquias:
+            return None
+        return {'documento_hierarquia': {'$in': list(self.hierarquias)}}
+
+    def as_query_params(self):
+        return {
+            'status': list(self.status),
+            'hierarquia': list(self.hierarquias),
+            'data_inicio': self.data_inicio.isoformat() if self.data_inicio else '',
+            'data_fim': self.data_fim.isoformat() if self.data_fim else '',
+        }
+
+
+def retrieve(store, query_vector, k, filters=None, max_fetch=None):
+    """
+    Devolve [(chunk, score)] com os k chunks mais similares que passam nos filtros, do mais para o
+    menos similar, com chunk.documento já carregado. Para o LexicalStore, query_vector é o texto da pergunta.
+    """
+    filters = filters or SearchFilters()
+    max_fetch = max(k, max_fetch or getattr(settings, 'MELCHIOR_MAX_FETCH', DEFAULT_MAX_FETCH))
+    chunks = {}
+    checked = set()
+    fetch_k = k
+    while True:
+        hits = store.search(query_vector, fetch_k, filters)
+        new_ids = [chunk_id for chunk_id, _score in hits if chunk_id not in checked]
+        checked.update(new_ids)
+        if new_ids:
+            chunks.update(filters.chunk_queryset().select_related('documento').in_bulk(new_ids))
+        results = [(chunks[chunk_id], score) for chunk_id, score in hits if chunk_id in chunks]
+        # Para quando há k válidos, quando o índice não tem mais candidatos ou no limite de candidatos
+        if len(results) >= k or len(hits) < fetch_k or fetch_k >= max_fetch:
+            return results[:k]
+        fetch_k = min(fetch_k * 2, max_fetch)
+
+
+def reciprocal_rank_fusion(rankings, k=RRF_K):
+    """
+    Combina listas de ids (cada uma do mais para o menos relevante) em [(id, score RRF)], do maior para o menor.
+    """
+    scores = {}
+    for ranking in rankings:
+        for position, item in enumerate(ranking, start=1):
+            scores[item] = scores.get(item, 0.0) + 1.0 / (k + position)
+    # sorted é estável: nos empates vale a ordem de aparição (a busca vetorial vem primeiro)
+    return sorted(scores.items(), key=lambda entry: -entry[1])
+
+
+def _hybrid_candidates(k, candidates):
+    return max(k, candidates or getattr(settings, 'MELCHIOR_HYBRID_CANDIDATES', DEFAULT_HYBRID_CANDIDATES))
+
+
+def hybrid_retrieve(store, query, query_vector, k, filters=None, candidates=None):
+    """
+    Busca vetorial + lexical com os mesmos filtros, fundidas por RRF. Devolve [(chunk, score RRF)].
+    """
+    candidates = _hybrid_candidates(k, candidates)
+    vector_results = retrieve(store, query_vector, candidates, filters)
+    lexical_results = retrieve(LexicalStore(), query, candidates, filters)
+    return _fuse(vector_results, lexical_results, k)
+
+
+async def ahybrid_retrieve(store, query, query_vector, k, filters=None, candidates=None):
+    """
+    Versão assíncrona de hybrid_retrieve(): as duas buscas rodam ao mesmo tempo no pool de threads
+    (melchior.services.run_blocking). query_vector pode ser um awaitable, como o embedding da
+    pergunta ainda em andamento: a busca lexical não depende dele e começa antes.
+    """
+    candidates = _hybrid_candidates(k, candidates)
+    filters = filters or SearchFilters()
+    lexical = asyncio.ensure_future(run_blocking(retrieve, LexicalStore(), query, candidates, filters))
+    try:
+        if inspect.isawaitable(query_vector):
+            query_vector = await query_vector
+        vector_results = await run_blocking(retrieve, store, query_vector, candidates, filters)
+    except BaseException:
+        lexical.cancel()
+        raise
+    return _fuse(vector_results, await lexical, k)
+
+
+def _fuse(vector_results, lexical_results, k):
+    chunks = {chunk.id: chunk for chunk, _score in vector_results + lexical_results}
+    fused = reciprocal_rank_fusion([
+        [chunk.id for chunk, _score in vector_results],
+        [chunk.id for chunk, _score in lexical_results],
+    ])
+    return [(chunks[chunk_id], score) for chunk_id, score in fused[:k]]
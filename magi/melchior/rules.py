@@ -0,0 +1,141 @@
+# nerv/magi/melchior/rules.py
+
+"""
+Motor das regras de antinomia (RegraAntinomia) usado pelo resolve_antinomias.
+
+Os gatilhos de todas as regras são compilados em uma única expressão (uma alternância de
+literais), que percorre o texto do chunk uma vez só e para em cada posição onde algum gatilho
+começa; a busca continua um caractere depois de cada parada, para não perder gatilhos
+sobrepostos. Só nessas posições o padrão de cada regra daquele gatilho é testado, ancorado
+(pattern.match(texto, posição)). É o papel de um autômato Aho-Corasick, com o módulo re da
+biblioteca padrão. A varredura é feita no texto em minúsculas, sem IGNORECASE, porque só assim
+o re pula direto para os primeiros caracteres possíveis dos gatilhos.
+
+Cada disparo guarda a regra e o trecho; entre as regras disparadas, decide a de maior
+prioridade (em empate, a que aparece primeiro no texto).
+"""
+
+import re
+from dataclasses import dataclass
+
+REVOGACAO = 'REVOGACAO'
+VALIDADE = 'VALIDADE'
+
+
+@dataclass(frozen=True)
+class Rule:
+    """
+    Cópia de uma RegraAntinomia, sem ORM, para poder ser enviada a outros processos.
+    """
+    nome: str
+    tipo: str
+    gatilho: str
+    padrao: str
+    posicao_maxima: int = None
+    prioridade: int = 0
+
+    @classmethod
+    def from_model(cls, regra):
+        return cls(regra.nome, regra.tipo, regra.gatilho, regra.padrao, regra.posicao_maxima, regra.prioridade)
+
+    @property
+    def invalida(self):
+        return self.tipo == REVOGACAO
+
+
+@dataclass(frozen=True)
+class Hit:
+    rule: Rule
+    start: int
+    end: int
+
+
+@dataclass(frozen=True)
+class Decision:
+    """
+    Regra que decidiu a validade do chunk e todos os disparos no texto.
+    """
+    rule: Rule
+    hits: tuple
+
+    @property
+    def fired(self):
+        # Nomes das regras que dispararam, na ordem do primeiro disparo
+        return tuple(dict.fromkeys(hit.rule.nome for hit in self.hits))
+
+
+class RuleEngine:
+
+    def __init__(self, rules):
+        self.rules = tuple(rules)
+        self._by_trigger = {}
+        for rule in self.rules:
+            if not rule.gatilho:
+                raise ValueError(f'Regra "{rule.nome}" sem gatilho.')
+            try:
+                pattern = re.compile(rule.padrao, re.IGNORECASE)
+            except re.error as e:
+                raise ValueError(f'Padrão inválido na regra "{rule.nome}": {e}') from e
+            self._by_trigger.setdefault(rule.gatilho.lower(), []).append((rule, pattern))
+        self.triggers = tuple(sorted(self._by_trigger, key=len, reverse=True))
+        # Na alternância vence o primeiro gatilho que casa: com os mais longos antes, o grupo traz o maior
+        # gatilho que começa na posição, e os menores que também começam ali são prefixos dele
+        self._prefixes = {
+            trigger: [other for other in self.triggers if trigger.startswith(other)]
+            for trigger in self.triggers
+        }
+        alternation = '|'.join(re.escape(trigger) for trigger in self.triggers)
+        self._scanner = re.compile(alternation) if self.triggers else None
+        self._scanner_ignorecase = re.compile(alternation, re.IGNORECASE) if self.triggers else None
+
+    @classmethod
+    def from_db(cls):
+        from melchior.models import RegraAntinomia
+        return cls(Rule.from_model(regra) for regra in RegraAntinomia.objects.filter(ativa=True))
+
+    def scan(self, text):
+        """
+        Todos os disparos das regras no texto, em ordem de posição.
+        """
+        if self._scanner is None:
+            return []
+        hits = []
+        lowered = text.lower()
+        scanner = self._scanner
+        if len(lowered) != len(text):
+            # Alguns caracteres mudam de tamanho em minúsculas e deslocariam as posições
+            lowered, scanner = text, self._scanner_ignorecase
+        found = scanner.search(lowered)
+        while found is not None:
+            position = found.start()
+            for trigger in self._prefixes.get(found.group().lower(), ()):
+                for rule, pattern in self._by_trigger[trigger]:
+                    if rule.posicao_maxima is not None and position > rule.posicao_maxima:
+                        continue
+                    match = pattern.match(text, position)
+                    if match:
+                        hits.append(Hit(rule, position, match.end()))
+            found = scanner.search(lowered, position + 1)
+        return hits
+
+    def decide(self, text):
+        """
+        Decision com a regra de maior prioridade entre as que dispararam, ou None.
+        """
+        hits = self.scan(text)
+        if not hits:
+            return None
+        best = max(hits, key=lambda hit: hit.rule.prioridade)
+        return Decision(best.rule, tuple(hits))
+
+    def evaluate(self, rows):
+        """
+        Recebe [(id, texto)] e devolve [(id, nome da regra decisiva, nomes das regras disparadas)]
+        dos textos em que alguma regra disparou.
+        """
+        results = []
+        for row_id, text in rows:
+            decision = self.decide(text)
+            if decision is not None:
+                results.append((row_id, decision.rule.nome, decision.fired))
+        return results
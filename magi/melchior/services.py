@@ -0,0 +1,196 @@
+# nerv/magi/melchior/services.py
+
+"""
+Clientes externos da recuperação do Melchior: Google AI Studio (genai) e ChromaDB.
+
+Nada aqui é criado na importação. Cada cliente é montado no primeiro uso e reaproveitado pelo
+resto do processo (requisições da busca e comandos de management), então 'manage.py check', a
+resolução de URLs e os testes não importam o SDK do Gemini nem abrem o ChromaDB, e a falta da
+GOOGLE_API_KEY só é acusada por quem de fato chama a API. Com MELCHIOR_WARM_UP, o wsgi.py e o
+asgi.py chamam warm_up_process() para que a primeira requisição de cada worker não pague esse custo.
+Os clientes nunca atravessam um fork: o processo filho começa sem nenhum (os do gRPC e as threads
+do pool não sobrevivem ao fork).
+
+As views assíncronas rodam o trabalho bloqueante (ORM, índice vetorial, caches em disco) com
+run_blocking(), em um pool de threads limitado por MELCHIOR_ASYNC_WORKERS: o event loop nunca
+bloqueia e o número de conexões ao banco abertas pelas buscas não cresce com a carga.
+"""
+
+import asyncio
+import functools
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import close_old_connections
+
+CHROMA_COLLECTION_NAME = 'melchior_chunks'
+DEFAULT_ASYNC_WORKERS = 8
+
+_lock = threading.RLock()
+_genai = None
+_chroma_clients = {}
+_vector_store = None
+_executor = None
+_warm_up_after_fork_registered = False
+
+logger = logging.getLogger(__name__)
+
+
+def _reset_after_fork():
+    # No filho: descarta o que veio do pai sem tocar nos objetos (o lock pode ter sido copiado travado)
+    global _lock, _genai, _vector_store, _executor
+    _lock = threading.RLock()
+    _genai = None
+    _chroma_clients.clear()
+    _vector_store = None
+    _executor = None
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def chroma_db_path():
+    return getattr(settings, 'MELCHIOR_CHROMA_DB_PATH', os.path.join(settings.BASE_DIR, 'chroma_db'))
+
+
+def google_api_key():
+    api_key = os.getenv('GOOGLE_API_KEY')
+    if not api_key:
+        raise ImproperlyConfigured(
+            "Erro: A chave da API do Google AI Studio (GOOGLE_API_KEY) não foi encontrada nas variáveis de ambiente. "
+            "Certifique-se de que seu arquivo .env está configurado corretamente e é carregado no settings.py."
+        )
+    return api_key
+
+
+def get_genai():
+    """
+    Devolve o módulo google.generativeai já configurado com a chave da API.
+    """
+    global _genai
+    with _lock:
+        if _genai is None:
+            import google.generativeai as genai
+            genai.configure(api_key=google_api_key())
+            _genai = genai
+        return _genai
+
+
+def get_chroma_client(path=None):
+    """
+    Cliente persistente do ChromaDB, um por diretório.
+    """
+    path = str(path or chroma_db_path())
+    with _lock:
+        if path not in _chroma_clients:
+            import chromadb
+            _chroma_clients[path] = chromadb.PersistentClient(path=path)
+        return _chroma_clients[path]
+
+
+def get_vector_store():
+    """
+    Backend vetorial da busca (MELCHIOR_VECTOR_BACKEND), compartilhado por todas as requisições do processo.
+    """
+    global _vector_store
+    with _lock:
+        if _vector_store is None:
+            from melchior.vectorstore import get_vector_store as build_vector_store
+            _vector_store = build_vector_store()
+        return _vector_store
+
+
+def get_executor():
+    """
+    Pool de threads das views assíncronas, com MELCHIOR_ASYNC_WORKERS threads.
+    """
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'MELCHIOR_ASYNC_WORKERS', DEFAULT_ASYNC_WORKERS),
+                thread_name_prefix='melchior',
+            )
+        return _executor
+
+
+def _in_worker(func, *args, **kwargs):
+    try:
+        return func(*args, **kwargs)
+    finally:
+        # Como ao fim de uma requisição: fecha a conexão da thread se CONN_MAX_AGE expirou ou se ela falhou
+        close_old_connections()
+
+
+async def run_blocking(func, *args, **kwargs):
+    """
+    Executa func(*args, **kwargs) no pool de threads e aguarda o resultado sem bloquear o event loop.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), functools.partial(_in_worker, func, *args, **kwargs))
+
+
+def warm_up(stdout=None):
+    """
+    Cria os clientes e abre o índice vetorial antes da primeira requisição. Devolve o tempo gasto em cada etapa.
+    """
+    timings = {}
+    start = time.perf_counter()
+    get_genai()
+    timings['genai'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    get_vector_store().warm_up()
+    timings['vector_store'] = time.perf_counter() - start
+
+    if stdout is not None:
+        for step, elapsed in timings.items():
+            stdout.write(f'{step}: {elapsed * 1000:.0f}ms')
+    return timings
+
+
+def _warm_up_in_background():
+    def run():
+        try:
+            warm_up()
+        except Exception:
+            logger.exception('Falha no warm-up do processo %s.', os.getpid())
+
+    threading.Thread(target=run, name='melchior-warm-up', daemon=True).start()
+
+
+def warm_up_process():
+    """
+    Warm-up dos processos web, se MELCHIOR_WARM_UP estiver ligado: roda no processo atual e em cada
+    worker criado depois por fork, como os de um servidor que carrega a aplicação antes de criar os
+    workers (gunicorn --preload). No worker, o warm-up roda em segundo plano, depois que os clientes
+    herdados foram descartados; uma requisição que chegue antes só espera pelo mesmo cliente.
+    """
+    global _warm_up_after_fork_registered
+    if not getattr(settings, 'MELCHIOR_WARM_UP', False):
+        return
+    with _lock:
+        if not _warm_up_after_fork_registered:
+            # Registrado depois de _reset_after_fork, então roda depois dele
+            os.register_at_fork(after_in_child=_warm_up_in_background)
+            _warm_up_after_fork_registered = True
+    warm_up()
+
+
+def reset():
+    """
+    Descarta os clientes criados (ex.: depois de um fork ou entre testes).
+    """
+    global _genai, _vector_store, _executor
+    with _lock:
+        _genai = None
+        _chroma_clients.clear()
+        _vector_store = None
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+            _executor = None
@@ -1,3 +1,1311 @@
-from django.test import TestCase
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from asgiref.sync import async_to_sync, sync_to_async
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.storage import FileSystemStorage
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.http import QueryDict
+from django.test import (
+    AsyncRequestFactory, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings,
+)
+
+from melchior import services, views
+from melchior.answer_cache import AnswerCache, bump_index_version, current_index_version, prompt_version
+from melchior.chunking import (
+    chunk_text, chunk_text_by_legal_articles, split_article_hierarchically, split_legal_articles,
+    split_legal_articles_legacy,
+)
+from melchior.citations import Citation, extract_references, lookup_article, normalize_lei_cod, parse_citation
+from melchior.context import Passage, best_span, pack_context
+from melchior.embedding_cache import EmbeddingCache, QueryEmbeddingCache, vector_to_bytes
+from melchior.embeddings import AdaptiveBatchSizer, EmbeddingPipeline, FakeEmbeddingProvider
+from melchior.extractors import EXTRACTORS, REFERENCE_EXTRACTOR, get_extractor
+from melchior.generation import BaseAnswerModel, FakeAnswerModel, get_answer_model
+from melchior.lexical import FTS_TRIGGERS, LexicalStore, fts_match_expression, matching_documento_ids
+from melchior.models import (
+    CitacaoNorma, Chunk, Documento, ExecucaoEmbedding, FalhaEmbedding, LoteEmbedding, RegraAntinomia,
+)
+from melchior.retrieval import SearchFilters, reciprocal_rank_fusion, retrieve
+from melchior.rules import Rule, RuleEngine
+from melchior.vectorstore import IvfVectorStore, NumpyVectorStore, build_ivf_index, build_numpy_index
+
+CORPUS_DIR = os.path.join(settings.BASE_DIR, 'documentos_leis')
+EXTRACTOR_FIXTURES = (
+    '1948/LE000421948consol.html',
+    '1978/DL000021978consol.html',
+    '1978/LE029541978consol.html',
+    '1990/LOM.html',
+    '2005/LE097532005consol.html',
+    '2014/RE001062014consol.html',
+    '2019/LE129752019consol.html',
+)
+
+
+class AllowedIdsFilter:
+    """
+    Filtro de busca sem banco: só os ids informados passam.
+    """
+    restricts_documents = True
+
+    def __init__(self, ids):
+        self.ids = np.array(sorted(ids), dtype=np.int64)
+
+    def mask_key(self):
+        return tuple(self.ids)
+
+    def allowed_ids(self):
+        return self.ids
+
+
+class ExtractorTests(SimpleTestCase):
+
+    def test_ignora_script_style_e_comentarios(self):
+        html_content = (
+            '<html><head><title>Lei</title><style>p {color: red}</style></head>'
+            '<body><script>var x = "Art. 1";</script><!-- nota -->'
+            '<p>Art. 1&ordm;&nbsp;Fica&#32;criado &amp; mantido.</p><script/>Fim</body></html>'
+        )
+        for name in EXTRACTORS:
+            with self.subTest(extractor=name):
+                self.assertEqual(get_extractor(name).extract(html_content), 'LeiArt. 1o Fica criado & mantido.Fim')
+
+    def test_extrator_desconhecido(self):
+        with self.assertRaises(ValueError):
+            get_extractor('inexistente')
+
+    @unittest.skipUnless(os.path.isdir(CORPUS_DIR), 'Corpus documentos_leis/ não disponível.')
+    def test_extratores_equivalentes_a_referencia(self):
+        # Amostra fixa do corpus (comentários, <script>, entidades numéricas, arquivos grandes e a LOM);
+        # a comparação no corpus inteiro fica no benchmark_extractors
+        reference = get_extractor(REFERENCE_EXTRACTOR)
+        others = [get_extractor(name) for name in EXTRACTORS if name != REFERENCE_EXTRACTOR]
+        for name in EXTRACTOR_FIXTURES:
+            with open(os.path.join(CORPUS_DIR, name), 'r', encoding='utf-8', errors='replace') as f:
+                html_content = f.read()
+            expected = reference.extract(html_content)
+            for extractor in others:
+                with self.subTest(arquivo=name, extractor=extractor.name):
+                    self.assertEqual(extractor.extract(html_content), expected)
+
+
+class LegalArticleSplitterTests(SimpleTestCase):
+
+    def test_equivalente_ao_regex_original(self):
+        samples = [
+            '',
+            'Texto sem artigos.',
+            'Preâmbulo. Art. 1º Fica criado. Art. 2o Revogam-se as disposições. ART.3 Fim.',
+            'Art. 1 Art. 2 art.3',
+            'Art. 5 um\n\xa0 Art. 6º dois Cart. 7 três',
+            'Art. 10. Texto com Art. sem número e Art.\n 11 com quebra.',
+        ]
+        for text in samples:
+            with self.subTest(text=text):
+                self.assertEqual(split_legal_articles(text), split_legal_articles_legacy(text))
+
+    def test_fallback_para_chunk_unico(self):
+        self.assertEqual(chunk_text_by_legal_articles('  Sem artigos.  '), (['Sem artigos.'], True))
+        self.assertEqual(chunk_text_by_legal_articles('   '), ([], True))
+        self.assertEqual(chunk_text_by_legal_articles('Art. 1º A. Art. 2º B.'), (['Art. 1º A.', 'Art. 2º B.'], False))
+
+
+class HierarchicalChunkerTests(SimpleTestCase):
+    ARTIGO = (
+        'Art. 5o Os loteamentos deverão atender: I - área mínima de 360 m2; II - frente de 12 m, '
+        'conforme o § 2o do art. 3o; III - as seguintes condições: a) arruamento; b) drenagem; c) iluminação. '
+        '§ 1o O disposto no inciso I não se aplica a conjuntos. § 2o Casos omissos: I - decisão do Executivo; '
+        'II - recurso ao Conselho.'
+    )
+
+    def test_artigo_pequeno_vira_um_chunk(self):
+        self.assertEqual(split_article_hierarchically(self.ARTIGO, 1000), [(self.ARTIGO, 'Art. 5º')])
+
+    def test_respeita_orcamento_e_preserva_o_texto(self):
+        for max_chars in (150, 60, 30):
+            with self.subTest(max_chars=max_chars):
+                chunks = split_article_hierarchically(self.ARTIGO, max_chars)
+                self.assertTrue(all(len(content) <= max_chars for content, _path in chunks))
+                self.assertEqual(' '.join(content for content, _path in chunks).split(), self.ARTIGO.split())
+
+    def test_caminhos_estruturais(self):
+        paths = [path for _content, path in split_article_hierarchically(self.ARTIGO, 60)]
+        self.assertIn('Art. 5º, I', paths)
+        self.assertIn('Art. 5º, III, c)', paths)
+        self.assertIn('Art. 5º, §2º, II', paths)
+        # "§ 2o do art. 3o" é referência cruzada, não um novo parágrafo
+        self.assertEqual(paths.count('Art. 5º, §2º'), 1)
+
+    def test_estrategia_artigos_preserva_chunks(self):
+        text = 'Preâmbulo. Art. 1º Fica criado. Art. 12 Revogam-se as disposições em contrário.'
+        chunks, usou_fallback = chunk_text(text, 'artigos')
+        self.assertFalse(usou_fallback)
+        self.assertEqual(chunks, [('Art. 1º Fica criado.', 'Art. 1º'), ('Art. 12 Revogam-se as disposições em contrário.', 'Art. 12')])
+
+
+class EmbeddingPipelineTests(SimpleTestCase):
+    TEXTS = [f'Art. {i}º Texto {i}.' for i in range(200)]
+
+    def _run(self, provider, **kwargs):
+        pipeline = EmbeddingPipeline(provider, workers=4, sizer=AdaptiveBatchSizer(initial=16, maximum=32),
+                                     backoff_base=0.001, **kwargs)
+        return pipeline, list(pipeline.run(enumerate(self.TEXTS)))
+
+    def test_erros_passageiros_sao_repetidos(self):
+        provider = FakeEmbeddingProvider(dimension=8, failure_rate=0.3, seed=1)
+        pipeline, results = self._run(provider, max_retries=20)
+        vectors = {key: vector for result in results for key, vector in zip(result.keys, result.vectors)}
+        self.assertTrue(all(result.ok for result in results))
+        self.assertEqual(sorted(vectors), list(range(len(self.TEXTS))))
+        self.assertEqual(vectors[7], provider.vector(self.TEXTS[7]))
+        self.assertGreater(pipeline.stats['repeticoes'], 0)
+
+    def test_lote_com_falha_e_dividido_ate_isolar_o_item(self):
+        provider = FakeEmbeddingProvider(dimension=8, poison=('Texto 42.',))
+        pipeline, results = self._run(provider)
+        failed = [key for result in results if not result.ok for key in result.keys]
+        embedded = [key for result in results if result.ok for key in result.keys]
+        self.assertEqual(failed, [42])
+        self.assertEqual(sorted(embedded), [i for i in range(len(self.TEXTS)) if i != 42])
+        self.assertGreater(pipeline.stats['divisoes'], 0)
+
+    def test_repeticoes_esgotadas_falham_sem_dividir_o_lote(self):
+        provider = FakeEmbeddingProvider(dimension=8, failure_rate=1.0)
+        pipeline, results = self._run(provider, max_retries=2)
+        self.assertFalse(any(result.ok for result in results))
+        self.assertEqual(sorted(key for result in results for key in result.keys), list(range(len(self.TEXTS))))
+        self.assertEqual(pipeline.stats['divisoes'], 0)
+        self.assertEqual(pipeline.stats['requisicoes'], 2 * len(results))
+
+    def test_tamanho_do_lote_se_adapta(self):
+        sizer = AdaptiveBatchSizer(initial=40, maximum=100, target_latency=1.0)
+        sizer.record_success(0.5)
+        self.assertEqual(sizer.size, 44)
+        sizer.record_success(2.0)
+        self.assertEqual(sizer.size, 22)
+        for _ in range(10):
+            sizer.record_failure()
+        self.assertEqual(sizer.size, 1)
+
+
+class EmbeddingCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'cache.sqlite3')
+
+    def test_chave_usa_modelo_tarefa_e_texto_normalizado(self):
+        cache = EmbeddingCache(self.path)
+        self.addCleanup(cache.close)
+        cache.put('m1', 'retrieval_document', 'Revogam-se  as disposições\nem contrário.', [0.5, -1.0])
+        self.assertEqual(cache.get('m1', 'RETRIEVAL_DOCUMENT', 'Revogam-se as disposições em contrário. '), [0.5, -1.0])
+        self.assertIsNone(cache.get('m2', 'retrieval_document', 'Revogam-se as disposições em contrário.'))
+        self.assertIsNone(cache.get('m1', 'retrieval_query', 'Revogam-se as disposições em contrário.'))
+        self.assertEqual((cache.stats['hits'], cache.stats['misses']), (1, 2))
+
+    def test_descarta_os_menos_usados_ao_passar_do_limite(self):
+        cache = EmbeddingCache(self.path, max_bytes=10 * 8 * 4)  # 10 vetores de 8 floats
+        self.addCleanup(cache.close)
+        for i in range(10):
+            cache.put('m', 't', f'texto {i}', [float(i)] * 8)
+        cache.get('m', 't', 'texto 0')  # passa a ser o mais recente
+        cache.put('m', 't', 'texto 10', [10.0] * 8)
+        self.assertLessEqual(cache.size_bytes, 10 * 8 * 4)
+        self.assertIsNotNone(cache.get('m', 't', 'texto 0'))
+        self.assertIsNone(cache.get('m', 't', 'texto 1'))
+
+    def test_acertos_gravam_usado_em_em_lote(self):
+        cache = EmbeddingCache(self.path, touch_batch_size=3)
+        self.addCleanup(cache.close)
+        cache.put_many('m', 't', ['a', 'b', 'c'], [[1.0], [2.0], [3.0]])
+
+        def used_at():
+            connection = sqlite3.connect(self.path)
+            try:
+                return dict(connection.execute('SELECT chave, usado_em FROM embeddings'))
+            finally:
+                connection.close()
+
+        before = used_at()
+        cache.get('m', 't', 'a')
+        cache.get('m', 't', 'b')
+        cache.get('m', 't', 'a')
+        self.assertEqual(used_at(), before)
+        cache.get('m', 't', 'c')
+        self.assertTrue(all(after > before[key] for key, after in used_at().items()))
+
+    def test_arquivo_travado_conta_como_falta(self):
+        cache = EmbeddingCache(self.path)
+        self.addCleanup(cache.close)
+        cache.put('m', 't', 'a', [1.0])
+        with mock.patch.object(cache, '_connection') as connection:
+            connection.execute.side_effect = sqlite3.OperationalError('database is locked')
+            self.assertIsNone(cache.get('m', 't', 'a'))
+        self.assertEqual((cache.stats['misses'], cache.stats['travados']), (1, 1))
+        self.assertEqual(cache.get('m', 't', 'a'), [1.0])
+
+    def test_gravacao_com_arquivo_travado_e_pulada(self):
+        cache = EmbeddingCache(self.path)
+        self.addCleanup(cache.close)
+        cache.put('m', 't', 'a', [1.0])
+        size = cache.size_bytes
+        # Outro processo (ex.: o generate_embeddings) com o lock de escrita do arquivo
+        other = sqlite3.connect(self.path, isolation_level=None)
+        self.addCleanup(other.close)
+        other.execute('BEGIN IMMEDIATE')
+        cache._connection.execute('PRAGMA busy_timeout = 0')
+        cache.put('m', 't', 'b', [2.0])
+        self.assertEqual((cache.stats['travados'], cache.stats['gravados'], cache.size_bytes), (1, 1, size))
+        other.execute('ROLLBACK')
+
+        cache.put('m', 't', 'c', [3.0])
+        self.assertEqual(cache.get('m', 't', 'c'), [3.0])
+        self.assertIsNone(cache.get('m', 't', 'b'))
+        self.assertEqual((cache.stats['gravados'], cache.size_bytes), (2, 2 * size))
+
+    def test_pipeline_nao_reembeda_textos_em_cache(self):
+        cache = EmbeddingCache(self.path)
+        self.addCleanup(cache.close)
+        provider = FakeEmbeddingProvider(dimension=8)
+        texts = ['Art. 1º A.', 'Art. 2º B.', 'Art. 1º A.', 'Art. 3º C.']
+        list(EmbeddingPipeline(provider, workers=2, cache=cache).run(enumerate(texts[:2])))
+        pipeline = EmbeddingPipeline(provider, workers=2, cache=cache)
+        results = list(pipeline.run(enumerate(texts)))
+        self.assertEqual(pipeline.stats['itens'], 1)
+        self.assertEqual(sorted(key for result in results if result.cached for key in result.keys), [0, 1, 2])
+
+
+class NumpyVectorStoreTests(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        provider = FakeEmbeddingProvider(dimension=16)
+        self.vectors = {chunk_id: provider.vector(f'chunk {chunk_id}') for chunk_id in range(100, 400)}
+        rows = [(chunk_id, vector_to_bytes(vector)) for chunk_id, vector in self.vectors.items()]
+        build_numpy_index(lambda: iter(rows), self.directory, 16, 'fake-16')
+
+    def test_top_k_igual_a_forca_bruta(self):
+        store = NumpyVectorStore(self.directory)
+        query = self.vectors[250]
+        expected = sorted(self.vectors, key=lambda chunk_id: -sum(a * b for a, b in zip(query, self.vectors[chunk_id])))[:7]
+        self.assertEqual([chunk_id for chunk_id, _score in store.search(query, 7)], expected)
+        self.assertEqual(len(store.search(query, 1000)), len(self.vectors))
+
+    def test_recarrega_o_indice_reconstruido(self):
+        store = NumpyVectorStore(self.directory)
+        self.assertEqual(store.search(self.vectors[100], 1)[0][0], 100)
+        build_numpy_index(lambda: iter([(7, vector_to_bytes(self.vectors[100]))]), self.directory, 16, 'fake-16')
+        self.assertEqual(store.search(self.vectors[100], 5), [(7, store.search(self.vectors[100], 1)[0][1])])
+        self.assertEqual(len(os.listdir(self.directory)), 3)
+
+    def test_filtro_aplicado_dentro_da_busca(self):
+        store = NumpyVectorStore(self.directory)
+        allowed = set(range(300, 310))
+        results = store.search(self.vectors[250], 7, AllowedIdsFilter(allowed))
+        query = self.vectors[250]
+        expected = sorted(allowed, key=lambda chunk_id: -sum(a * b for a, b in zip(query, self.vectors[chunk_id])))[:7]
+        self.assertEqual([chunk_id for chunk_id, _score in results], expected)
+        self.assertEqual(store.search(query, 7, AllowedIdsFilter([])), [])
+
+
+class IvfVectorStoreTests(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.exact_dir = os.path.join(directory.name, 'exato')
+        self.ivf_dir = os.path.join(directory.name, 'ivf')
+        rng = np.random.default_rng(0)
+        centers = rng.normal(size=(10, 32))
+        self.vectors = (centers[rng.integers(0, 10, size=1000)] + rng.normal(scale=0.3, size=(1000, 32))).astype(np.float32)
+        rows = [(chunk_id, vector_to_bytes(vector)) for chunk_id, vector in enumerate(self.vectors)]
+        build_numpy_index(lambda: iter(rows), self.exact_dir, 32, 'teste')
+        self.meta = build_ivf_index(self.exact_dir, self.ivf_dir, nlist=10, seed=0)
+
+    def test_todas_as_particoes_equivalem_a_busca_exata(self):
+        exact = NumpyVectorStore(self.exact_dir)
+        ivf = IvfVectorStore(self.ivf_dir, nprobe=self.meta['nlist'])
+        for query in self.vectors[:20]:
+            self.assertEqual([chunk_id for chunk_id, _ in ivf.search(query, 7)], [chunk_id for chunk_id, _ in exact.search(query, 7)])
+
+    def test_recall_alto_com_poucas_particoes_em_dados_agrupados(self):
+        exact = NumpyVectorStore(self.exact_dir)
+        ivf = IvfVectorStore(self.ivf_dir, nprobe=2)
+        found = total = 0
+        for query in self.vectors[:50]:
+            expected = {chunk_id for chunk_id, _ in exact.search(query, 7)}
+            found += len(expected & {chunk_id for chunk_id, _ in ivf.search(query, 7)})
+            total += len(expected)
+        self.assertGreater(found / total, 0.9)
+
+    def test_filtro_seletivo_visita_mais_particoes(self):
+        exact = NumpyVectorStore(self.exact_dir)
+        ivf = IvfVectorStore(self.ivf_dir, nprobe=1)
+        # Permitidos só os vetores mais distantes da consulta: estão fora da partição mais próxima
+        query = self.vectors[0]
+        allowed = AllowedIdsFilter([chunk_id for chunk_id, _ in exact.search(-query, 20)])
+        self.assertEqual([chunk_id for chunk_id, _ in ivf.search(query, 7, allowed)],
+                         [chunk_id for chunk_id, _ in exact.search(query, 7, allowed)])
+
+    def test_recarrega_centroides_junto_com_o_indice(self):
+        exact = NumpyVectorStore(self.exact_dir)
+        ivf = IvfVectorStore(self.ivf_dir, nprobe=100)
+        query = self.vectors[5]
+        self.assertEqual(ivf.search(query, 7), exact.search(query, 7))
+        # Amostra menor que nlist: usa ao menos um vetor por centroide
+        meta = build_ivf_index(self.exact_dir, self.ivf_dir, nlist=25, sample_size=3, seed=0)
+        self.assertEqual(meta['nlist'], 25)
+        self.assertEqual([chunk_id for chunk_id, _ in ivf.search(query, 7)], [chunk_id for chunk_id, _ in exact.search(query, 7)])
+        self.assertEqual((len(ivf.centroids), len(ivf.offsets)), (25, 26))
+        with self.assertRaises(ValueError):
+            build_ivf_index(self.exact_dir, self.ivf_dir, sample_size=0)
+
+
+class QuantizedSearchTests(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        rng = np.random.default_rng(1)
+        self.vectors = rng.normal(size=(500, 64)).astype(np.float32)
+        rows = [(chunk_id, vector_to_bytes(vector)) for chunk_id, vector in enumerate(self.vectors)]
+        build_numpy_index(lambda: iter(rows), self.directory, 64, 'teste', quantizations=('int8', 'binary'))
+
+    def test_reordenacao_recupera_o_resultado_exato(self):
+        exact = NumpyVectorStore(self.directory, quantization='')
+        for quantization in ('int8', 'binary'):
+            store = NumpyVectorStore(self.directory, quantization=quantization, candidates=500)
+            with self.subTest(quantization=quantization):
+                for query in self.vectors[:10]:
+                    self.assertEqual(store.search(query, 7), exact.search(query, 7))
+
+    def test_copias_quantizadas_sao_menores(self):
+        exact = NumpyVectorStore(self.directory, quantization='')
+        self.assertEqual(exact.scanned_bytes / NumpyVectorStore(self.directory, quantization='int8').scanned_bytes, 4)
+        self.assertEqual(exact.scanned_bytes / NumpyVectorStore(self.directory, quantization='binary').scanned_bytes, 32)
+        query = self.vectors[3]
+        self.assertEqual(NumpyVectorStore(self.directory, quantization='int8', candidates=20).search(query, 1)[0][0], 3)
+
+
+@override_settings(CACHES={'consultas': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    'LOCATION': 'testes-consultas',
+    'TIMEOUT': 60,
+    'OPTIONS': {'MAX_ENTRIES': 3, 'CULL_FREQUENCY': 3},
+}})
+class QueryEmbeddingCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        self.cache = QueryEmbeddingCache('consultas')
+        self.cache.cache.clear()
+
+    def test_pergunta_normalizada_e_contadores(self):
+        self.assertIsNone(self.cache.get('m', 'Qual o recuo mínimo?'))
+        self.cache.set('m', 'Qual o recuo mínimo?', [0.25, 0.5])
+        self.assertEqual(self.cache.get('m', '  qual O recuo\nmínimo? '), [0.25, 0.5])
+        self.assertIsNone(self.cache.get('outro-modelo', 'Qual o recuo mínimo?'))
+        self.assertEqual(self.cache.stats(), {'acertos': 1, 'faltas': 2, 'taxa_acerto': 1 / 3})
+        self.cache.reset_stats()
+        self.assertEqual(self.cache.stats()['faltas'], 0)
+
+    def test_tamanho_limitado(self):
+        for i in range(10):
+            self.cache.set('m', f'pergunta {i}', [float(i)])
+        self.assertEqual(self.cache.get('m', 'pergunta 9'), [9.0])
+        self.assertIsNone(self.cache.get('m', 'pergunta 0'))
+        # Os contadores não são descartados com as entradas
+        self.assertEqual((self.cache.stats()['acertos'], self.cache.stats()['faltas']), (1, 1))
+
+
+class ImportDocumentsCommandTests(TestCase):
+    """
+    import_documents e process_documents sobre um acervo pequeno gravado em um diretório temporário.
+    """
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+        # O prefixo "htmls/" da coluna arquivo é descartado: os arquivos ficam na raiz do acervo
+        os.makedirs(os.path.join(self.tmp, 'acervo'))
+        self.rows = []
+        for i in range(1, 31):
+            self.write_html(f'le{i}.html', f'<p>Art. 1º Texto da lei {i}.</p><p>Art. 2º Vigência da lei {i}.</p>')
+            self.rows.append([f'htmls/le{i}.html', f'2000-01-{i:02d}', f'LE{i:05d}2000', 'não' if i % 3 else 'sim'])
+        self.rows.append(['htmls/ausente.html', '2000-01-01', 'LE000992000', 'não'])
+        self.rows.append(['htmls/le2.html', 'NULL', 'LE000022000', '1'])
+        self.write_csv()
+
+    def write_html(self, nome, corpo):
+        with open(os.path.join(self.tmp, 'acervo', nome), 'w', encoding='utf-8') as f:
+            f.write(f'<html><body>{corpo}</body></html>')
+
+    def write_csv(self):
+        with open(os.path.join(self.tmp, 'metadados.csv'), 'w', encoding='utf-8', newline='') as f:
+            f.write('arquivo,data_publicacao,lei_cod,revogada\n')
+            for row in self.rows:
+                f.write(','.join(row) + '\n')
+
+    def run_command(self, name, *args):
+        out = StringIO()
+        if name == 'import_documents':
+            args = (os.path.join(self.tmp, 'metadados.csv'), os.path.join(self.tmp, 'acervo'),
+                    '--error-log', os.path.join(self.tmp, 'erros.log'), *args)
+        with override_settings(MEDIA_ROOT=os.path.join(self.tmp, 'media')):
+            call_command(name, *args, stdout=out)
+        return out.getvalue()
+
+    def snapshot(self):
+        documentos = list(Documento.objects.order_by('nome_arquivo').values(
+            'nome_arquivo', 'arquivo', 'tipo_documento', 'data_publicacao', 'hierarquia', 'status', 'lei_cod',
+            'texto_completo_extraido', 'hash_conteudo', 'hash_metadados', 'hash_texto_chunking',
+        ))
+        chunks = list(Chunk.objects.order_by('documento__nome_arquivo', 'ordem_no_documento').values_list(
+            'documento__nome_arquivo', 'ordem_no_documento', 'conteudo_original', 'caminho_estrutural', 'numero_artigo',
+        ))
+        return documentos, chunks
+
+    def test_serial_e_paralelo_gravam_as_mesmas_linhas(self):
+        real_save = FileSystemStorage._save
+
+        def failing_save(storage, name, content):
+            # A cópia de le5.html para o storage falha: nenhum dos caminhos deve criar a linha
+            if os.path.basename(name) == 'le5.html':
+                raise OSError('disco cheio')
+            return real_save(storage, name, content)
+
+        snapshots = []
+        for workers in ('0', '1', '3'):
+            Documento.objects.all().delete()
+            shutil.rmtree(os.path.join(self.tmp, 'media'), ignore_errors=True)
+            with mock.patch.object(FileSystemStorage, '_save', failing_save):
+                out = self.run_command('import_documents', '--workers', workers, '--batch-size', '7')
+            self.assertIn('30 documento(s) gravado(s)', out)
+            self.run_command('process_documents', '--workers', workers, '--batch-size', '7')
+            snapshots.append(self.snapshot())
+        self.assertEqual(snapshots[0], snapshots[1])
+        self.assertEqual(snapshots[0], snapshots[2])
+        documentos, chunks = snapshots[0]
+        self.assertEqual(len(documentos), 29)
+        self.assertEqual(len(chunks), 58)
+        self.assertNotIn('htmls/le5.html', {documento['nome_arquivo'] for documento in documentos})
+        # A última linha do CSV com o mesmo arquivo define os campos
+        le2 = next(documento for documento in documentos if documento['nome_arquivo'] == 'htmls/le2.html')
+        self.assertEqual((le2['status'], le2['data_publicacao']), ('REVOGADO', None))
+
+    def test_incremental_pula_inalterados_e_reimporta_alterados(self):
+        for workers in ('0', '2'):
+            with self.subTest(workers=workers):
+                Documento.objects.all().delete()
+                self.run_command('import_documents', '--workers', workers)
+                antes = {documento['nome_arquivo']: documento for documento in self.snapshot()[0]}
+                versao = current_index_version()
+
+                out = self.run_command('import_documents', '--workers', workers, '--incremental')
+                self.assertIn('0 documento(s) gravado(s)', out)
+                self.assertIn('Novos: 0 | Alterados: 0 | Inalterados: 30 (ignorado(s))', out)
+                self.assertEqual({documento['nome_arquivo']: documento for documento in self.snapshot()[0]}, antes)
+                self.assertEqual(current_index_version(), versao)
+
+                # Um arquivo com bytes novos e uma linha do CSV com metadados novos
+                self.write_html('le5.html', '<p>Art. 1º Texto novo da lei 5.</p>')
+                self.rows[6][3] = 'sim'
+                self.write_csv()
+                out = self.run_command('import_documents', '--workers', workers, '--incremental')
+                self.assertIn('2 documento(s) gravado(s)', out)
+                self.assertIn('Novos: 0 | Alterados: 2 | Inalterados: 28 (ignorado(s))', out)
+                depois = {documento['nome_arquivo']: documento for documento in self.snapshot()[0]}
+                self.assertIn('Texto novo da lei 5', depois['htmls/le5.html']['texto_completo_extraido'])
+                self.assertNotEqual(depois['htmls/le5.html']['hash_conteudo'], antes['htmls/le5.html']['hash_conteudo'])
+                self.assertEqual((antes['htmls/le7.html']['status'], depois['htmls/le7.html']['status']), ('VIGENTE', 'REVOGADO'))
+                self.assertEqual({nome: depois[nome] for nome in depois if nome not in ('htmls/le5.html', 'htmls/le7.html')},
+                                 {nome: antes[nome] for nome in antes if nome not in ('htmls/le5.html', 'htmls/le7.html')})
+                self.assertGreater(current_index_version(), versao)
+
+                self.write_html('le5.html', '<p>Art. 1º Texto da lei 5.</p><p>Art. 2º Vigência da lei 5.</p>')
+                self.rows[6][3] = 'não'
+                self.write_csv()
+
+
+class ProcessDocumentsCommandTests(TestCase):
+    """
+    Reconciliação dos chunks de um documento re-chunkado: chunks com o mesmo conteúdo mantêm o id.
+    """
+
+    ARTIGOS = {letra: f'Art. {numero}º Texto {letra}.' for numero, letra in enumerate('ABCD', start=1)}
+
+    def setUp(self):
+        self.documento = Documento.objects.create(nome_arquivo='lei.html', arquivo='documentos/lei.html')
+        self.process('ABC')
+        # Os chunks mantidos conservam o embedding já gerado
+        Chunk.objects.update(hash_embedding='gerado')
+        self.ids = {letra: chunk_id for chunk_id, letra in self.chunks()}
+
+    def process(self, letras):
+        Documento.objects.filter(pk=self.documento.pk).update(
+            texto_completo_extraido='\n'.join(self.ARTIGOS[letra] for letra in letras))
+        out = StringIO()
+        call_command('process_documents', stdout=out)
+        return out.getvalue()
+
+    def chunks(self):
+        letras = {texto: letra for letra, texto in self.ARTIGOS.items()}
+        rows = Chunk.objects.filter(documento=self.documento).order_by('ordem_no_documento')
+        self.assertEqual(list(rows.values_list('ordem_no_documento', flat=True)), list(range(rows.count())))
+        return [(chunk_id, letras[texto]) for chunk_id, texto in rows.values_list('id', 'conteudo_original')]
+
+    def assertReused(self, letras):
+        self.assertEqual(list(Chunk.objects.filter(id__in=[self.ids[letra] for letra in letras])
+                              .values_list('hash_embedding', flat=True)), ['gerado'] * len(letras))
+
+    def test_chunk_inserido_no_meio(self):
+        out = self.process('ADBC')
+        chunks = self.chunks()
+        self.assertEqual([letra for _id, letra in chunks], list('ADBC'))
+        self.assertEqual([chunks[i][0] for i in (0, 2, 3)], [self.ids['A'], self.ids['B'], self.ids['C']])
+        self.assertReused('ABC')
+        self.assertIn('Chunks criados: 1 | mantidos: 3 | removidos: 0', out)
+
+    def test_chunk_removido_do_meio(self):
+        out = self.process('AC')
+        self.assertEqual(self.chunks(), [(self.ids['A'], 'A'), (self.ids['C'], 'C')])
+        self.assertFalse(Chunk.objects.filter(pk=self.ids['B']).exists())
+        self.assertReused('AC')
+        self.assertIn('Chunks criados: 0 | mantidos: 2 | removidos: 1', out)
+
+    def test_chunks_reordenados(self):
+        # As posições trocadas não podem colidir em unique_together (documento, ordem_no_documento)
+        out = self.process('CAB')
+        self.assertEqual(self.chunks(), [(self.ids['C'], 'C'), (self.ids['A'], 'A'), (self.ids['B'], 'B')])
+        self.assertReused('ABC')
+        self.assertIn('Chunks criados: 0 | mantidos: 3 | removidos: 0', out)
+
+        out = self.process('CAB')
+        self.assertIn('Documentos re-chunkados: 0 | inalterados: 1', out)
+
+
+class GenerateEmbeddingsCommandTests(TestCase):
+    """
+    generate_embeddings com o provedor fake e uma coleção do ChromaDB em memória.
+    """
+
+    def setUp(self):
+        import chromadb
+        from melchior.management.commands import generate_embeddings
+        self.command_module = generate_embeddings
+        client = chromadb.EphemeralClient()
+        name = f'teste_{self._testMethodName}'
+        self.collection = client.get_or_create_collection(name=name, embedding_function=None)
+        self.addCleanup(client.delete_collection, name=name)
+        for patcher in (mock.patch.object(generate_embeddings.Command, '_get_collection', return_value=self.collection),
+                        mock.patch.object(generate_embeddings, 'get_chroma_client')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.documento = Documento.objects.create(nome_arquivo='lei.html', arquivo='documentos/lei.html',
+                                                  status='VIGENTE', hierarquia='LEI_MUNICIPAL')
+        self.chunks = [
+            Chunk.objects.create(documento=self.documento, ordem_no_documento=ordem, conteudo_original=texto, conteudo_tratado=texto)
+            for ordem, texto in enumerate(['Art. 1º Texto um.', 'Art. 2º Texto dois.', 'Art. 3º Texto três.', 'Art. 4º Texto quatro.'])
+        ]
+
+    def run_command(self, *args, provider=None):
+        provider = provider or FakeEmbeddingProvider(dimension=8)
+        out = StringIO()
+        with mock.patch.object(self.command_module, 'get_provider', return_value=provider), \
+                mock.patch.object(provider, 'embed', wraps=provider.embed) as embed:
+            call_command('generate_embeddings', '--provider', 'fake', '--no-cache', '--workers', '1',
+                         '--requests-per-minute', '0', '--batch-size', '2', *args, stdout=out)
+        embedded = [text for call in embed.call_args_list for text in call.args[0]]
+        return out.getvalue(), embedded
+
+    def stored_metadata(self):
+        stored = self.collection.get(include=['metadatas'])
+        return {chroma_id: metadata for chroma_id, metadata in zip(stored['ids'], stored['metadatas'])}
+
+    def test_incremental_pula_hash_igual_e_reembeda_o_alterado(self):
+        _out, embedded = self.run_command('--incremental')
+        self.assertEqual(len(embedded), 4)
+
+        Chunk.objects.filter(pk=self.chunks[1].pk).update(conteudo_tratado='Art. 2º Texto dois, alterado.')
+        out, embedded = self.run_command('--incremental')
+        self.assertEqual(embedded, ['Art. 2º Texto dois, alterado.'])
+        self.assertIn('~ 1 vetor(es) atualizado(s)', out)
+        self.assertIn('= 3 vetor(es) inalterado(s), 0 com metadados atualizados', out)
+        self.assertEqual(self.collection.get(ids=[f'chunk_{self.chunks[1].pk}'])['documents'], ['Art. 2º Texto dois, alterado.'])
+
+        _out, embedded = self.run_command('--incremental')
+        self.assertEqual(embedded, [])
+
+    def test_incremental_atualiza_metadados_sem_reembedar(self):
+        self.run_command('--incremental')
+        Documento.objects.filter(pk=self.documento.pk).update(hierarquia='LEI_FEDERAL', data_publicacao='2020-01-02')
+        Chunk.objects.filter(pk=self.chunks[3].pk).update(ordem_no_documento=10)
+
+        out, embedded = self.run_command('--incremental')
+        self.assertEqual(embedded, [])
+        self.assertIn('= 4 vetor(es) inalterado(s), 4 com metadados atualizados', out)
+        metadata = self.stored_metadata()
+        self.assertEqual({item['documento_hierarquia'] for item in metadata.values()}, {'LEI_FEDERAL'})
+        self.assertEqual({item['documento_data_publicacao'] for item in metadata.values()}, {'2020-01-02'})
+        self.assertEqual(metadata[f'chunk_{self.chunks[3].pk}']['ordem_no_documento'], 10)
+
+    def test_diario_registra_lotes_e_falhas(self):
+        Chunk.objects.filter(pk=self.chunks[2].pk).update(conteudo_tratado='Art. 3º Texto VENENO.')
+        out, _embedded = self.run_command(provider=FakeEmbeddingProvider(dimension=8, poison=('VENENO',)))
+
+        execucao = ExecucaoEmbedding.objects.get()
+        self.assertEqual((execucao.modo, execucao.status, execucao.modelo_embedding), ('COMPLETO', 'CONCLUIDA', 'fake-8'))
+        gravados = sorted(chunk_id for lote in execucao.lotes.all() for chunk_id in lote.chunk_ids)
+        self.assertEqual(gravados, sorted(chunk.pk for chunk in self.chunks if chunk != self.chunks[2]))
+        self.assertEqual(list(execucao.falhas.values_list('chunk_id', flat=True)), [self.chunks[2].pk])
+        self.assertIn('1 chunk(s) com falha registrada', out)
+        self.assertEqual(Chunk.objects.get(pk=self.chunks[2].pk).hash_embedding, '')
+
+    def test_retry_failed_reprocessa_so_os_chunks_com_falha(self):
+        Chunk.objects.filter(pk=self.chunks[2].pk).update(conteudo_tratado='Art. 3º Texto VENENO.')
+        self.run_command(provider=FakeEmbeddingProvider(dimension=8, poison=('VENENO',)))
+
+        out, embedded = self.run_command('--retry-failed')
+        self.assertEqual(embedded, ['Art. 3º Texto VENENO.'])
+        self.assertIn('Reprocessando 1 chunk(s) com falha registrada', out)
+        self.assertFalse(FalhaEmbedding.objects.exists())
+        self.assertEqual(ExecucaoEmbedding.objects.latest('id').modo, 'FALHAS')
+        self.assertEqual(len(self.collection.get()['ids']), 4)
+
+        out, embedded = self.run_command('--retry-failed')
+        self.assertEqual(embedded, [])
+        self.assertIn('Nenhuma falha registrada para reprocessar.', out)
+
+    def test_resume_pula_lotes_ja_gravados(self):
+        # Execução interrompida depois de gravar o lote dos dois primeiros chunks
+        execucao = ExecucaoEmbedding.objects.create(modo='COMPLETO', modelo_embedding='fake-8')
+        LoteEmbedding.objects.create(execucao=execucao, chunk_ids=[self.chunks[0].pk, self.chunks[1].pk])
+
+        out, embedded = self.run_command('--resume')
+        self.assertEqual(embedded, ['Art. 3º Texto três.', 'Art. 4º Texto quatro.'])
+        self.assertIn(f'Retomando a execução {execucao.id}', out)
+        self.assertIn('2 chunk(s) já gravado(s) e 0 com falha nesta execução serão pulados.', out)
+        execucao.refresh_from_db()
+        self.assertEqual(execucao.status, 'CONCLUIDA')
+        self.assertEqual(execucao.lotes.count(), 2)
+        self.assertEqual(ExecucaoEmbedding.objects.count(), 1)
+
+        with self.assertRaisesMessage(CommandError, 'Não há execução interrompida para retomar.'):
+            self.run_command('--resume')
+
+
+@override_settings(CACHES={'respostas': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    'LOCATION': 'testes-respostas',
+}})
+class AnswerCacheTests(TestCase):
+
+    def setUp(self):
+        self.cache = AnswerCache('respostas')
+        self.cache.cache.clear()
+
+    def test_chave_depende_dos_chunks_da_versao_e_do_prompt(self):
+        prompt = prompt_version('Pergunta: {query}', 'modelo')
+        self.cache.set('Qual o recuo?', [3, 1], 0, prompt, 'Cinco metros.')
+        self.assertEqual(self.cache.get(' qual o  RECUO? ', [3, 1], 0, prompt), 'Cinco metros.')
+        self.assertIsNone(self.cache.get('Qual o recuo?', [1, 3], 0, prompt))
+        self.assertIsNone(self.cache.get('Qual o recuo?', [3, 1], 1, prompt))
+        self.assertIsNone(self.cache.get('Qual o recuo?', [3, 1], 0, prompt_version('Pergunta: {query}?', 'modelo')))
+
+    def test_bump_incrementa_a_versao(self):
+        self.assertEqual(current_index_version(), 0)
+        self.assertEqual(bump_index_version('teste'), 1)
+        self.assertEqual(bump_index_version('teste'), 2)
+        self.assertEqual(current_index_version(), 2)
+
+
+class ServicesTests(SimpleTestCase):
+
+    def setUp(self):
+        services.reset()
+        self.addCleanup(services.reset)
+
+    def test_chave_ausente_so_falha_no_uso(self):
+        with mock.patch.dict(os.environ, {'GOOGLE_API_KEY': ''}):
+            with self.assertRaises(ImproperlyConfigured):
+                services.get_genai()
+
+    def test_backend_vetorial_compartilhado(self):
+        with tempfile.TemporaryDirectory() as directory, \
+                override_settings(MELCHIOR_VECTOR_BACKEND='numpy', MELCHIOR_VECTOR_INDEX_DIR=directory):
+            store = services.get_vector_store()
+            self.assertIs(services.get_vector_store(), store)
+            self.assertEqual(store.directory, directory)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'Requer os.fork.')
+    def test_filho_do_fork_nao_herda_clientes(self):
+        with tempfile.TemporaryDirectory() as directory, \
+                override_settings(MELCHIOR_VECTOR_BACKEND='numpy', MELCHIOR_VECTOR_INDEX_DIR=directory):
+            store = services.get_vector_store()
+            read_fd, write_fd = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    os.write(write_fd, b'1' if services.get_vector_store() is not store else b'0')
+                finally:
+                    os._exit(0)
+            os.close(write_fd)
+            os.waitpid(pid, 0)
+            with os.fdopen(read_fd, 'rb') as pipe:
+                self.assertEqual(pipe.read(), b'1')
+
+    def test_warm_up_do_processo_e_dos_workers(self):
+        with mock.patch.object(services, 'warm_up') as warm_up, \
+                mock.patch.object(services.os, 'register_at_fork') as register_at_fork, \
+                mock.patch.object(services, '_warm_up_after_fork_registered', False):
+            with override_settings(MELCHIOR_WARM_UP=False):
+                services.warm_up_process()
+            warm_up.assert_not_called()
+            with override_settings(MELCHIOR_WARM_UP=True):
+                services.warm_up_process()
+                services.warm_up_process()
+            self.assertEqual(warm_up.call_count, 2)
+            register_at_fork.assert_called_once_with(after_in_child=services._warm_up_in_background)
+
+
+class SearchFiltersTests(SimpleTestCase):
+
+    def test_le_parametros_da_url(self):
+        filters = SearchFilters.from_query_params(
+            QueryDict('status=VIGENTE&status=PARCIALMENTE_REVOGADO&hierarquia=&data_inicio=2000-01-31'))
+        self.assertEqual(filters.status, ('VIGENTE', 'PARCIALMENTE_REVOGADO'))
+        self.assertEqual(filters.hierarquias, ())
+        self.assertEqual(filters.data_inicio.isoformat(), '2000-01-31')
+        self.assertIsNone(filters.chroma_where())
+        self.assertEqual(SearchFilters(hierarquias=('RESOLUCAO',)).chroma_where(),
+                         {'documento_hierarquia': {'$in': ['RESOLUCAO']}})
+
+    def test_rejeita_valores_invalidos(self):
+        for params in ('status=QUALQUER', 'hierarquia=LEI', 'data_fim=31/12/2020'):
+            with self.assertRaises(ValueError):
+                SearchFilters.from_query_params(QueryDict(params))
+
+
+class FilterMaskTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        provider = FakeEmbeddingProvider(dimension=8)
+        lei = Documento.objects.create(nome_arquivo='lei.html', arquivo='documentos/lei.html', hierarquia='LEI_MUNICIPAL')
+        resolucao = Documento.objects.create(nome_arquivo='res.html', arquivo='documentos/res.html', hierarquia='RESOLUCAO')
+        cls.chunks = [
+            Chunk.objects.create(documento=documento, conteudo_original='', conteudo_tratado=f'Art. {ordem}º',
+                                 ordem_no_documento=ordem, is_valido_apos_antinomia=ordem != 2,
+                                 embedding=vector_to_bytes(provider.vector(f'{documento.pk} {ordem}')))
+            for documento in (lei, resolucao) for ordem in range(1, 4)
+        ]
+        cls.query = provider.vector(f'{lei.pk} 2')
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        rows = [(chunk.id, chunk.embedding) for chunk in self.chunks]
+        build_numpy_index(lambda: iter(rows), directory.name, 8, 'fake-8')
+        self.store = NumpyVectorStore(directory.name, quantization='')
+
+    def test_so_validade_nao_monta_mascara(self):
+        with mock.patch.object(SearchFilters, 'allowed_ids') as allowed_ids:
+            results = retrieve(self.store, self.query, 6, SearchFilters())
+        allowed_ids.assert_not_called()
+        self.assertEqual({chunk.id for chunk, _score in results},
+                         {chunk.id for chunk in self.chunks if chunk.is_valido_apos_antinomia})
+
+    def test_mascara_reaproveitada_ate_mudar_a_versao_do_indice(self):
+        with mock.patch.object(SearchFilters, 'allowed_ids', autospec=True, side_effect=SearchFilters.allowed_ids) as allowed_ids:
+            for _ in range(2):
+                results = retrieve(self.store, self.query, 6, SearchFilters(hierarquias=('RESOLUCAO',)))
+                self.assertEqual({chunk.documento.hierarquia for chunk, _score in results}, {'RESOLUCAO'})
+            self.assertEqual(allowed_ids.call_count, 1)
+            bump_index_version('teste')
+            retrieve(self.store, self.query, 6, SearchFilters(hierarquias=('RESOLUCAO',)))
+            self.assertEqual(allowed_ids.call_count, 2)
+
+
+class LexicalSearchTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        lei = Documento.objects.create(nome_arquivo='lei.html', arquivo='documentos/lei.html', hierarquia='LEI_MUNICIPAL')
+        resolucao = Documento.objects.create(nome_arquivo='resolucao.html', arquivo='documentos/resolucao.html', hierarquia='RESOLUCAO')
+        cls.alvara = Chunk.objects.create(documento=lei, conteudo_original='', ordem_no_documento=1,
+                                          conteudo_tratado='Art. 1º O Alvará de construção será expedido pela Prefeitura.')
+        cls.iptu = Chunk.objects.create(documento=lei, conteudo_original='', ordem_no_documento=2,
+                                        conteudo_tratado='Art. 2º O IPTU incide sobre imóveis urbanos, conforme a Lei 10.257.')
+        cls.resolucao = Chunk.objects.create(documento=resolucao, conteudo_original='', ordem_no_documento=1,
+                                             conteudo_tratado='Art. 1º Fica regulamentado o alvará sanitário.')
+
+    def test_triggers_do_indice_existem_apos_as_migracoes(self):
+        # Uma migração que recria melchior_chunk sem chamar recreate_fts_triggers apaga os triggers
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'melchior_chunk'")
+            self.assertEqual({name for (name,) in cursor.fetchall()}, set(FTS_TRIGGERS))
+
+    def test_busca_sem_acento_e_sem_caixa(self):
+        store = LexicalStore()
+        self.assertEqual({chunk_id for chunk_id, _ in store.search('ALVARA', 5)}, {self.alvara.id, self.resolucao.id})
+        self.assertEqual([chunk_id for chunk_id, _ in store.search('qual a lei 10.257?', 5)], [self.iptu.id])
+        self.assertEqual([chunk_id for chunk_id, _ in store.search('alvará', 5, SearchFilters(hierarquias=('RESOLUCAO',)))],
+                         [self.resolucao.id])
+
+    def test_indice_acompanha_as_gravacoes(self):
+        store = LexicalStore()
+        self.iptu.conteudo_tratado = 'Art. 2º A taxa de lixo é anual.'
+        self.iptu.save()
+        self.assertEqual(store.search('iptu', 5), [])
+        self.assertEqual([chunk_id for chunk_id, _ in store.search('lixo', 5)], [self.iptu.id])
+        self.alvara.delete()
+        self.assertEqual([chunk_id for chunk_id, _ in store.search('alvara', 5)], [self.resolucao.id])
+
+    def test_documentos_do_admin_sem_o_indice_usam_like(self):
+        self.assertEqual(set(Documento.objects.filter(id__in=matching_documento_ids('alvará sanitário'))
+                             .values_list('nome_arquivo', flat=True)), {'resolucao.html'})
+        Documento.objects.filter(nome_arquivo='lei.html').update(texto_completo_extraido='O Alvará de construção e o IPTU.')
+        with mock.patch('melchior.lexical.fts_available', return_value=False):
+            ids = matching_documento_ids('alvará iptu')
+            self.assertEqual(set(Documento.objects.filter(id__in=ids).values_list('nome_arquivo', flat=True)), {'lei.html'})
+
+    def test_expressao_ignora_sintaxe_do_fts(self):
+        self.assertEqual(fts_match_expression('Qual o "IPTU" NEAR(lei*)?'), '"iptu" OR "near(lei*"')
+        self.assertEqual(LexicalStore().search('"', 5), [])
+
+    def test_fusao_por_rrf(self):
+        fused = reciprocal_rank_fusion([[1, 2, 3], [3, 4, 1]], k=60)
+        self.assertEqual([item for item, _ in fused], [1, 3, 2, 4])
+        self.assertAlmostEqual(fused[0][1], 1 / 61 + 1 / 63)
+
+
+class CitationTests(TestCase):
+
+    def test_reconhece_perguntas_que_so_citam_um_artigo(self):
+        self.assertEqual(parse_citation('O que diz o art. 12 da LE 1234/1998?'), Citation('LE', 1234, 1998, 12))
+        self.assertEqual(parse_citation('Art. 3º da Lei nº 1.234, de 1998'), Citation('LE', 1234, 1998, 3))
+        self.assertEqual(parse_citation('texto do artigo 5 da Resolução 7/1950'), Citation('RE', 7, 1950, 5))
+        self.assertEqual(parse_citation('art 1 do decreto-lei 45 de 2 de maio de 1951'), Citation('DL', 45, 1951, 1))
+        self.assertIsNone(parse_citation('O art. 12 da LE 1234/1998 se aplica a galpões?'))
+        self.assertIsNone(parse_citation('Qual a lei sobre IPTU?'))
+
+    def test_normaliza_lei_cod(self):
+        self.assertEqual(normalize_lei_cod('LE12341998'), 'LE012341998')
+        self.assertEqual(normalize_lei_cod(' le000021948 '), 'LE000021948')
+        self.assertEqual(normalize_lei_cod('ABC'), 'ABC')
+
+    def test_busca_os_chunks_do_artigo(self):
+        documento = Documento.objects.create(nome_arquivo='LE012341998consol.html', arquivo='documentos/lei.html',
+                                             lei_cod='LE012341998')
+        for ordem, (caminho, numero) in enumerate([('Art. 11', 11), ('Art. 12', 12), ('Art. 12, §1º', 12), ('Art. 13', 13)]):
+            Chunk.objects.create(documento=documento, conteudo_original='', conteudo_tratado=caminho,
+                                 ordem_no_documento=ordem, caminho_estrutural=caminho, numero_artigo=numero)
+        chunks = lookup_article(parse_citation('o que diz o art. 12 da LE 1234/1998'))
+        self.assertEqual([chunk.conteudo_tratado for chunk in chunks], ['Art. 12', 'Art. 12, §1º'])
+        self.assertEqual(lookup_article(Citation('LE', 1234, 1998, 99)), [])
+
+    def test_extrai_citacoes_e_revogacoes_do_texto(self):
+        def extract(text, **kwargs):
+            return [(ref.lei_cod, ref.artigo, ref.tipo, ref.unidade) for ref in extract_references(text, **kwargs)]
+
+        self.assertEqual(extract('Art. 1º Fica revogado o Decreto-Lei nº 137, de 23 de novembro de 1946.'),
+                         [('DL001371946', None, 'REVOGA', '')])
+        self.assertEqual(extract('revogadas as disposições em contrário, especialmente as constantes das Leis nºs 141, '
+                                 'de 19-5-1.952 e 209, de 9-12-1.953.'),
+                         [('LE001411952', None, 'REVOGA', ''), ('LE002091953', None, 'REVOGA', '')])
+        self.assertEqual(extract('conforme o art. 12 da Lei 1234/1998.'), [('LE012341998', 12, 'CITA', '')])
+        # Nota cortada entre dois chunks: a citação pertence ao chunk em que a nota começa
+        note, rest = 'Art. 6º (Este artigo foi revogado pelo', 'art. 3º da Lei Municipal nº 1.438, de 16.12.1968)'
+        self.assertEqual(extract(note, tail=rest), [('LE014381968', 3, 'REVOGADO_POR', 'artigo')])
+        self.assertEqual(extract(rest, head=note), [])
+
+
+class ContextPackingTests(SimpleTestCase):
+
+    def setUp(self):
+        self.lei = Documento(pk=1, nome_arquivo='lei.html')
+        self.outra = Documento(pk=2, nome_arquivo='outra.html')
+
+    def chunk(self, documento, ordem, texto):
+        return Chunk(pk=documento.pk * 100 + ordem, documento=documento, ordem_no_documento=ordem, conteudo_tratado=texto)
+
+    def test_une_vizinhos_e_descarta_repetidos(self):
+        repetido = ('Art. 5º O alvará de construção terá validade de dois anos, contados da data de sua expedição, '
+                    'prorrogável uma única vez por igual período, desde que a obra tenha sido iniciada e o '
+                    'requerimento seja apresentado antes do vencimento, acompanhado do projeto aprovado.')
+        chunks = [
+            self.chunk(self.lei, 2, 'Art. 2º O IPTU incide sobre imóveis urbanos.'),
+            self.chunk(self.outra, 5, repetido),
+            self.chunk(self.lei, 1, 'Art. 1º Esta lei institui o código tributário.'),
+            self.chunk(self.lei, 5, repetido.replace('dois', '2')),
+        ]
+        packed = pack_context('iptu', chunks)
+        self.assertEqual((packed.duplicates, packed.merged, packed.truncated), (1, 1, 0))
+        self.assertEqual([passage.text for passage in packed.passages], [
+            'Art. 1º Esta lei institui o código tributário.\nArt. 2º O IPTU incide sobre imóveis urbanos.',
+            repetido,
+        ])
+        self.assertLess(packed.tokens_after, packed.tokens_before)
+
+    def test_corta_em_volta_dos_termos_da_pergunta_dentro_do_orcamento(self):
+        texto = 'Art. 9º ' + 'Disposição genérica sobre obras. ' * 80 + 'A multa por obra sem alvará será de dez salários.'
+        packed = pack_context('Qual a multa?', [self.chunk(self.lei, 9, texto), self.chunk(self.outra, 1, 'Art. 1º ' + 'Outra regra. ' * 200)],
+                              budget=150, max_passage_tokens=100)
+        self.assertEqual((packed.truncated, packed.omitted), (1, 1))
+        [passage] = packed.passages
+        self.assertTrue(passage.text.startswith('[...] '))
+        self.assertIn('A multa por obra sem alvará', passage.text)
+        self.assertLessEqual(passage.tokens, 100)
+        self.assertEqual(best_span('a b c', {'c'}, 10), (0, 5))
+
+    def test_orcamento_entra_na_versao_do_prompt(self):
+        model = get_answer_model('fake')
+        version = model.prompt_version
+        with override_settings(MELCHIOR_CONTEXT_TOKENS=500):
+            self.assertNotEqual(model.prompt_version, version)
+
+    def test_passagem_de_um_chunk(self):
+        self.assertEqual(Passage.from_chunk(self.chunk(self.lei, 1, 'x')).text, 'x')
+
+
+class RuleEngineTests(SimpleTestCase):
+
+    def setUp(self):
+        self.engine = RuleEngine([
+            Rule('nota', 'REVOGACAO', '(revogad', r'\(revogad[oa]s?\b', prioridade=10),
+            Rule('rotulo', 'REVOGACAO', 'revogad', r'revogad[oa]s?\s*[.;]', posicao_maxima=10, prioridade=10),
+            Rule('revigorado', 'VALIDADE', '(revigorad', r'\(revigorad[oa]s?\b', prioridade=20),
+            Rule('clausula', 'VALIDADE', 'revogadas as', r'revogadas\s+as\s+disposi', prioridade=0),
+        ])
+
+    def test_disparos_sobrepostos_e_posicao_maxima(self):
+        hits = self.engine.scan('Art. 7º (REVOGADO pela Lei 1/1990); revogado.')
+        # '(revogad' e 'revogad' começam em posições vizinhas; 'rotulo' só vale até o caractere 10
+        self.assertEqual([(hit.rule.nome, hit.start) for hit in hits], [('nota', 8)])
+        self.assertEqual([hit.rule.nome for hit in self.engine.scan('Art. 7º Revogado.')], ['rotulo'])
+
+    def test_decide_pela_prioridade(self):
+        self.assertIsNone(self.engine.decide('Art. 3º Ficam irrevogáveis as concessões.'))
+        self.assertEqual(self.engine.decide('Art. 9º Revogadas as disposições em contrário.').rule.nome, 'clausula')
+        decision = self.engine.decide('Art. 2º (Revogado pela Lei 1/1990) (Revigorado pela Lei 2/2000)')
+        self.assertEqual(decision.rule.nome, 'revigorado')
+        self.assertFalse(decision.rule.invalida)
+        self.assertEqual(decision.fired, ('nota', 'revigorado'))
+
+    def test_padrao_invalido(self):
+        with self.assertRaisesMessage(ValueError, 'quebrada'):
+            RuleEngine([Rule('quebrada', 'REVOGACAO', 'x', '(x')])
+
+
+class ResolveAntinomiasTests(TestCase):
+
+    def test_regras_de_status_e_auto_revogacao(self):
+        revogada = Documento.objects.create(nome_arquivo='revogada.html', arquivo='documentos/revogada.html', status='REVOGADO')
+        vigente = Documento.objects.create(nome_arquivo='vigente.html', arquivo='documentos/vigente.html', status='VIGENTE')
+        textos = {
+            (revogada, 1): 'Art. 1º Texto qualquer.',
+            (vigente, 1): 'Art. 1º Texto em vigor.',
+            (vigente, 2): 'Art. 2º (Revogado pela Lei 10/1990)',
+            (vigente, 3): 'Art. 3º Ficam irrevogáveis as concessões.',
+            (vigente, 4): 'Art. 4º Revogadas as disposições em contrário, esta Lei entra em vigor.',
+            (vigente, 5): 'b) (Esta alínea foi revogada pela Lei 20/2000)',
+        }
+        chunks = {
+            key: Chunk.objects.create(documento=key[0], ordem_no_documento=key[1], conteudo_original=texto,
+                                      conteudo_tratado=texto, is_valido_apos_antinomia=key != (vigente, 1))
+            for key, texto in textos.items()
+        }
+        out = StringIO()
+        call_command('resolve_antinomias', stdout=out)
+
+        validos = dict(Chunk.objects.values_list('id', 'is_valido_apos_antinomia'))
+        self.assertEqual([validos[chunks[key].id] for key in textos], [False, True, False, True, True, False])
+        regras = dict(Chunk.objects.values_list('id', 'regra_antinomia__nome'))
+        self.assertEqual([regras[chunks[key].id] for key in textos],
+                         [None, None, 'nota-revogado', None, 'disposicoes-em-contrario', 'nota-foi-revogado'])
+        self.assertIn('Marcado 1 chunks de "revogada.html" como inválidos (Documento Revogado).', out.getvalue())
+        self.assertIn('marcado como inválido (regra "nota-revogado")', out.getvalue())
+        self.assertIn('Tempo da busca no texto', out.getvalue())
+        self.assertEqual(RegraAntinomia.objects.get(nome='disposicoes-em-contrario').acertos, 1)
+        self.assertEqual(current_index_version(), 1)
+
+        # Sem mudança na validade, uma nova execução não invalida as respostas em cache
+        out = StringIO()
+        call_command('resolve_antinomias', stdout=out)
+        self.assertEqual(dict(Chunk.objects.values_list('id', 'is_valido_apos_antinomia')), validos)
+        self.assertEqual(current_index_version(), 1)
+        self.assertIn('A validade dos chunks não mudou', out.getvalue())
+
+    def test_workers_em_paralelo_dao_o_mesmo_resultado(self):
+        vigente = Documento.objects.create(nome_arquivo='vigente.html', arquivo='documentos/vigente.html', status='VIGENTE')
+        modelos = [
+            'Art. {n}º Texto em vigor.',
+            'Art. {n}º (Revogado pela Lei 10/1990)',
+            'Art. {n}º Revogadas as disposições em contrário, esta Lei entra em vigor.',
+            'b) (Esta alínea foi revogada pela Lei 20/2000)',
+            'Art. {n}º Ficam irrevogáveis as concessões.',
+        ]
+        for ordem in range(40):
+            texto = modelos[ordem % len(modelos)].format(n=ordem + 1)
+            Chunk.objects.create(documento=vigente, ordem_no_documento=ordem, conteudo_original=texto, conteudo_tratado=texto)
+
+        resultados = []
+        for workers in ('1', '2'):
+            Chunk.objects.update(is_valido_apos_antinomia=True, regra_antinomia=None)
+            out = StringIO()
+            call_command('resolve_antinomias', '--workers', workers, '--batch-size', '7', stdout=out)
+            resultados.append((
+                list(Chunk.objects.order_by('id').values_list('id', 'is_valido_apos_antinomia', 'regra_antinomia__nome')),
+                dict(RegraAntinomia.objects.values_list('nome', 'acertos')),
+                [line for line in out.getvalue().splitlines() if line.startswith('Chunk ')],
+            ))
+        self.assertEqual(resultados[0], resultados[1])
+        self.assertEqual(len(resultados[0][2]), 16)
+
+    def test_grafo_de_revogacoes_entre_normas(self):
+        antiga = Documento.objects.create(nome_arquivo='antiga.html', arquivo='documentos/antiga.html', status='VIGENTE', lei_cod='LE000051950')
+        nova = Documento.objects.create(nome_arquivo='nova.html', arquivo='documentos/nova.html', status='VIGENTE', lei_cod='LE000071951')
+        outra = Documento.objects.create(nome_arquivo='outra.html', arquivo='documentos/outra.html', status='VIGENTE', lei_cod='LE000091952')
+        textos = [
+            (antiga, 'Art. 1º O imposto será cobrado anualmente.', 1),
+            (antiga, 'Parágrafo único. O pagamento poderá ser parcelado.', 1),
+            (antiga, 'Art. 2º Esta Lei entra em vigor na data de sua publicação.', 2),
+            (nova, 'Art. 1º Fica revogado o art. 1º da Lei nº 5, de 1950.', 1),
+            (outra, 'Art. 3º (Este artigo foi revogado pelo', 3),
+            (outra, 'art. 1º da Lei Municipal nº 7, de 12.05.1951)', 3),
+            (outra, 'Art. 4º Conforme a Lei nº 5/1950, o prazo é de trinta dias.', 4),
+        ]
+        chunks = [
+            Chunk.objects.create(documento=documento, ordem_no_documento=ordem, conteudo_original=texto,
+                                 conteudo_tratado=texto, numero_artigo=artigo, caminho_estrutural=f'Art. {artigo}º')
+            for ordem, (documento, texto, artigo) in enumerate(textos)
+        ]
+        call_command('resolve_antinomias', stdout=StringIO())
+
+        resultado = {chunk.id: (chunk.is_valido_apos_antinomia, chunk.revogado_por_chunk_id) for chunk in Chunk.objects.all()}
+        revogador = chunks[3].id
+        self.assertEqual([resultado[chunk.id] for chunk in chunks], [
+            (False, revogador), (False, revogador), (True, None), (True, None),
+            (False, revogador), (False, revogador), (True, None),
+        ])
+        self.assertEqual(
+            sorted(CitacaoNorma.objects.values_list('chunk_id', 'tipo', 'lei_cod', 'numero_artigo', 'documento_citado_id')),
+            sorted([(chunks[3].id, 'REVOGA', 'LE000051950', 1, antiga.id),
+                    (chunks[4].id, 'REVOGADO_POR', 'LE000071951', 1, nova.id),
+                    (chunks[6].id, 'CITA', 'LE000051950', None, antiga.id)]),
+        )
+        answer = views._citation_answer(Citation('LE', 5, 1950, 1), lookup_article(Citation('LE', 5, 1950, 1)))
+        self.assertIn('consta como revogado', answer)
+        self.assertIn('Revogado por: Art. 1º (nova.html).', answer)
+
+        # Documento revogado depois da última execução: o status basta para o aviso
+        Documento.objects.filter(pk=outra.pk).update(status='REVOGADO')
+        answer = views._citation_answer(Citation('LE', 9, 1952, 4), lookup_article(Citation('LE', 9, 1952, 4)))
+        self.assertIn('consta como revogado', answer)
+        self.assertNotIn('Revogado por', answer)
+
+    def test_nota_de_alinea_so_invalida_o_chunk_que_so_tem_a_nota(self):
+        nova = Documento.objects.create(nome_arquivo='nova.html', arquivo='documentos/nova.html', status='VIGENTE', lei_cod='LE000071951')
+        antiga = Documento.objects.create(nome_arquivo='antiga.html', arquivo='documentos/antiga.html', status='VIGENTE', lei_cod='LE000051950')
+        textos = [
+            (nova, 'Art. 1º Altera a Lei nº 5, de 1950.', 1),
+            (antiga, 'Art. 5º O tributo incide sobre: a) imóveis; b) (Esta alínea foi revogada pela Lei nº 7, de 1951)', 5),
+            (antiga, 'c) (Esta alínea foi revogada pela Lei nº 7, de 1951)', 5),
+            (antiga, '§ 1º O prazo é de trinta dias. § 2º (Este parágrafo foi revogado pela Lei nº 7, de 1951)', 5),
+            (antiga, '§ 3º (Este parágrafo foi revogado pela Lei nº 7, de 1951)', 5),
+        ]
+        chunks = [
+            Chunk.objects.create(documento=documento, ordem_no_documento=ordem, conteudo_original=texto,
+                                 conteudo_tratado=texto, numero_artigo=artigo)
+            for ordem, (documento, texto, artigo) in enumerate(textos)
+        ]
+        RegraAntinomia.objects.all().delete()
+        call_command('resolve_antinomias', stdout=StringIO())
+
+        resultado = dict(Chunk.objects.values_list('id', 'is_valido_apos_antinomia'))
+        self.assertEqual([resultado[chunk.id] for chunk in chunks], [True, True, False, True, False])
+        # A nota dos chunks com outras alíneas e parágrafos continua no grafo
+        notas = CitacaoNorma.objects.filter(tipo='REVOGADO_POR').order_by('chunk_id').values_list('chunk_id', flat=True)
+        self.assertEqual(list(notas), [chunk.id for chunk in chunks[1:]])
+
+    def test_revogacao_desfeita_quando_o_revogador_sai_do_acervo(self):
+        # Só os chunks de documentos vigentes voltam a ser válidos pelas regras de status
+        antiga = Documento.objects.create(nome_arquivo='antiga.html', arquivo='documentos/antiga.html', status='PARCIALMENTE_REVOGADO', lei_cod='LE000051950')
+        nova = Documento.objects.create(nome_arquivo='nova.html', arquivo='documentos/nova.html', status='VIGENTE', lei_cod='LE000071951')
+        textos = [
+            (antiga, 'Art. 1º O imposto será cobrado anualmente.', 1),
+            (antiga, 'Art. 2º (Revogado pela Lei nº 7, de 1951)', 2),
+            (nova, 'Art. 1º Fica revogado o art. 1º da Lei nº 5, de 1950.', 1),
+        ]
+        chunks = [
+            Chunk.objects.create(documento=documento, ordem_no_documento=ordem, conteudo_original=texto,
+                                 conteudo_tratado=texto, numero_artigo=artigo)
+            for ordem, (documento, texto, artigo) in enumerate(textos)
+        ]
+        call_command('resolve_antinomias', stdout=StringIO())
+        self.assertEqual(Chunk.objects.get(pk=chunks[0].pk).revogado_por_chunk_id, chunks[2].pk)
+
+        chunks[2].delete()
+        out = StringIO()
+        call_command('resolve_antinomias', stdout=out)
+        resultado = dict(Chunk.objects.values_list('id', 'is_valido_apos_antinomia'))
+        # O artigo revogado pelo chunk apagado volta a valer; o que traz a nota de revogação continua inválido
+        self.assertEqual([resultado[chunks[0].pk], resultado[chunks[1].pk]], [True, False])
+        revalidado = Chunk.objects.get(pk=chunks[0].pk)
+        self.assertEqual((revalidado.revogado_por_chunk_id, revalidado.revogado_por_citacao), (None, False))
+        self.assertIn(f'Chunk {chunks[0].pk} de "antiga.html" voltou a ser válido', out.getvalue())
+
+        # Sem mudanças no acervo, uma nova execução não invalida nem revalida nada
+        call_command('resolve_antinomias', stdout=out)
+        self.assertEqual(dict(Chunk.objects.values_list('id', 'is_valido_apos_antinomia')), resultado)
+
+
+def parse_sse(content):
+    """
+    Lista de (evento, dados) de uma resposta text/event-stream.
+    """
+    events = []
+    for block in content.decode('utf-8').strip().split('\n\n'):
+        fields = dict(line.split(': ', 1) for line in block.splitlines())
+        events.append((fields['event'], json.loads(fields['data'])))
+    return events
+
+
+@override_settings(MELCHIOR_EMBEDDING_PROVIDER='fake', MELCHIOR_EMBEDDING_PROVIDER_OPTIONS={'dimension': 8},
+                   MELCHIOR_ANSWER_BACKEND='fake', MELCHIOR_ANSWER_MODEL_OPTIONS={})
+class StreamingSearchTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        documento = Documento.objects.create(nome_arquivo='lei.html', arquivo='documentos/lei.html', hierarquia='LEI_MUNICIPAL')
+        cls.chunk = Chunk.objects.create(documento=documento, conteudo_original='', ordem_no_documento=1,
+                                         conteudo_tratado='Art. 1º O Alvará de construção será expedido pela Prefeitura.')
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        embedding_cache = EmbeddingCache(os.path.join(directory.name, 'cache.sqlite3'))
+        self.addCleanup(embedding_cache.close)
+        # Sem índice vetorial: os resultados vêm só da busca lexical
+        empty_store = mock.Mock(search=mock.Mock(return_value=[]))
+        for target, value in (('get_embedding_cache', embedding_cache), ('get_vector_store', empty_store)):
+            patcher = mock.patch(f'melchior.views.{target}', return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        views.answer_cache.cache.clear()
+        self.factory = RequestFactory()
+
+    def stream(self, **params):
+        response = views.melchior_search_stream_view(self.factory.get('/melchior/search/stream/', params))
+        self.assertEqual(response['Content-Type'], 'text/event-stream; charset=utf-8')
+        return parse_sse(b''.join(response.streaming_content))
+
+    def test_fontes_antes_da_resposta_aos_pedacos(self):
+        with self.assertLogs('melchior.views', 'INFO') as logs:
+            events = self.stream(q='alvará de construção')
+        self.assertIn('contexto: 25 -> 25 tokens estimados', logs.output[0])
+        self.assertEqual(events[0][0], 'fontes')
+        self.assertEqual([fonte['conteudo_tratado'] for fonte in events[0][1]], [self.chunk.conteudo_tratado])
+        pieces = [data['texto'] for event, data in events if event == 'resposta']
+        self.assertGreater(len(pieces), 1)
+        self.assertEqual(events[-1], ('fim', {}))
+        answer = ''.join(pieces)
+        self.assertEqual(answer, "Resposta simulada para 'alvará de construção' com base em 1 fonte(s).")
+
+        # A resposta completa fica no cache e a próxima busca a devolve de uma vez
+        self.assertEqual([data for event, data in self.stream(q='alvará de construção') if event == 'resposta'],
+                         [{'texto': answer}])
+
+    def test_erro_vira_evento(self):
+        self.assertEqual(self.stream(q='alvará', status='QUALQUER'), [('erro', {'mensagem': "Status desconhecido: 'QUALQUER'."})])
+
+    def test_modelo_de_resposta_configuravel(self):
+        with override_settings(MELCHIOR_ANSWER_MODEL_OPTIONS={'token_latency': 0.5}):
+            model = get_answer_model()
+        self.assertIsInstance(model, FakeAnswerModel)
+        self.assertEqual(model.token_latency, 0.5)
+        self.assertEqual(model.generate('Fontes:\n---\n\nPergunta: IPTU?'), "Resposta simulada para 'IPTU?' com base em 1 fonte(s).")
+
+    def test_stream_assincrono_igual_ao_sincrono(self):
+        prompt = 'Fontes:\n---\n\nPergunta: IPTU?'
+
+        async def collect(model):
+            return [piece async for piece in model.astream(prompt)]
+
+        model = FakeAnswerModel()
+        self.assertEqual(async_to_sync(collect)(model), list(model.stream(prompt)))
+        # Modelos sem astream() próprio leem o stream() no pool de threads
+        with mock.patch.object(FakeAnswerModel, 'astream', BaseAnswerModel.astream):
+            self.assertEqual(async_to_sync(collect)(model), list(model.stream(prompt)))
+
+
+@override_settings(MELCHIOR_EMBEDDING_PROVIDER='fake', MELCHIOR_EMBEDDING_PROVIDER_OPTIONS={'dimension': 8},
+                   MELCHIOR_ANSWER_BACKEND='fake', MELCHIOR_ANSWER_MODEL_OPTIONS={})
+class AsyncSearchTests(TransactionTestCase):
+    # TransactionTestCase: o pool de threads da view assíncrona usa outras conexões, que não veem a transação de um TestCase
+
+    def setUp(self):
+        documento = Documento.objects.create(nome_arquivo='lei.html', arquivo='documentos/lei.html', hierarquia='LEI_MUNICIPAL')
+        self.chunk = Chunk.objects.create(documento=documento, conteudo_original='', ordem_no_documento=1,
+                                          conteudo_tratado='Art. 1º O Alvará de construção será expedido pela Prefeitura.')
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        embedding_cache = EmbeddingCache(os.path.join(directory.name, 'cache.sqlite3'))
+        self.addCleanup(embedding_cache.close)
+        self.store = mock.Mock(search=mock.Mock(return_value=[]))
+        for target, value in (('get_embedding_cache', embedding_cache), ('get_vector_store', self.store)):
+            patcher = mock.patch(f'melchior.views.{target}', return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        views.answer_cache.cache.clear()
+        services.reset()
+        self.addCleanup(services.reset)
+
+    async def test_stream_assincrono_envia_aos_pedacos(self):
+        request = AsyncRequestFactory().get('/melchior/search/stream/', {'q': 'alvará'})
+        with override_settings(MELCHIOR_ANSWER_MODEL_OPTIONS={'token_latency': 0.05}), self.assertLogs('melchior.views', 'INFO'):
+            response = await sync_to_async(views.melchior_search_stream_view)(request)
+            self.assertTrue(response.is_async)
+            arrivals = []
+            async for chunk in response.streaming_content:
+                arrivals.append((time.perf_counter(), chunk))
+        events = parse_sse(b''.join(chunk for _arrival, chunk in arrivals))
+        self.assertEqual([event for event, _data in events][:2], ['fontes', 'resposta'])
+        self.assertEqual(events[-1], ('fim', {}))
+        self.assertEqual(''.join(data['texto'] for event, data in events if event == 'resposta'),
+                         "Resposta simulada para 'alvará' com base em 1 fonte(s).")
+        # Cada pedaço chega quando é gerado, não todos juntos no fim
+        answer_arrivals = [arrival for arrival, chunk in arrivals if chunk.startswith(b'event: resposta')]
+        self.assertGreater(answer_arrivals[-1] - answer_arrivals[0], 0.05 * (len(answer_arrivals) - 2))
+        self.assertFalse(views.melchior_search_stream_view(RequestFactory().get('/melchior/search/stream/')).is_async)
+
+    async def test_mesma_resposta_da_view_sincrona(self):
+        with self.assertLogs('melchior.views', 'INFO'):
+            response = await views.melchior_search_async_view(AsyncRequestFactory().get('/melchior/search/async/', {'q': 'alvará'}))
+        content = response.content.decode('utf-8')
+        self.assertIn("Resposta simulada para &#x27;alvará&#x27; com base em 1 fonte(s).", content)
+        self.assertIn('Art. 1º O Alvará de construção', content)
+        # O embedding da pergunta chegou à busca vetorial
+        self.assertEqual(len(self.store.search.call_args.args[0]), 8)
+
+    async def test_trabalho_bloqueante_no_pool_limitado(self):
+        thread_name = await services.run_blocking(lambda: threading.current_thread().name)
+        self.assertTrue(thread_name.startswith('melchior'))
+        prepared = await views.aprepare_answer('alvará', SearchFilters(hierarquias=('RESOLUCAO',)), FakeAnswerModel())
+        self.assertEqual((prepared.chunks, prepared.answer), ([], views.NO_RESULTS_ANSWER))
@@ -7,5 +7,7 @@ app_name = 'melchior' # <--- ADICIONE ESTA LINHA AQUI!
 
 urlpatterns = [
     path('search/', views.melchior_search_view, name='melchior_search'), # URL para a busca do Melchior
+    path('search/stream/', views.melchior_search_stream_view, name='melchior_search_stream'), # A mesma busca, como server-sent events
+    path('search/async/', views.melchior_search_async_view, name='melchior_search_async'), # A mesma busca, assíncrona (ASGI)
     # Adicione mais URLs para Melchior conforme necessário
 ]
\ No newline at end of file
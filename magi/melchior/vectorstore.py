@@ -0,0 +1,511 @@
+# nerv/magi/melchior/vectorstore.py
+
+"""
+Backends de busca vetorial usados pela busca do Melchior.
+
+O ChromaVectorStore consulta a coleção do ChromaDB gerada pelo generate_embeddings. O
+NumpyVectorStore faz busca exata (força bruta) sobre uma matriz float32 contígua montada a partir
+de Chunk.embedding pelo build_vector_index: a matriz é aberta com memmap, então todos os workers
+web compartilham as mesmas páginas do cache do sistema operacional. O IvfVectorStore faz busca
+aproximada, olhando só as partições (k-means) mais próximas da consulta. O backend usado pela
+view é escolhido pelo setting MELCHIOR_VECTOR_BACKEND.
+"""
+
+import json
+import os
+import threading
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+from django.conf import settings
+
+from melchior.embedding_cache import bytes_to_vector
+from melchior.services import CHROMA_COLLECTION_NAME, chroma_db_path, get_chroma_client
+
+META_FILE = 'meta.json'
+# Prefixos dos arquivos versionados dos índices (removidos quando um build novo é publicado)
+INDEX_FILE_PREFIXES = ('vetores-', 'ids-', 'centroides-', 'offsets-', 'int8-', 'escala-', 'bits-')
+
+# Máscaras de filtros guardadas por índice carregado (uma por combinação de filtros e versão do índice)
+MASK_CACHE_SIZE = 32
+
+QUANTIZATIONS = ('int8', 'binary')
+QUANTIZATION_BLOCK_ROWS = 16384
+
+# Quantidade de bits 1 em cada byte, para a distância de Hamming dos vetores binários
+_POPCOUNT = np.array([bin(byte).count('1') for byte in range(256)], dtype=np.uint8)
+
+def default_index_dir():
+    return getattr(settings, 'MELCHIOR_VECTOR_INDEX_DIR', os.path.join(settings.BASE_DIR, 'vector_index'))
+
+
+class BaseVectorStore:
+    """
+    Interface dos backends: search() devolve [(id do chunk, score)] dos k mais próximos, do mais
+    para o menos similar (score maior = mais similar).
+
+    filters é um melchior.retrieval.SearchFilters opcional. Cada backend aplica dentro da busca o que
+    consegue; a conferência final contra o banco fica com melchior.retrieval.retrieve().
+    """
+    name = None
+
+    def search(self, query_vector, k, filters=None):
+        raise NotImplementedError
+
+    def warm_up(self):
+        """
+        Abre os arquivos ou conexões do backend antes da primeira consulta.
+        """
+
+
+class ChromaVectorStore(BaseVectorStore):
+    """
+    Busca na coleção persistente do ChromaDB. O cliente só é aberto na primeira consulta.
+    """
+    name = 'chroma'
+
+    def __init__(self, path=None, collection_name=CHROMA_COLLECTION_NAME):
+        self.path = path or chroma_db_path()
+        self.collection_name = collection_name
+        self._collection = None
+        self._lock = threading.Lock()
+
+    @property
+    def collection(self):
+        with self._lock:
+            if self._collection is None:
+                client = get_chroma_client(self.path)
+                # Sem função de embedding: as consultas sempre chegam com o vetor pronto
+                self._collection = client.get_collection(name=self.collection_name)
+            return self._collection
+
+    def warm_up(self):
+        self.collection
+
+    def search(self, query_vector, k, filters=None):
+        where = filters.chroma_where() if filters is not None else None
+        results = self.collection.query(query_embeddings=[list(query_vector)], n_results=k, where=where, include=['distances'])
+        ids = results['ids'][0] if results and results['ids'] else []
+        distances = results['distances'][0] if results and results.get('distances') else [0.0] * len(ids)
+        return [(int(result_id.split('_')[1]), -float(distance)) for result_id, distance in zip(ids, distances)]
+
+
+def _top_k(scores, k):
+    # Índices dos k maiores scores, do maior para o menor, sem ordenar o vetor inteiro
+    if k < len(scores):
+        top = np.argpartition(scores, -k)[-k:]
+    else:
+        top = np.arange(len(scores))
+    return top[np.argsort(-scores[top], kind='stable')]
+
+
+def _masked_top_k(scores, k, mask):
+    if mask is None:
+        return _top_k(scores, k)
+    allowed = int(np.count_nonzero(mask))
+    if not allowed:
+        return np.empty(0, dtype=np.int64)
+    return _top_k(np.where(mask, scores, -np.inf), min(k, allowed))
+
+
+def _normalized_query(query_vector):
+    query = np.asarray(query_vector, dtype=np.float32)
+    norm = np.linalg.norm(query)
+    return query / norm if norm else query
+
+
+class NumpyVectorStore(BaseVectorStore):
+    """
+    Busca exata por similaridade de cosseno sobre a matriz memory-mapped gerada por build_numpy_index().
+
+    Os vetores são gravados já normalizados, então a similaridade é um único produto matriz-vetor,
+    seguido de argpartition para separar os k maiores sem ordenar a matriz inteira. Se o índice
+    for reconstruído, a próxima consulta abre os arquivos novos.
+
+    Com quantization ('int8' ou 'binary', gravadas pelo build_vector_index --quantize), a varredura
+    completa usa a cópia quantizada (4x ou 32x menor) para escolher 'candidates' candidatos, que
+    são reordenados com os vetores float32: só as linhas desses candidatos são lidas do disco.
+    """
+    name = 'numpy'
+
+    def __init__(self, directory=None, quantization=None, candidates=None):
+        self.directory = directory or default_index_dir()
+        self.quantization = quantization if quantization is not None else getattr(settings, 'MELCHIOR_VECTOR_QUANTIZATION', None)
+        if self.quantization and self.quantization not in QUANTIZATIONS:
+            raise ValueError(f"Quantização desconhecida: '{self.quantization}'. Opções: {', '.join(QUANTIZATIONS)}.")
+        self.candidates = candidates or getattr(settings, 'MELCHIOR_VECTOR_RERANK_CANDIDATES', 100)
+        self._loaded_version = None
+        self.matrix = None
+        self.ids = None
+        self.meta = None
+        self.quantized = None
+        self.scale = None
+        self._masks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _meta_path(self):
+        return os.path.join(self.directory, META_FILE)
+
+    def load(self):
+        """
+        (matrix, ids, quantized, scale) do mesmo build, lidos juntos sob o lock: um reload entre
+        leituras separadas dos atributos misturaria candidatos de um índice com ids de outro.
+        """
+        with self._lock:
+            self._refresh()
+            return self.matrix, self.ids, self.quantized, self.scale
+
+    def _refresh(self):
+        # Reabre os arquivos se o meta.json mudou. Quem chama segura self._lock: os atributos do
+        # índice são sempre trocados juntos
+        try:
+            stat = os.stat(self._meta_path())
+            version = (stat.st_ino, stat.st_mtime_ns)
+        except FileNotFoundError:
+            raise FileNotFoundError(f'Índice vetorial não encontrado em {self.directory}. Execute o comando build_vector_index.')
+        if version != self._loaded_version:
+            with open(self._meta_path(), encoding='utf-8') as f:
+                meta = json.load(f)
+            self._open_files(meta)
+            self.meta = meta
+            self._loaded_version = version
+            self._masks.clear()
+
+    def _open_files(self, meta):
+        self.ids = np.load(os.path.join(self.directory, meta['ids']), mmap_mode='r')
+        if meta['quantidade']:
+            self.matrix = np.memmap(os.path.join(self.directory, meta['vetores']), dtype=np.float32, mode='r',
+                                    shape=(meta['quantidade'], meta['dimensao']))
+        else:
+            self.matrix = np.empty((0, meta['dimensao']), dtype=np.float32)
+        self.quantized, self.scale = self._load_quantized(meta)
+
+    def warm_up(self):
+        self.load()
+
+    def _allowed_mask(self, ids, filters):
+        """
+        Linhas do índice cujos chunks passam nos filtros do documento (None = todas). A máscara custa
+        uma varredura de todos os ids, então é guardada por filters.mask_key() até o índice ser recarregado.
+        """
+        if filters is None or not filters.restricts_documents:
+            return None
+        key = filters.mask_key()
+        with self._lock:
+            cached = self._masks.get(key)
+            # Cada máscara vale só para o array de ids em que foi montada
+            if cached is not None and cached[0] is ids:
+                self._masks.move_to_end(key)
+                return cached[1]
+        mask = np.isin(ids, filters.allowed_ids(), assume_unique=True)
+        with self._lock:
+            if self.ids is ids:
+                self._masks[key] = (ids, mask)
+                while len(self._masks) > MASK_CACHE_SIZE:
+                    self._masks.popitem(last=False)
+        return mask
+
+    def _load_quantized(self, meta):
+        if not self.quantization or not meta['quantidade']:
+            return None, None
+        if self.quantization not in meta.get('quantizacoes', []):
+            raise FileNotFoundError(f"O índice em {self.directory} não tem a quantização '{self.quantization}'. "
+                                    f"Execute o build_vector_index --quantize {self.quantization}.")
+        if self.quantization == 'int8':
+            return np.load(os.path.join(self.directory, meta['int8']), mmap_mode='r'), \
+                   np.load(os.path.join(self.directory, meta['escala']))
+        return np.load(os.path.join(self.directory, meta['bits']), mmap_mode='r'), None
+
+    def search(self, query_vector, k, filters=None):
+        matrix, ids, quantized, scale = self.load()
+        if not len(ids) or k <= 0:
+            return []
+        query = _normalized_query(query_vector)
+        # Chunks fora dos filtros nunca entram no top-k (nem entre os candidatos da quantização)
+        mask = self._allowed_mask(ids, filters)
+        if quantized is None:
+            scores = matrix @ query
+            return [(int(ids[i]), float(scores[i])) for i in _masked_top_k(scores, k, mask)]
+
+        # 1ª etapa: scores aproximados sobre a cópia quantizada; 2ª: reordenação exata dos candidatos
+        candidates = np.sort(_masked_top_k(self.quantized_scores(query, quantized, scale), max(k, self.candidates), mask))
+        scores = matrix[candidates] @ query
+        return [(int(ids[candidates[i]]), float(scores[i])) for i in _top_k(scores, k)]
+
+    def quantized_scores(self, query, quantized, scale):
+        """
+        Scores aproximados de todos os vetores contra a consulta normalizada, usando a cópia quantizada
+        (e a escala, no int8) devolvida pelo load().
+
+        A conversão para float32 é feita em blocos de linhas, para não materializar a matriz inteira.
+        """
+        scores = np.empty(len(quantized), dtype=np.float32)
+        if self.quantization == 'int8':
+            scaled_query = query * scale
+            for start in range(0, len(scores), QUANTIZATION_BLOCK_ROWS):
+                block = quantized[start:start + QUANTIZATION_BLOCK_ROWS]
+                scores[start:start + QUANTIZATION_BLOCK_ROWS] = block.astype(np.float32) @ scaled_query
+        else:
+            # Similaridade = -distância de Hamming entre os sinais
+            query_bits = np.packbits(query > 0)
+            for start in range(0, len(scores), QUANTIZATION_BLOCK_ROWS):
+                block = quantized[start:start + QUANTIZATION_BLOCK_ROWS]
+                scores[start:start + QUANTIZATION_BLOCK_ROWS] = -_POPCOUNT[block ^ query_bits].sum(axis=1, dtype=np.int32)
+        return scores
+
+    @property
+    def scanned_bytes(self):
+        """
+        Bytes varridos por consulta na etapa completa (matriz float32 ou cópia quantizada).
+        """
+        matrix, _ids, quantized, _scale = self.load()
+        return (quantized if quantized is not None else matrix).nbytes
+
+
+def quantize_int8(matrix):
+    """
+    Quantização escalar simétrica por dimensão: x ≈ q * escala, com q em int8 [-127, 127].
+    """
+    scale = np.zeros(matrix.shape[1], dtype=np.float32)
+    for start in range(0, len(matrix), QUANTIZATION_BLOCK_ROWS):
+        scale = np.maximum(scale, np.abs(matrix[start:start + QUANTIZATION_BLOCK_ROWS]).max(axis=0))
+    scale = np.where(scale == 0, 1, scale / 127).astype(np.float32)
+    quantized = np.empty(matrix.shape, dtype=np.int8)
+    for start in range(0, len(matrix), QUANTIZATION_BLOCK_ROWS):
+        block = matrix[start:start + QUANTIZATION_BLOCK_ROWS] / scale
+        quantized[start:start + QUANTIZATION_BLOCK_ROWS] = np.clip(np.rint(block), -127, 127)
+    return quantized, scale
+
+
+def quantize_binary(matrix):
+    """
+    Quantização binária: 1 bit por dimensão (o sinal), empacotado em bytes.
+    """
+    return np.packbits(matrix > 0, axis=1)
+
+
+def build_numpy_index(chunks, directory, dimension, model, quantizations=()):
+    """
+    Grava o índice do NumpyVectorStore a partir de (id, embedding em bytes float32) dos chunks.
+    quantizations ('int8', 'binary') grava também as cópias quantizadas, alinhadas à matriz.
+
+    chunks precisa poder ser percorrido duas vezes (ex.: um callable que devolve um iterador novo):
+    a primeira passada conta os vetores para dimensionar o arquivo. Cada build grava arquivos com
+    um sufixo novo e só no final troca o meta.json que aponta para eles, para que nenhum worker
+    leia um índice pela metade. Devolve a quantidade de vetores gravados.
+    """
+    os.makedirs(directory, exist_ok=True)
+    count = sum(1 for _chunk in chunks())
+    version = uuid.uuid4().hex[:12]
+    vectors_name = f'vetores-{version}.f32'
+    ids_name = f'ids-{version}.npy'
+    vectors_tmp = os.path.join(directory, vectors_name)
+    ids_tmp = os.path.join(directory, ids_name)
+
+    ids = np.zeros(count, dtype=np.int64)
+    if count:
+        matrix = np.memmap(vectors_tmp, dtype=np.float32, mode='w+', shape=(count, dimension))
+        row = 0
+        for chunk_id, data in chunks():
+            if row >= count:
+                break
+            vector = np.asarray(bytes_to_vector(data), dtype=np.float32)
+            if len(vector) != dimension:
+                raise ValueError(f'O embedding do chunk {chunk_id} tem dimensão {len(vector)}, esperado {dimension}.')
+            norm = np.linalg.norm(vector)
+            matrix[row] = vector / norm if norm else vector
+            ids[row] = chunk_id
+            row += 1
+        matrix.flush()
+        count = row
+        ids = ids[:count]
+    else:
+        open(vectors_tmp, 'wb').close()
+    with open(ids_tmp, 'wb') as f:
+        np.save(f, ids)
+    meta = {'quantidade': count, 'dimensao': dimension, 'modelo': model, 'vetores': vectors_name, 'ids': ids_name,
+            'quantizacoes': []}
+    if count:
+        for quantization in quantizations:
+            if quantization == 'int8':
+                quantized, scale = quantize_int8(matrix[:count])
+                meta['int8'] = f'int8-{version}.npy'
+                meta['escala'] = f'escala-{version}.npy'
+                np.save(os.path.join(directory, meta['escala']), scale)
+            elif quantization == 'binary':
+                quantized = quantize_binary(matrix[:count])
+                meta['bits'] = f'bits-{version}.npy'
+            else:
+                raise ValueError(f"Quantização desconhecida: '{quantization}'. Opções: {', '.join(QUANTIZATIONS)}.")
+            np.save(os.path.join(directory, meta['int8' if quantization == 'int8' else 'bits']), quantized)
+            meta['quantizacoes'].append(quantization)
+        del matrix
+    _publish_index(directory, meta)
+    return count
+
+
+def _publish_index(directory, meta):
+    # A troca do meta.json é o que faz os workers recarregarem o índice
+    meta_tmp = os.path.join(directory, META_FILE + '.tmp')
+    with open(meta_tmp, 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    os.replace(meta_tmp, os.path.join(directory, META_FILE))
+
+    # Arquivos de builds anteriores: quem ainda os tem mapeados continua lendo até recarregar
+    current = set(value for value in meta.values() if isinstance(value, str))
+    for name in os.listdir(directory):
+        if name.startswith(INDEX_FILE_PREFIXES) and name not in current:
+            os.remove(os.path.join(directory, name))
+
+
+def default_ivf_index_dir():
+    return getattr(settings, 'MELCHIOR_IVF_INDEX_DIR', os.path.join(settings.BASE_DIR, 'vector_index_ivf'))
+
+
+def spherical_kmeans(matrix, nlist, iterations=20, seed=0, block_size=8192):
+    """
+    K-means com similaridade de cosseno sobre vetores normalizados. Devolve os centroides (normalizados).
+
+    As atribuições são calculadas em blocos de linhas para não materializar a matriz n x nlist inteira.
+    Partições que ficam vazias recebem um vetor aleatório da amostra.
+    """
+    rng = np.random.default_rng(seed)
+    centroids = matrix[rng.choice(len(matrix), size=nlist, replace=False)].astype(np.float32)
+    for _iteration in range(iterations):
+        assignments = assign_partitions(matrix, centroids, block_size)
+        counts = np.bincount(assignments, minlength=nlist)
+        empty = counts == 0
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        sums = np.zeros_like(centroids)
+        sums[~empty] = np.add.reduceat(matrix[np.argsort(assignments, kind='stable')], starts[~empty], axis=0)
+        if empty.any():
+            sums[empty] = matrix[rng.choice(len(matrix), size=int(empty.sum()), replace=False)]
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        centroids = sums / np.where(norms == 0, 1, norms)
+    return centroids.astype(np.float32)
+
+
+def assign_partitions(matrix, centroids, block_size=8192):
+    assignments = np.empty(len(matrix), dtype=np.int64)
+    for start in range(0, len(matrix), block_size):
+        block = np.asarray(matrix[start:start + block_size])
+        assignments[start:start + block_size] = np.argmax(block @ centroids.T, axis=1)
+    return assignments
+
+
+def build_ivf_index(source_directory, directory, nlist=None, iterations=20, sample_size=50000, seed=0):
+    """
+    Monta um índice IVF (inverted file) a partir do índice exato do NumpyVectorStore.
+
+    Os centroides são treinados com k-means esférico sobre uma amostra de até sample_size vetores
+    (no mínimo nlist, um por centroide inicial); depois todos os vetores são atribuídos à partição mais próxima e gravados agrupados por
+    partição, com a tabela de offsets de cada uma. nlist padrão: 4 * sqrt(n). Devolve o meta gravado.
+    """
+    source = NumpyVectorStore(source_directory)
+    matrix, ids, _quantized, _scale = source.load()
+    count, dimension = matrix.shape
+    if not count:
+        raise ValueError('O índice exato está vazio.')
+    if nlist is not None and nlist < 1:
+        raise ValueError('nlist deve ser maior ou igual a 1.')
+    if sample_size < 1:
+        raise ValueError('sample_size deve ser maior ou igual a 1.')
+    nlist = min(count, nlist or max(1, int(4 * count ** 0.5)))
+
+    rng = np.random.default_rng(seed)
+    sample = np.sort(rng.choice(count, size=min(count, max(sample_size, nlist)), replace=False))
+    centroids = spherical_kmeans(np.asarray(matrix[sample]), nlist, iterations, seed)
+
+    assignments = assign_partitions(matrix, centroids)
+    order = np.argsort(assignments, kind='stable')
+    offsets = np.zeros(nlist + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(assignments, minlength=nlist))
+
+    os.makedirs(directory, exist_ok=True)
+    version = uuid.uuid4().hex[:12]
+    names = {
+        'vetores': f'vetores-{version}.f32',
+        'ids': f'ids-{version}.npy',
+        'centroides': f'centroides-{version}.npy',
+        'offsets': f'offsets-{version}.npy',
+    }
+    vectors = np.memmap(os.path.join(directory, names['vetores']), dtype=np.float32, mode='w+', shape=(count, dimension))
+    for start in range(0, count, 8192):
+        vectors[start:start + 8192] = matrix[order[start:start + 8192]]
+    vectors.flush()
+    del vectors
+    np.save(os.path.join(directory, names['ids']), np.asarray(ids)[order])
+    np.save(os.path.join(directory, names['centroides']), centroids)
+    np.save(os.path.join(directory, names['offsets']), offsets)
+
+    meta = {'quantidade': int(count), 'dimensao': int(dimension), 'modelo': source.meta.get('modelo', ''),
+            'nlist': int(nlist), 'iteracoes': iterations, **names}
+    _publish_index(directory, meta)
+    return meta
+
+
+class IvfVectorStore(NumpyVectorStore):
+    """
+    Busca aproximada no índice IVF: compara a consulta com os centroides e faz busca exata apenas
+    nas nprobe partições mais próximas. nprobe maior aumenta o recall e a latência; com
+    nprobe == nlist o resultado é o mesmo da busca exata.
+    """
+    name = 'ivf'
+
+    def __init__(self, directory=None, nprobe=None):
+        # O IVF não tem cópias quantizadas: ignora MELCHIOR_VECTOR_QUANTIZATION
+        super().__init__(directory or default_ivf_index_dir(), quantization='')
+        self.nprobe = nprobe or getattr(settings, 'MELCHIOR_IVF_NPROBE', 8)
+        self.centroids = None
+        self.offsets = None
+
+    def _open_files(self, meta):
+        super()._open_files(meta)
+        self.centroids = np.load(os.path.join(self.directory, meta['centroides']))
+        self.offsets = np.load(os.path.join(self.directory, meta['offsets']))
+
+    def search(self, query_vector, k, filters=None):
+        # Matriz, ids, centroides e offsets do mesmo build: um reload entre as leituras misturaria índices
+        with self._lock:
+            self._refresh()
+            matrix, ids, centroids, offsets = self.matrix, self.ids, self.centroids, self.offsets
+        if not len(ids) or k <= 0:
+            return []
+        query = _normalized_query(query_vector)
+        mask = self._allowed_mask(ids, filters)
+        # Partições da mais para a menos próxima da consulta
+        order = np.argsort(-(centroids @ query), kind='stable')
+        nprobe = min(self.nprobe, len(order))
+        while True:
+            probes = np.sort(order[:nprobe])
+            # Cada partição é um intervalo contíguo da matriz: fatias, sem cópia por indexação
+            ranges = [(offsets[p], offsets[p + 1]) for p in probes if offsets[p + 1] > offsets[p]]
+            rows = np.concatenate([np.arange(start, end) for start, end in ranges]) if ranges else np.empty(0, dtype=np.int64)
+            allowed = mask[rows] if mask is not None else None
+            # Com filtros seletivos, as nprobe partições podem não ter k chunks permitidos: visita mais partições
+            if nprobe >= len(order) or (allowed is None and len(rows) >= k) or (allowed is not None and allowed.sum() >= k):
+                break
+            nprobe = min(nprobe * 2, len(order))
+        if not len(rows):
+            return []
+        scores = np.concatenate([matrix[start:end] @ query for start, end in ranges])
+        return [(int(ids[rows[i]]), float(scores[i])) for i in _masked_top_k(scores, k, allowed)]
+
+
+VECTOR_STORES = {
+    ChromaVectorStore.name: ChromaVectorStore,
+    NumpyVectorStore.name: NumpyVectorStore,
+    IvfVectorStore.name: IvfVectorStore,
+}
+
+
+def get_vector_store(name=None, **kwargs):
+    """
+    Instancia o backend informado ou, por padrão, o configurado em MELCHIOR_VECTOR_BACKEND.
+    """
+    name = name or getattr(settings, 'MELCHIOR_VECTOR_BACKEND', ChromaVectorStore.name)
+    try:
+        return VECTOR_STORES[name](**kwargs)
+    except KeyError:
+        raise ValueError(f"Backend vetorial desconhecido: '{name}'. Opções: {', '.join(VECTOR_STORES)}.")
@@ -1,123 +1,329 @@
 # nerv/magi/melchior/views.py
 
-import os
-import google.generativeai as genai
-import chromadb
-from chromadb.utils import embedding_functions
+import asyncio
+import json
+import logging
+from dataclasses import dataclass
+
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
 from django.shortcuts import render
 from django.conf import settings
-from .models import Chunk 
+from .models import Documento
+from .answer_cache import AnswerCache, current_index_version
+from .citations import lookup_article, parse_citation
+from .context import pack_context
+from .embedding_cache import QueryEmbeddingCache, get_embedding_cache
+from .embeddings import QUERY_TASK_TYPE, get_provider
+from .generation import build_prompt, get_answer_model
+from .retrieval import SearchFilters, ahybrid_retrieve, hybrid_retrieve
+from .services import get_vector_store, run_blocking
+
+# O cliente do Google AI Studio e o backend vetorial (MELCHIOR_VECTOR_BACKEND) são criados
+# pelo melchior.services na primeira busca e compartilhados pelas requisições seguintes.
+
+# Embeddings das perguntas: cache do Django (LRU + TTL) na frente do cache em disco
+query_cache = QueryEmbeddingCache()
+
+logger = logging.getLogger(__name__)
+
+# Respostas geradas, invalidadas pela versão do índice e pela versão do prompt (ver melchior.answer_cache)
+answer_cache = AnswerCache()
+
+SEARCH_K = 7
+NO_RESULTS_ANSWER = "Não foram encontrados documentos relevantes para a sua pergunta no momento."
+
+
+def _query_embedding_provider():
+    return get_provider(
+        getattr(settings, 'MELCHIOR_EMBEDDING_PROVIDER', 'gemini'),
+        task_type=QUERY_TASK_TYPE,
+        **getattr(settings, 'MELCHIOR_EMBEDDING_PROVIDER_OPTIONS', {}),
+    )
+
+
+def _cached_query_embedding(provider, query):
+    query_embedding = query_cache.get(provider.model_id, query)
+    if query_embedding is None:
+        query_embedding = get_embedding_cache().get(provider.model_id, provider.task_type, query)
+        if query_embedding is not None:
+            query_cache.set(provider.model_id, query, query_embedding)
+    return query_embedding
+
+
+def _remember_query_embedding(provider, query, query_embedding):
+    get_embedding_cache().put(provider.model_id, provider.task_type, query, query_embedding)
+    query_cache.set(provider.model_id, query, query_embedding)
+
+
+def embed_query(query):
+    """
+    Embedding da pergunta pelo provedor MELCHIOR_EMBEDDING_PROVIDER; perguntas repetidas não chamam a API.
+    """
+    provider = _query_embedding_provider()
+    query_embedding = _cached_query_embedding(provider, query)
+    if query_embedding is None:
+        query_embedding = provider.embed([query])[0]
+        _remember_query_embedding(provider, query, query_embedding)
+    return query_embedding
+
+
+async def aembed_query(query):
+    """
+    Versão assíncrona de embed_query(): os caches em disco rodam no pool de threads e a chamada à API é aguardada.
+    """
+    provider = _query_embedding_provider()
+    query_embedding = await run_blocking(_cached_query_embedding, provider, query)
+    if query_embedding is None:
+        query_embedding = (await provider.aembed([query]))[0]
+        await run_blocking(_remember_query_embedding, provider, query, query_embedding)
+    return query_embedding
+
 
-# --- Configuração da API do Google AI Studio ---
-API_KEY = os.getenv('GOOGLE_API_KEY')
+def _result_entry(chunk_obj):
+    return {
+        'ordem_no_documento': chunk_obj.ordem_no_documento,
+        'documento_nome': chunk_obj.documento.nome_arquivo,
+        'conteudo_tratado': chunk_obj.conteudo_tratado,
+        'documento_data_publicacao': chunk_obj.documento.data_publicacao,
+        'documento_hierarquia': chunk_obj.documento.hierarquia,
+    }
+
+
+def _citation_answer(citation, chunks):
+    answer = f"{citation}:\n" + "\n".join(chunk.conteudo_tratado for chunk in chunks)
+    # A validade já foi resolvida pelo resolve_antinomias (status do documento, regras e grafo de revogações);
+    # o status vale também para um documento marcado como revogado depois da última execução
+    if chunks[0].documento.status == 'REVOGADO' or not all(chunk.is_valido_apos_antinomia for chunk in chunks):
+        answer += "\n\nAtenção: este artigo consta como revogado ou inválido após a resolução de antinomias."
+        revokers = dict.fromkeys(chunk.revogado_por_chunk for chunk in chunks if chunk.revogado_por_chunk_id)
+        for revoker in revokers:
+            answer += f"\nRevogado por: {revoker.caminho_estrutural or revoker} ({revoker.documento.nome_arquivo})."
+    return answer
+
+
+@dataclass
+class PreparedAnswer:
+    """
+    Fontes de uma pergunta e, quando já se sabe a resposta (citação direta, cache ou nenhuma fonte),
+    a resposta pronta; senão, o prompt a ser enviado ao modelo e o contexto montado para ele.
+    """
+    chunks: list
+    answer: str = None
+    prompt: str = None
+    cache_key: tuple = ()
+    context: object = None
+
+    def remember(self, answer):
+        answer_cache.set(*self.cache_key, answer)
+
+    async def aremember(self, answer):
+        await answer_cache.aset(*self.cache_key, answer)
+
+
+def _prompt_answer(query, chunks, cache_key):
+    # Só o contexto montado (sem repetições, dentro do orçamento de tokens) vai para o LLM
+    context = pack_context(query, chunks)
+    logger.info('%s | pergunta: %r', context.summary(), query[:80])
+    return PreparedAnswer(chunks, prompt=build_prompt(query, context.passages), cache_key=cache_key, context=context)
 
-if not API_KEY:
-    raise Exception("Erro: A chave da API do Google AI Studio (GOOGLE_API_KEY) não foi encontrada nas variáveis de ambiente. "
-                    "Certifique-se de que seu arquivo .env está configurado corretamente e é carregado no settings.py.")
 
-genai.configure(api_key=API_KEY)
+def prepare_answer(query, filters, answer_model):
+    # Pergunta que só cita um artigo ("o que diz o art. 12 da LE 1234/1998"): o texto exato sai de
+    # uma consulta indexada, sem embedding, busca vetorial nem LLM
+    citation = parse_citation(query)
+    if citation:
+        chunks = lookup_article(citation)
+        if chunks:
+            return PreparedAnswer(chunks, answer=_citation_answer(citation, chunks))
 
-# --- Configuração do ChromaDB ---
-CHROMA_DB_PATH = os.path.join(settings.BASE_DIR, 'chroma_db')
-client = chromadb.PersistentClient(path=CHROMA_DB_PATH)
+    # Busca vetorial e lexical (BM25), fundidas por RRF. Os filtros (inclusive a validade após
+    # antinomias) entram nas duas buscas; os documentos vêm na mesma consulta dos chunks
+    chunks = [chunk for chunk, _score in hybrid_retrieve(get_vector_store(), query, embed_query(query), SEARCH_K, filters)]
+    if not chunks:
+        return PreparedAnswer([], answer=NO_RESULTS_ANSWER)
 
-COLLECTION_NAME = "melchior_chunks"
-gemini_embedding_function = embedding_functions.GoogleGenerativeAiEmbeddingFunction(api_key=API_KEY, model_name="embedding-001")
+    # Mesma pergunta, mesmos chunks, mesmo índice e mesmo prompt: a resposta já gerada vale
+    cache_key = (query, [chunk.id for chunk in chunks], current_index_version(), answer_model.prompt_version)
+    cached = answer_cache.get(*cache_key)
+    if cached is not None:
+        return PreparedAnswer(chunks, answer=cached)
+    return _prompt_answer(query, chunks, cache_key)
 
-try:
-    collection = client.get_collection(name=COLLECTION_NAME, embedding_function=gemini_embedding_function)
-except Exception as e:
-    raise Exception(f"Erro: Coleção ChromaDB '{COLLECTION_NAME}' não encontrada ou erro na inicialização. "
-                    f"Certifique-se de que 'generate_embeddings' foi executado com sucesso e o caminho do ChromaDB ({CHROMA_DB_PATH}) está correto. Erro: {e}")
+
+async def aprepare_answer(query, filters, answer_model):
+    """
+    Versão assíncrona de prepare_answer(). O embedding da pergunta, a abertura do backend vetorial, a
+    busca lexical e a versão do índice andam ao mesmo tempo; ORM e índice rodam no pool de threads.
+    """
+    citation = parse_citation(query)
+    if citation:
+        chunks = await run_blocking(lookup_article, citation)
+        if chunks:
+            return PreparedAnswer(chunks, answer=_citation_answer(citation, chunks))
+
+    query_embedding = asyncio.ensure_future(aembed_query(query))
+    index_version = asyncio.ensure_future(run_blocking(current_index_version))
+    try:
+        store = await run_blocking(get_vector_store)
+        results = await ahybrid_retrieve(store, query, query_embedding, SEARCH_K, filters)
+        index_version = await index_version
+    except BaseException:
+        query_embedding.cancel()
+        index_version.cancel()
+        raise
+    chunks = [chunk for chunk, _score in results]
+    if not chunks:
+        return PreparedAnswer([], answer=NO_RESULTS_ANSWER)
+
+    cache_key = (query, [chunk.id for chunk in chunks], index_version, answer_model.prompt_version)
+    cached = await answer_cache.aget(*cache_key)
+    if cached is not None:
+        return PreparedAnswer(chunks, answer=cached)
+    return _prompt_answer(query, chunks, cache_key)
+
+
+def _search_filters(request):
+    # Filtros da busca: ?status=VIGENTE&hierarquia=LEI_FEDERAL&data_inicio=2000-01-01&data_fim=2020-12-31
+    try:
+        return SearchFilters.from_query_params(request.GET), ""
+    except ValueError as e:
+        return None, str(e)
+
+
+def _search_context(query, results, generated_answer, error_message, filters):
+    return {
+        'query': query,
+        'results': results,
+        'generated_answer': generated_answer,
+        'error_message': error_message,
+        'filters': filters.as_query_params() if filters is not None else SearchFilters().as_query_params(),
+        'status_choices': Documento.STATUS_DOCUMENTO_CHOICES,
+        'hierarquia_choices': Documento.HIERARQUIA_NORMA_CHOICES,
+    }
 
 
 def melchior_search_view(request):
     query = request.GET.get('q', '').strip()
     results = []
     generated_answer = ""
-    error_message = ""
+    filters, error_message = _search_filters(request)
 
-    if query:
+    if query and filters is not None:
         try:
-            query_embedding_response = genai.embed_content(
-                model="models/embedding-001",
-                content=query,
-                task_type="RETRIEVAL_QUERY"
-            )
-            query_embedding = query_embedding_response['embedding']
-
-            chroma_results = collection.query(
-                query_embeddings=[query_embedding],
-                n_results=7,
-            )
-            
-            relevant_chunk_ids = []
-            if chroma_results and chroma_results['ids'] and chroma_results['ids'][0]:
-                for result_id in chroma_results['ids'][0]:
-                    django_chunk_id = int(result_id.split('_')[1])
-                    relevant_chunk_ids.append(django_chunk_id)
-
-            relevant_chunks_from_db = Chunk.objects.filter(id__in=relevant_chunk_ids, is_valido_apos_antinomia=True) \
-                                                    .order_by('documento__data_publicacao', 'ordem_no_documento')
-            
-            context_chunks_for_llm = []
-            ordered_chunks_map = {chunk.id: chunk for chunk in relevant_chunks_from_db}
-
-            for result_id in chroma_results['ids'][0]:
-                django_chunk_id = int(result_id.split('_')[1])
-                if django_chunk_id in ordered_chunks_map:
-                    chunk_obj = ordered_chunks_map[django_chunk_id]
-                    context_chunks_for_llm.append(
-                        f"Documento: {chunk_obj.documento.nome_arquivo}\n"
-                        f"Artigo/Trecho: {chunk_obj.conteudo_tratado}\n"
-                        f"---"
-                    )
-                    results.append({
-                        'ordem_no_documento': chunk_obj.ordem_no_documento,
-                        'documento_nome': chunk_obj.documento.nome_arquivo,
-                        'conteudo_tratado': chunk_obj.conteudo_tratado,
-                        'documento_data_publicacao': chunk_obj.documento.data_publicacao,
-                        'documento_hierarquia': chunk_obj.documento.hierarquia,
-                    })
-            
-            if context_chunks_for_llm:
-                context_str = "\n".join(context_chunks_for_llm)
-                
-                # --- PROMPT REFINADO AQUI ---
-                final_prompt = (
-                    f"Você é um assistente especializado em legislação do Brasil. "
-                    f"Sua tarefa é responder à 'Pergunta' de forma **direta e concisa**, "
-                    f"utilizando **APENAS** as 'Fontes' fornecidas. "
-                    f"Não invente informações. Se a resposta não estiver explicitamente nas fontes, "
-                    f"diga 'Não consigo responder com as informações fornecidas.' "
-                    f"Sua resposta deve ser um parágrafo claro e curto, sem iniciar com 'Com base nas fontes...' ou similar. "
-                    f"Após sua resposta direta, **obrigatóriamente** inclua uma seção 'Fontes Relevantes:' "
-                    f"listando cada fonte utilizada com a anotação: "
-                    f"'Fonte: Documento: [Nome do Documento], Artigo/Trecho: [Primeiras ~50 palavras do trecho relevante]'. "
-                    f"Priorize informações de leis mais recentes e de hierarquia superior se houver informações conflitantes nas fontes.\n\n"
-                    f"Fontes:\n{context_str}\n\n"
-                    f"Pergunta: {query}"
-                )
-                # --- FIM DO PROMPT REFINADO ---
-                
-                model = genai.GenerativeModel('gemini-1.5-flash') 
-                
-                response = model.generate_content(final_prompt)
-                generated_answer = response.text
-                
-                generated_answer = generated_answer.strip()
-
-            else:
-                generated_answer = "Não foram encontrados documentos relevantes para a sua pergunta no momento."
+            answer_model = get_answer_model()
+            prepared = prepare_answer(query, filters, answer_model)
+            results = [_result_entry(chunk_obj) for chunk_obj in prepared.chunks]
+            generated_answer = prepared.answer
+            if generated_answer is None:
+                generated_answer = answer_model.generate(prepared.prompt)
+                prepared.remember(generated_answer)
 
         except Exception as e:
             error_message = f"Ocorreu um erro ao processar sua solicitação: {e}. Por favor, tente novamente."
             print(f"ERRO: Erro na melchior_search_view: {e}")
 
-    context = {
-        'query': query,
-        'results': results,
-        'generated_answer': generated_answer,
-        'error_message': error_message,
-    }
-    return render(request, 'melchior/search.html', context)
\ No newline at end of file
+    return render(request, 'melchior/search.html', _search_context(query, results, generated_answer, error_message, filters))
+
+
+async def melchior_search_async_view(request):
+    """
+    Mesma busca da melchior_search_view para servidores ASGI: enquanto uma requisição espera o
+    embedding ou o LLM, o worker atende as outras.
+    """
+    query = request.GET.get('q', '').strip()
+    results = []
+    generated_answer = ""
+    filters, error_message = _search_filters(request)
+
+    if query and filters is not None:
+        try:
+            answer_model = get_answer_model()
+            prepared = await aprepare_answer(query, filters, answer_model)
+            results = [_result_entry(chunk_obj) for chunk_obj in prepared.chunks]
+            generated_answer = prepared.answer
+            if generated_answer is None:
+                generated_answer = await answer_model.agenerate(prepared.prompt)
+                await prepared.aremember(generated_answer)
+
+        except Exception as e:
+            error_message = f"Ocorreu um erro ao processar sua solicitação: {e}. Por favor, tente novamente."
+            print(f"ERRO: Erro na melchior_search_async_view: {e}")
+
+    return render(request, 'melchior/search.html', _search_context(query, results, generated_answer, error_message, filters))
+
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+
+def _stream_error(e):
+    return _sse('erro', {'mensagem': f"Ocorreu um erro ao processar sua solicitação: {e}. Por favor, tente novamente."})
+
+
+def _stream_events(query, filters, error_message):
+    if not query or filters is None:
+        yield _sse('erro', {'mensagem': error_message or "Informe uma pergunta."})
+        return
+    try:
+        answer_model = get_answer_model()
+        prepared = prepare_answer(query, filters, answer_model)
+        yield _sse('fontes', [_result_entry(chunk_obj) for chunk_obj in prepared.chunks])
+        if prepared.answer is not None:
+            yield _sse('resposta', {'texto': prepared.answer})
+        else:
+            pieces = []
+            for piece in answer_model.stream(prepared.prompt):
+                pieces.append(piece)
+                yield _sse('resposta', {'texto': piece})
+            prepared.remember(''.join(pieces).strip())
+        yield _sse('fim', {})
+    except Exception as e:
+        print(f"ERRO: Erro na melchior_search_stream_view: {e}")
+        yield _stream_error(e)
+
+
+async def _astream_events(query, filters, error_message):
+    # Os mesmos eventos de _stream_events(), sem bloquear o event loop entre um pedaço e outro
+    if not query or filters is None:
+        yield _sse('erro', {'mensagem': error_message or "Informe uma pergunta."})
+        return
+    try:
+        answer_model = get_answer_model()
+        prepared = await aprepare_answer(query, filters, answer_model)
+        yield _sse('fontes', [_result_entry(chunk_obj) for chunk_obj in prepared.chunks])
+        if prepared.answer is not None:
+            yield _sse('resposta', {'texto': prepared.answer})
+        else:
+            pieces = []
+            async for piece in answer_model.astream(prepared.prompt):
+                pieces.append(piece)
+                yield _sse('resposta', {'texto': piece})
+            await prepared.aremember(''.join(pieces).strip())
+        yield _sse('fim', {})
+    except Exception as e:
+        print(f"ERRO: Erro na melchior_search_stream_view: {e}")
+        yield _stream_error(e)
+
+
+def melchior_search_stream_view(request):
+    """
+    Mesma busca da melchior_search_view, como server-sent events: 'fontes' (os chunks recuperados,
+    assim que a busca termina), 'resposta' (cada pedaço do texto gerado), e 'fim' ou 'erro'.
+
+    Sob ASGI os eventos vêm de um gerador assíncrono: o Django só envia aos pedaços, sem acumular
+    a resposta inteira, um StreamingHttpResponse assíncrono. Sob WSGI, de um gerador comum.
+    """
+    query = request.GET.get('q', '').strip()
+    filters, error_message = _search_filters(request)
+
+    if isinstance(request, ASGIRequest):
+        events = _astream_events(query, filters, error_message)
+    else:
+        events = _stream_events(query, filters, error_message)
+
+    response = StreamingHttpResponse(events, content_type='text/event-stream; charset=utf-8')
+    response['Cache-Control'] = 'no-cache'
+    # Proxies como o nginx não devem acumular os eventos antes de repassá-los
+    response['X-Accel-Buffering'] = 'no'
+    return response